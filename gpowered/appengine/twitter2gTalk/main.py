@@ -2,20 +2,29 @@ import urllib
 import os, sys, re
 import logging
 import wsgiref.handlers
-from models import Account, RsaKey
+from models import Account, RsaKey, keys
 
+from google.appengine.ext import db
 from google.appengine.ext import webapp
 from google.appengine.api import users
 from google.appengine.ext.webapp import template
 from google.appengine.api import urlfetch
-from google.appengine.api.labs import taskqueue
+from google.appengine.api import memcache
+try:
+    from google.appengine.api import taskqueue
+except ImportError:
+    from google.appengine.api.labs import taskqueue
 import simplejson
 import rsa
+import timeline
 import datetime
+import hashlib
 import urllib2
 
 _DEBUG = True
 
+twitter = timeline.TimelineClient()
+
 class BaseRequestHandler(webapp.RequestHandler):
   
   def generate(self, template_name, template_values={}):
@@ -103,43 +112,29 @@ class SettingsHander(BaseRequestHandler):
                                                 })
 class TweetHander(BaseRequestHandler):
         
-    def makePubKey(self, k):
-        temp = k.split('!')
-        pubkey = {'e': long(temp[0]), 'n': long(temp[1])}
-        return pubkey
-    
-    def makePrivKey(self, k):
-        temp = k.split('!')
-        privkey = {'d': long(temp[0]), 'p': long(temp[1]), 'q': long(temp[2])}        
-        return privkey        
-    
     def getTwitterStatus(self, username):
-        twitter_url = 'http://twitter.com/statuses/user_timeline/%s.json?count=1'
-        url = twitter_url % username
-
-        result = urlfetch.fetch(url)
-            
-        json = simplejson.loads(str(result.content))
-        try:    
-            return json[0].get('text')  
-        except:
+        #None when Twitter can not be asked now, rate limited or down
+        try:
+            tweet = twitter.latest(username)
+        except timeline.TimelineError, e:
+            logging.error("could not get the timeline of TWITTER: %s: %s" % (username, e))
+            return None
+        if tweet is None:
             return 'twitter account is wrong in twitter2gTalk'
+        return tweet[1]
     
     def encryptGtalk(self, email, password, msg):   
-        gp_pub = RsaKey.gql("WHERE name = :1", 'gp_pub').get()
-        gae_priv = RsaKey.gql("WHERE name = :1", 'gae_priv').get()
-           
         gpowered_gtalk_url = 'http://gpowered.net/g/gtalk/update/%s/'
         
         enc = '%s!gpowered!%s!gpowered!%s' % (email, password, msg)
         
-        gp_pubkey = self.makePubKey(gp_pub.keystring)
-        gae_privkey = self.makePrivKey(gae_priv.keystring)        
+        gp_pubkey = keys.get('gp_pub')
+        gae_privkey = keys.get('gae_priv')
         
         gae_one = rsa.encrypt(str(enc), gp_pubkey)
         #gae_two = rsa.sign(gae_one, gae_privkey)
         
-        encrypted_url = gpowered_gtalk_url % gae_one.replace('/', '!GP!')
+        encrypted_url = gpowered_gtalk_url % gae_one
         
         return encrypted_url
     
@@ -149,9 +144,10 @@ class TweetHander(BaseRequestHandler):
         count = 0
         results = []
         #for user in users:
+        twitter_status = None
         if user.twitter and user.user and user.gPass:
-            twitter_status = None        
             twitter_status = self.getTwitterStatus(user.twitter) 
+        if twitter_status is not None:
             
             email = '%s@gmail.com' % user.user
             
@@ -169,33 +165,28 @@ class TweetHander(BaseRequestHandler):
                                                    'results' : results,
                                                 })
                                                 
-class ListHandler(BaseRequestHandler):
-
-    def makePubKey(self, k):
-        temp = k.split('!')
-        pubkey = {'e': long(temp[0]), 'n': long(temp[1])}
-        return pubkey
-    
-    def makePrivKey(self, k):
-        temp = k.split('!')
-        privkey = {'d': long(temp[0]), 'p': long(temp[1]), 'q': long(temp[2])}        
-        return privkey 
+#accounts fetched and encrypted together by ListHandler
+LIST_BATCH = 100
 
+class ListHandler(BaseRequestHandler):
+    #one line per active account, each encrypted on its own, so clients
+    #can decrypt and start on the first account while the rest arrives
     def get(self):
-        gp_pub = RsaKey.gql("WHERE name = :1", 'gp_pub').get()
-        gae_priv = RsaKey.gql("WHERE name = :1", 'gae_priv').get()
-        gp_pubkey = self.makePubKey(gp_pub.keystring)
-        gae_privkey = self.makePrivKey(gae_priv.keystring)
-        
-        ret = ''
-        users = Account.gql('WHERE active = :1 ', True)
-        
-        for user in users:
-            ret = ret + '%s!gp!%s!gp!%s!GP!' % (user.user, user.gPass, user.twitter)
+        gp_pubkey = keys.get('gp_pub')
+        self.response.headers['Content-Type'] = 'text/plain'
 
-        gae_one = rsa.encrypt(str(ret), gp_pubkey)
-        
-        self.generate('list.html', template_values={'users': gae_one})
+        query = Account.gql('WHERE active = :1', True)
+        users = query.fetch(LIST_BATCH)
+        while users:
+            messages = [str('%s!gp!%s!gp!%s' % (user.user, user.gPass, user.twitter))
+                        for user in users]
+            for record in rsa.encrypt_many(messages, gp_pubkey):
+                self.response.out.write('%s\n' % record)
+
+            if len(users) < LIST_BATCH:
+                break
+            query.with_cursor(query.cursor())
+            users = query.fetch(LIST_BATCH)
         
 class Prime(BaseRequestHandler):
     def get(self):
@@ -214,52 +205,124 @@ class CronHandler(BaseRequestHandler):
     def get(self):
         return None
     
+#active accounts per TaskLoader slice, and tasks per taskqueue add call
+SLICE_SIZE = 500
+ADD_BATCH = 100
+
+def add_tasks(tasks):
+    """Adds 'tasks' to the default queue ADD_BATCH at a time. Named tasks
+    that already exist, from an earlier try of the same slice, are
+    skipped; the rest of their batch is still added."""
+    queue = taskqueue.Queue()
+    for start in xrange(0, len(tasks), ADD_BATCH):
+        try:
+            queue.add(tasks[start:start + ADD_BATCH])
+        except (taskqueue.TaskAlreadyExistsError, taskqueue.TombstonedTaskError):
+            logging.info("skipped tasks that were already added")
+
 class TaskLoader(BaseRequestHandler):
-    def makePubKey(self, k):
-        temp = k.split('!')
-        pubkey = {'e': long(temp[0]), 'n': long(temp[1])}
-        return pubkey
-    
-    def makePrivKey(self, k):
-        temp = k.split('!')
-        privkey = {'d': long(temp[0]), 'p': long(temp[1]), 'q': long(temp[2])}        
-        return privkey 
+    #cron starts a run, one slice task per SLICE_SIZE accounts follows
     def get(self):
-        logging.info("Starting to load tasks %s" % datetime.datetime.now())
-        ret = ''
-        gp_pub = RsaKey.gql("WHERE name = :1", 'gp_pub').get()
-        gae_priv = RsaKey.gql("WHERE name = :1", 'gae_priv').get()
-        gp_pubkey = self.makePubKey(gp_pub.keystring)
-        gae_privkey = self.makePrivKey(gae_priv.keystring)
-        
-        
-        users = Account.gql('WHERE active = :1', True)
-        
-        count = 0
+        run = datetime.datetime.utcnow().strftime('%Y%m%d%H')
+        logging.info("Starting to load tasks for run %s" % run)
+        add_tasks([taskqueue.Task(url='/taskloader/',
+                                  params={'run': run, 'slice': 0},
+                                  name='load-%s-0' % run)])
+
+    #a slice queues the next slice, then a worker task per account.
+    #task names depend on run and slice only, so retries add nothing twice
+    def post(self):
+        run = self.request.get('run')
+        slice = int(self.request.get('slice'))
+        cursor = self.request.get('cursor')
+
+        gp_pubkey = keys.get('gp_pub')
+
+        query = Account.gql('WHERE active = :1', True)
+        if cursor:
+            query.with_cursor(cursor)
+        users = query.fetch(SLICE_SIZE)
+
+        if len(users) == SLICE_SIZE:
+            add_tasks([taskqueue.Task(url='/taskloader/',
+                                      params={'run': run,
+                                              'slice': slice + 1,
+                                              'cursor': query.cursor()},
+                                      name='load-%s-%d' % (run, slice + 1))])
+
+        accounts = []
+        messages = []
         for user in users:
             #logging.info(user.user)
             try:
                 ret = '%s!gp!%s!gp!%s' % (user.user, user.gPass, user.twitter)
-                gae_one = rsa.encrypt(str(ret), gp_pubkey)
-                #logging.debug("WTF %s" % ret)
-                send_key = gae_one.replace('\n', '!gp!')
-                taskqueue.add(url='/worker/', params={'key': send_key})
-                #logging.error("KEY !%s!" % gae_one.replace('\n', '!gp!'))
-                #logging.error("KEY !%d!" % gae_one.find('\n'))
-                logging.debug("USER: %s TWITTER: %s KEY: %s" % (user.user, user.twitter, send_key))
-                count += 1
+                messages.append(str(ret))
+                accounts.append(user)
             except:
                 logging.error("something is fucked with USER: %s TWITTER: %s" % (user.user, user.twitter))
-        
-        logging.info("Ended load tasks (%d users) %s" % (count, datetime.datetime.now()))
+
+        #encrypt everyone in one batch, the key is only prepared once
+        send_keys = rsa.encrypt_many(messages, gp_pubkey)
+
+        tasks = []
+        for index, send_key in enumerate(send_keys):
+            tasks.append(taskqueue.Task(url='/worker/',
+                                        params={'key': send_key,
+                                                'account': str(accounts[index].key()),
+                                                'run': run},
+                                        name='work-%s-%d-%d' % (run, slice, index)))
+        add_tasks(tasks)
+
+        logging.info("Loaded slice %d of run %s (%d users)" % (slice, run, len(tasks)))
             
-        
+def tweet_hash(text):
+    return hashlib.sha1(text.encode('utf-8')).hexdigest()
+
+def count(run, name):
+    memcache.incr('%s-%s' % (name, run), initial_value=0)
+
 class TaskWorker(BaseRequestHandler):
+    def tweet_changed(self, account):
+        """Returns False if the account has not tweeted anything new since
+        the last push. Otherwise notes the new tweet on the account."""
+        try:
+            tweet = twitter.latest(account.twitter, account.last_tweet_id)
+        except Exception:
+            #let the proxy fetch it and deal with it, as before
+            logging.exception("could not check TWITTER: %s" % account.twitter)
+            return True
+
+        if tweet is None:
+            return False
+
+        (tweet_id, text) = tweet
+        digest = tweet_hash(text or '')
+        if digest == account.last_tweet_hash:
+            return False
+
+        account.last_tweet_id = tweet_id
+        account.last_tweet_hash = digest
+        return True
+
     def post(self):
         key = self.request.get('key')
+        run = self.request.get('run')
+        account = None
+        if self.request.get('account'):
+            account = Account.get(self.request.get('account'))
+
+        if account and not self.tweet_changed(account):
+            logging.info("TWITTER: %s unchanged, skipped" % account.twitter)
+            count(run, 'skipped')
+            return
+
         #logging.error("WORKINGGGGGGG WITH !%s!" % key)
         #u = "http://django.gpowered.net/xmppproxy/eJwlzbkRwzAQQ9FclTjyAIs9e2ATzhW4/8gUnb4B5r/uL66lNiC9ukrd6/osgbIaEhzYkSnB0hjdesBGLu8KuuSPELERVeXBOlJ7Dm9p9H/tQqgzN84pZcCYGgrihvcPO6Mfww=="
         t = ''.join(["http://django.gpowered.net/xmppproxy/", key])
+        if account:
+            #the proxy queues the push and posts the account back to
+            #/undelivered/ if it gives up on it
+            t = '%s?%s' % (t, urllib.urlencode({'account': str(account.key())}))
         #logging.error("URL !%s!" % u)
         logging.info("URL !%s!" % t)
         result = urlfetch.fetch(t, 
@@ -271,6 +334,47 @@ class TaskWorker(BaseRequestHandler):
         #logging.error( result.headers)
         #logging.error( result.content)
         #logging.error( "!")
+
+        #only note the tweet as pushed once the proxy took it, otherwise
+        #fail the task so the queue retries it
+        if result.status_code < 200 or result.status_code >= 300:
+            logging.error("proxy answered %d for TWITTER: %s" % (
+                result.status_code, account and account.twitter))
+            self.error(500)
+            return
+
+        if account:
+            account.put()
+        count(run, 'pushed')
+
+class UndeliveredHandler(BaseRequestHandler):
+    #the proxy gave up on a push noted above: forget the tweet, so the
+    #next run pushes it again
+    def post(self):
+        try:
+            account = Account.get(self.request.get('account'))
+        except (db.BadKeyError, db.BadArgumentError, db.KindError):
+            account = None
+        if account is None:
+            self.error(404)
+            return
+
+        logging.info("proxy gave up on TWITTER: %s" % account.twitter)
+        account.last_tweet_id = None
+        account.last_tweet_hash = None
+        account.put()
+
+class StatsHandler(BaseRequestHandler):
+    #pushed/skipped counts of a run, the current hour by default
+    def get(self):
+        run = self.request.get('run') or datetime.datetime.utcnow().strftime('%Y%m%d%H')
+        pushed = int(memcache.get('pushed-%s' % run) or 0)
+        skipped = int(memcache.get('skipped-%s' % run) or 0)
+        total = max(pushed + skipped, 1)
+
+        self.response.headers['Content-Type'] = 'text/plain'
+        self.response.out.write("run %s: %d pushed (%.1f%%), %d skipped (%.1f%%)\n" % (
+            run, pushed, 100.0 * pushed / total, skipped, 100.0 * skipped / total))
     
 def main():
   application = webapp.WSGIApplication([('/', MainHandler),
@@ -281,6 +385,8 @@ def main():
                                        ('/cron/', CronHandler),
                                        ('/taskloader/', TaskLoader),
                                        ('/worker/', TaskWorker),
+                                       ('/undelivered/', UndeliveredHandler),
+                                       ('/stats/', StatsHandler),
                                        #('/prime/', Prime),  
                                        ],
                                        debug=True)
@@ -1,4 +1,5 @@
 from google.appengine.ext import db
+import rsa
 
 class Account(db.Model):
     user = db.UserProperty(required = True)
@@ -7,7 +8,27 @@ class Account(db.Model):
     twitter = db.StringProperty(required = True)
     active = db.BooleanProperty(required = True)
     counts = db.IntegerProperty(required = True)
+    #last tweet pushed to gTalk, so unchanged users can be skipped
+    last_tweet_id = db.IntegerProperty(required = False)
+    last_tweet_hash = db.StringProperty(required = False)
     
 class RsaKey(db.Model):
     name = db.StringProperty(required = True)
-    keystring = db.StringProperty(required = True)
\ No newline at end of file
+    keystring = db.StringProperty(required = True)
+
+    def put(self):
+        result = db.Model.put(self)
+        keys.invalidate()
+        return result
+
+    def delete(self):
+        db.Model.delete(self)
+        keys.invalidate()
+
+    save = put
+
+def load_keystring(name):
+    return RsaKey.gql("WHERE name = :1", name).get().keystring
+
+#parsed keys, other instances pick up a changed RsaKey after ten minutes
+keys = rsa.KeyRegistry(load_keystring, ttl=600)
@@ -0,0 +1,282 @@
+"""
+Tests for twitter2gTalk, run against the SDK's in-memory stubs:
+
+    python tests.py
+"""
+
+import base64
+import cgi
+import os
+import unittest
+
+from google.appengine.api import users
+from google.appengine.ext import testbed
+from google.appengine.ext import webapp
+
+import main
+import rsa
+from models import Account, RsaKey, keys
+
+APP_DIR = os.path.dirname(os.path.abspath(__file__))
+
+class TaskLoaderTest(unittest.TestCase):
+    def setUp(self):
+        self.testbed = testbed.Testbed()
+        self.testbed.activate()
+        self.testbed.init_datastore_v3_stub()
+        self.testbed.init_memcache_stub()
+        self.testbed.init_user_stub()
+        self.testbed.init_taskqueue_stub(root_path=APP_DIR)
+        self.taskqueue = self.testbed.get_stub(testbed.TASKQUEUE_SERVICE_NAME)
+
+        (pub, priv) = rsa.gen_pubpriv_keys(128, e=rsa.FIXED_EXPONENT)
+        self.privkey = priv
+        RsaKey(name='gp_pub', keystring=rsa.format_key(pub)).put()
+        keys.invalidate()
+
+        for i in range(7):
+            Account(user=users.User('user%d@gmail.com' % i), gPass='pass%d' % i,
+                    twitter='twitter%d' % i, active=True, counts=0).put()
+        Account(user=users.User('idle@gmail.com'), gPass='idle',
+                twitter='idle', active=False, counts=0).put()
+
+        self.slice_size = main.SLICE_SIZE
+        main.SLICE_SIZE = 3
+
+    def tearDown(self):
+        main.SLICE_SIZE = self.slice_size
+        self.testbed.deactivate()
+
+    def tasks(self, url):
+        return [task for task in self.taskqueue.GetTasks('default')
+                if task['url'] == url]
+
+    def run_loader_task(self, task):
+        params = cgi.parse_qs(base64.b64decode(task['body']))
+        post = dict([(name, values[0]) for name, values in params.items()])
+        handler = main.TaskLoader()
+        handler.initialize(webapp.Request.blank('/taskloader/', POST=post),
+                           webapp.Response())
+        handler.post()
+
+    def run_all(self):
+        done = []
+        while True:
+            pending = [task for task in self.tasks('/taskloader/')
+                       if task['name'] not in done]
+            if not pending:
+                return
+            for task in pending:
+                self.run_loader_task(task)
+                done.append(task['name'])
+
+    def test_fan_out(self):
+        """
+        Tests that every active account gets exactly one worker task, in
+        slices of SLICE_SIZE accounts.
+        """
+        handler = main.TaskLoader()
+        handler.initialize(webapp.Request.blank('/taskloader/'), webapp.Response())
+        handler.get()
+        self.run_all()
+
+        self.failUnlessEqual(len(self.tasks('/taskloader/')), 3)
+
+        workers = self.tasks('/worker/')
+        self.failUnlessEqual(len(workers), 7)
+
+        logins = []
+        for task in workers:
+            key = cgi.parse_qs(base64.b64decode(task['body']))['key'][0]
+            logins.append(rsa.decrypt(key, self.privkey).split('!gp!')[0])
+        logins.sort()
+        self.failUnlessEqual(logins, [str(users.User('user%d@gmail.com' % i))
+                                      for i in range(7)])
+
+    def test_retry_adds_nothing(self):
+        """
+        Tests that running the cron and the slices again does not queue
+        any task twice.
+        """
+        handler = main.TaskLoader()
+        handler.initialize(webapp.Request.blank('/taskloader/'), webapp.Response())
+        handler.get()
+        self.run_all()
+
+        handler.get()
+        for task in self.tasks('/taskloader/'):
+            self.run_loader_task(task)
+
+        self.failUnlessEqual(len(self.tasks('/taskloader/')), 3)
+        self.failUnlessEqual(len(self.tasks('/worker/')), 7)
+
+class ListHandlerTest(unittest.TestCase):
+    def setUp(self):
+        self.testbed = testbed.Testbed()
+        self.testbed.activate()
+        self.testbed.init_datastore_v3_stub()
+        self.testbed.init_memcache_stub()
+        self.testbed.init_user_stub()
+
+        (pub, priv) = rsa.gen_pubpriv_keys(128, e=rsa.FIXED_EXPONENT)
+        self.privkey = priv
+        RsaKey(name='gp_pub', keystring=rsa.format_key(pub)).put()
+        keys.invalidate()
+
+        for i in range(7):
+            Account(user=users.User('user%d@gmail.com' % i), gPass='pass%d' % i,
+                    twitter='twitter%d' % i, active=True, counts=0).put()
+        Account(user=users.User('idle@gmail.com'), gPass='idle',
+                twitter='idle', active=False, counts=0).put()
+
+        self.list_batch = main.LIST_BATCH
+        main.LIST_BATCH = 3
+
+    def tearDown(self):
+        main.LIST_BATCH = self.list_batch
+        self.testbed.deactivate()
+
+    def test_records(self):
+        """
+        Tests that every active account is one line that decrypts on its
+        own, across several batches.
+        """
+        handler = main.ListHandler()
+        response = webapp.Response()
+        handler.initialize(webapp.Request.blank('/list/'), response)
+        handler.get()
+
+        lines = response.out.getvalue().splitlines()
+        self.failUnlessEqual(len(lines), 7)
+        records = [rsa.decrypt(line, self.privkey).split('!gp!') for line in lines]
+        records.sort()
+        self.failUnlessEqual(records, [[str(users.User('user%d@gmail.com' % i)),
+                                        'pass%d' % i, 'twitter%d' % i]
+                                       for i in range(7)])
+
+class FakeFetchResult:
+    def __init__(self, status_code):
+        self.status_code = status_code
+        self.content = ''
+
+class TaskWorkerTest(unittest.TestCase):
+    def setUp(self):
+        self.testbed = testbed.Testbed()
+        self.testbed.activate()
+        self.testbed.init_datastore_v3_stub()
+        self.testbed.init_memcache_stub()
+        self.testbed.init_user_stub()
+
+        self.account = Account(user=users.User('user@gmail.com'), gPass='pass',
+                               twitter='twitter', active=True, counts=0)
+        self.account.put()
+
+        #no network here: fake the timeline and the proxy
+        self.timeline = [(10, u'first')]
+        self.since_ids = []
+        self.pushed = []
+        self.status_code = 200
+        self.latest = main.twitter.latest
+        self.fetch = main.urlfetch.fetch
+        main.twitter.latest = self.fake_latest
+        main.urlfetch.fetch = self.fake_fetch
+
+    def tearDown(self):
+        main.twitter.latest = self.latest
+        main.urlfetch.fetch = self.fetch
+        self.testbed.deactivate()
+
+    def fake_latest(self, username, since_id=None):
+        self.since_ids.append(since_id)
+        newer = [tweet for tweet in self.timeline if tweet[0] > (since_id or 0)]
+        if not newer:
+            return None
+        return newer[-1]
+
+    def fake_fetch(self, url, *args):
+        self.pushed.append(url)
+        return FakeFetchResult(self.status_code)
+
+    def work(self, run='2009010100'):
+        handler = main.TaskWorker()
+        response = webapp.Response()
+        handler.initialize(webapp.Request.blank('/worker/', POST={
+            'key': 'abc', 'account': str(self.account.key()), 'run': run}),
+            response)
+        handler.post()
+        return response
+
+    def stats(self, run='2009010100'):
+        handler = main.StatsHandler()
+        response = webapp.Response()
+        handler.initialize(webapp.Request.blank('/stats/?run=%s' % run), response)
+        handler.get()
+        return response.out.getvalue()
+
+    def test_unchanged_is_skipped(self):
+        """
+        Tests that the proxy is only called when there is a new tweet, and
+        that the last seen id is sent as since_id.
+        """
+        self.work()
+        self.work()
+        self.failUnlessEqual(len(self.pushed), 1)
+        self.failUnlessEqual(self.since_ids, [None, 10])
+
+        self.timeline.append((11, u'second'))
+        self.work()
+        self.failUnlessEqual(len(self.pushed), 2)
+        self.failUnlessEqual(Account.get(self.account.key()).last_tweet_id, 11)
+
+        self.failUnlessEqual(self.stats(),
+                             "run 2009010100: 2 pushed (66.7%), 1 skipped (33.3%)\n")
+
+    def test_same_text_is_skipped(self):
+        """
+        Tests that a new tweet repeating the last one is not pushed again.
+        """
+        self.work()
+        self.timeline.append((11, u'first'))
+        self.work()
+        self.failUnlessEqual(len(self.pushed), 1)
+
+    def test_failed_push_is_retried(self):
+        """
+        Tests that a tweet the proxy did not take is not noted as pushed,
+        and that the task fails so the queue runs it again.
+        """
+        self.status_code = 500
+        self.failUnlessEqual(self.work().status, 500)
+        self.failUnlessEqual(Account.get(self.account.key()).last_tweet_id, None)
+
+        self.status_code = 200
+        self.failUnlessEqual(self.work().status, 200)
+        self.failUnlessEqual(len(self.pushed), 2)
+        self.failUnlessEqual(Account.get(self.account.key()).last_tweet_id, 10)
+        self.failUnlessEqual(self.stats(),
+                             "run 2009010100: 1 pushed (100.0%), 0 skipped (0.0%)\n")
+
+    def test_undelivered(self):
+        """
+        Tests that a push the proxy queued and then gave up on is made
+        again on the next run.
+        """
+        self.work()
+        self.failUnless(self.pushed[0].endswith('/abc?account=%s' % self.account.key()))
+        self.work()
+        self.failUnlessEqual(len(self.pushed), 1)
+
+        handler = main.UndeliveredHandler()
+        response = webapp.Response()
+        handler.initialize(webapp.Request.blank('/undelivered/', POST={
+            'account': str(self.account.key())}), response)
+        handler.post()
+        self.failUnlessEqual(response.status, 200)
+
+        self.work()
+        self.failUnlessEqual(len(self.pushed), 2)
+        self.failUnlessEqual(self.since_ids, [None, 10, None])
+        self.failUnlessEqual(Account.get(self.account.key()).last_tweet_id, 10)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -139,6 +139,7 @@ class PageElement:
     def extract(self):
         """Destructively rips this element out of the tree."""
         if self.parent:
+            self.parent._contentsChanged()
             try:
                 self.parent.contents.remove(self)
             except ValueError:
@@ -192,6 +193,7 @@ class PageElement:
                     position = position - 1
             newChild.extract()
 
+        self._contentsChanged()
         newChild.parent = self
         previousChild = None
         if position == 0:
@@ -236,6 +238,15 @@ class PageElement:
         """Appends the given tag to the contents of this tag."""
         self.insert(len(self.contents), tag)
 
+    def _contentsChanged(self):
+        """Drops the name indexes of this tag and every tag above it, which
+        no longer match their contents."""
+        tag = self
+        while tag:
+            tag.nameIndex = None
+            tag.parsedTags = None
+            tag = tag.parent
+
     def findNext(self, name=None, attrs={}, text=None, **kwargs):
         """Returns the first item that matches the given criteria and
         appears after this Tag in the document."""
@@ -510,6 +521,8 @@ class Tag(PageElement):
         self.setup(parent, previous)
         self.hidden = False
         self.containsSubstitutions = False
+        self.nameIndex = None
+        self.parsedTags = None
         self.convertHTMLEntities = parser.convertHTMLEntities
         self.convertXMLEntities = parser.convertXMLEntities
         self.escapeUnrecognizedEntities = parser.escapeUnrecognizedEntities
@@ -765,11 +778,27 @@ class Tag(PageElement):
         string, a list of strings, a regular expression object, or a
         callable that takes a string and returns whether or not the
         string matches for some custom definition of 'matches'. The
-        same is true of the tag name."""
-        generator = self.recursiveChildGenerator
-        if not recursive:
-            generator = self.childGenerator
-        return self._findAll(name, attrs, text, limit, generator, **kwargs)
+        same is true of the tag name.
+
+        Plain tag names, or a list or set of them, are looked up in an
+        index of the tags below this one instead of walking them all. If
+        the name is a set, the ResultSet also has a 'groups' map from
+        each of the names to the ResultSet of its tags."""
+        if recursive and text is None and self._isNameList(name):
+            results = self._findIndexed(name, attrs, limit, **kwargs)
+        else:
+            generator = self.recursiveChildGenerator
+            if not recursive:
+                generator = self.childGenerator
+            results = self._findAll(name, attrs, text, limit, generator,
+                                    **kwargs)
+        if isinstance(name, set) and text is None:
+            results.groups = {}
+            for n in name:
+                results.groups[n] = ResultSet(results.source)
+            for tag in results:
+                results.groups[tag.name].append(tag)
+        return results
     findChildren = findAll
 
     # Pre-3.x compatibility methods
@@ -784,6 +813,54 @@ class Tag(PageElement):
 
     #Private methods
 
+    def _isNameList(self, name):
+        if isString(name):
+            return True
+        if type(name) not in (types.ListType, types.TupleType, set):
+            return False
+        for n in name:
+            if not isString(n):
+                return False
+        return True
+
+    def _getNameIndex(self):
+        """Returns a map from tag name to the (position, tag) pairs of the
+        tags below this one, in document order. It is built on first use,
+        from the tags the parser made if the tree has not changed since,
+        and dropped by insert() and extract(). Renaming a tag by setting
+        its name is not noticed."""
+        if self.nameIndex is None:
+            tags = self.parsedTags
+            if tags is None:
+                tags = [t for t in self.recursiveChildGenerator()
+                        if isinstance(t, Tag)]
+            index = {}
+            for position in range(len(tags)):
+                tag = tags[position]
+                index.setdefault(tag.name, []).append((position, tag))
+            self.nameIndex = index
+            self.parsedTags = None
+        return self.nameIndex
+
+    def _findIndexed(self, name, attrs, limit, **kwargs):
+        "Like _findAll(), with the candidates taken from the name index."
+        strainer = SoupStrainer(name, attrs, None, **kwargs)
+        index = self._getNameIndex()
+        if isString(name):
+            candidates = index.get(name, [])
+        else:
+            candidates = []
+            for n in dict([(n, None) for n in name]).keys():
+                candidates.extend(index.get(n, []))
+            candidates.sort()
+        results = ResultSet(strainer)
+        for position, tag in candidates:
+            if strainer.search(tag):
+                results.append(tag)
+                if limit and len(results) >= limit:
+                    break
+        return results
+
     def _getAttrMap(self):
         """Initializes a map representation of this tag's attributes,
         if not already initialized."""
@@ -1156,6 +1233,8 @@ class BeautifulStoneSoup(Tag, SGMLParser):
     def reset(self):
         Tag.__init__(self, self, self.ROOT_TAG_NAME)
         self.hidden = 1
+        # every tag made, in document order, for the name index
+        self.parsedTags = []
         SGMLParser.reset(self)
         self.currentData = []
         self.currentTag = None
@@ -1293,6 +1372,7 @@ class BeautifulStoneSoup(Tag, SGMLParser):
             return
 
         tag = Tag(self, name, attrs, self.currentTag, self.previous)
+        self.parsedTags.append(tag)
         if self.previous:
             self.previous.next = tag
         self.previous = tag
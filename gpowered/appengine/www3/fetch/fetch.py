@@ -1,18 +1,41 @@
-from BeautifulSoup import BeautifulSoup
 import os
 import sys
 import re
+import logging
 import wsgiref.handlers
 from google.appengine.api import urlfetch
+from google.appengine.api import memcache
 from google.appengine.ext import webapp
 from google.appengine.ext.webapp import template
 import htmllib, formatter
 import sgmllib
-from models import Img
+from models import Img, img_key_name
+import imagecache
+import rewriter
 from google.appengine.ext import db
+try:
+    from google.appengine.api import taskqueue
+except ImportError:
+    from google.appengine.api.labs import taskqueue
 
 _DEBUG = True
 
+#sub-resources fetched at once by MainHandler2
+FETCH_LIMIT = 10
+FETCH_DEADLINE = 10
+#Img entities re-keyed per MigrateImgs task
+MIGRATE_BATCH = 100
+#seconds browsers and edge caches may keep an image
+IMAGE_MAX_AGE = 86400
+#largest blob an Img entity holds
+MAX_PICTURE = 1000000
+#most picture bytes in one datastore put
+PUT_BYTES = 1000000
+
+#image bytes: instance LRU, then memcache, then Img entities
+images = imagecache.ImageCache([imagecache.MemcacheStore(memcache),
+                                imagecache.DatastoreStore(Img)])
+
 class BaseRequestHandler(webapp.RequestHandler):
 
     def generate(self, template_name, template_values={}):
@@ -43,48 +66,6 @@ class MainHandler(BaseRequestHandler):
 class MainHandler2(BaseRequestHandler):
     url = None
     foo = None
-    def my_blob(self, img):
-        loc = img.find('http:')
-        if loc < 0 or loc > 6:
-            if img[0] != '/':
-                img = '%s/1%s' % (self.url, img)
-            else:
-                #img = '%s%s' % (self.url, img)
-                loc2 = img.find('//')
-                if loc2 < 0:
-                    img = '%s%s' % (self.url, img)
-                else:
-                    img = 'http://google.com/%s/%s' % (self.url.split('//')[1].split('/'), img)
-        test = getImg(img)
-        if not test:
-            store = Img(url=img)
-            store.picture = db.Blob(urlfetch.Fetch(img).content)
-            store.put()
-        pass_on = 'image?img=%s' % img
-        return pass_on
-
-    def scan_blobs(self, tag, type):
-        for e in self.soup.findAll(tag):
-            try:
-                e['src'] = self.my_blob(e[type])
-            except:
-                pass
-    def url_fix(self, tag, type):
-        for a in self.soup.findAll(tag):
-            try:
-                href = a[type]
-                loc = href.find('http')
-                if loc < 0 or loc > 5:
-                        if href[0] != '/':
-                            href = '%s%s/%s' % ('?l=', self.url, href)
-                        else:
-                            href = '%s%s%s' % ('?l=', self.url, href)
-                else:
-                        href = '%s%s' % ('?l=', href)
-                a['href'] = href
-            except:
-                pass
-
     def start(self):
         self.generate('start.html', template_values={'url': self.foo,
                                             
@@ -102,61 +83,142 @@ class MainHandler2(BaseRequestHandler):
         if loc < 0 or loc > 5:
             self.url = 'http://%s' % self.url
         result = urlfetch.fetch(self.url)
-        self.soup = BeautifulSoup(result.content)
-    #print soup.prettify()
-        self.scan_blobs('img', 'src')
-        self.scan_blobs('script', 'src')
-        self.scan_blobs('style', 'src')
-        self.url_fix('a', 'href')
-        self.url_fix('link', 'href')
-        
-    
-            
-        for a in self.soup.findAll('form'):
-            try:
-                href = a['action']
-                loc = href.find('http')
-                if loc < 0 or loc > 5:
-                        if href[0] != '/':
-                            href = '%s%s/%s' % ('?l=', self.url, href)
-                        else:
-                            href = '%s%s%s' % ('?l=', self.url, href)
-                else:
-                        href = '%s%s' % ('?l=', href)
-                a['action'] = href
-                self.foo = a['action']
-            except:
-                pass            
-
-        self.generate('base.html', template_values={'url': self.url,
-                                            'page': self.soup.prettify(),
-                                            #'links': links,
-                                            #'imgs': imgs
-                                            })
-
+        #one pass over the page, written out as it is rewritten
+        resources = rewriter.rewrite_page(self.url, result.content,
+                                          self.response.out.write)
+        #the page is already written, a cache failure only costs a refetch
+        try:
+            cacheImgs(resources)
+        except Exception:
+            logging.exception('could not cache the images of %s' % self.url)
 
-        
 class GetImage(webapp.RequestHandler):
     def get(self):
         url = self.request.get('img')
-        img = getImg(url)
-        if (img and img.picture):
-            self.response.headers['Content-Type'] = 'image/jpg'
-            self.response.out.write(img.picture)
-        else:
-            self.redirect('/static/noimage.jpg')
-    
-def getImg(url):
-    result = db.GqlQuery("SELECT * FROM Img WHERE url = :1 LIMIT 1", url).fetch(1)
-    if (len(result) > 0):
-        return result[0]
-    else:
-        return None
-            
+        image = images.get(url)
+        if image is None:
+            #not cached, or could not be: the page points here for every
+            #source, so send the browser to the original
+            if url.startswith('http://') or url.startswith('https://'):
+                self.redirect(url)
+            else:
+                self.error(404)
+            return
+        self.response.headers['ETag'] = image.etag
+        self.response.headers['Cache-Control'] = 'public, max-age=%d' % IMAGE_MAX_AGE
+        if image.matches(self.request.headers.get('If-None-Match', '')):
+            self.response.set_status(304)
+            return
+        self.response.headers['Content-Type'] = image.content_type
+        self.response.out.write(image.data)
+
+def getImgs(urls):
+    """Returns a dict of url to Img for the stored ones among 'urls'"""
+    found = {}
+    for url, img in zip(urls, Img.get_by_urls(urls)):
+        if img is not None:
+            found[url] = img
+    return found
+
+def fetchImgs(urls):
+    """Fetches 'urls' with at most FETCH_LIMIT RPCs in flight and returns
+    new, unsaved Img entities for the ones that could be fetched"""
+    imgs = []
+    rpcs = []
+
+    def finish(url, rpc):
+        try:
+            content = rpc.get_result().content
+        except urlfetch.Error:
+            return
+        if len(content) > MAX_PICTURE:
+            return
+        try:
+            imgs.append(Img.create(url, db.Blob(content)))
+        except db.BadValueError:
+            #urls over the 500 bytes of a StringProperty are not cached
+            logging.info('not caching %s...' % url[:100])
+
+    for url in urls:
+        if len(rpcs) == FETCH_LIMIT:
+            finish(*rpcs.pop(0))
+        rpc = urlfetch.create_rpc(deadline=FETCH_DEADLINE)
+        try:
+            urlfetch.make_fetch_call(rpc, url)
+        except urlfetch.Error:
+            continue
+        rpcs.append((url, rpc))
+    for url, rpc in rpcs:
+        finish(url, rpc)
+    return imgs
+
+def putBatches(imgs):
+    """Puts 'imgs' in batches of at most PUT_BYTES of pictures, logging
+    the batches that fail. Returns the Imgs stored."""
+    put = []
+    batch = []
+    size = 0
+    for img in imgs + [None]:
+        if batch and (img is None or size + len(img.picture) > PUT_BYTES):
+            try:
+                db.put(batch)
+                put.extend(batch)
+            except Exception:
+                logging.exception('could not store %d images' % len(batch))
+            batch = []
+            size = 0
+        if img is not None:
+            batch.append(img)
+            size += len(img.picture)
+    return put
+
+def cacheImgs(urls):
+    """Stores every one of 'urls' as an Img: one lookup for all of them,
+    concurrent fetches of the misses and puts bounded by PUT_BYTES.
+    Returns the set of urls stored."""
+    unique = []
+    for url in urls:
+        if url not in unique:
+            unique.append(url)
+    stored = getImgs(unique)
+    fetched = putBatches(fetchImgs([url for url in unique if url not in stored]))
+    return set(stored.keys()) | set([img.url for img in fetched])
+
             
+class MigrateImgs(webapp.RequestHandler):
+    #re-keys Img entities stored under an auto id by their url digest,
+    #MIGRATE_BATCH per task, each task queueing the next
+    def get(self):
+        taskqueue.Task(url='/migrate/').add()
+        self.response.out.write('migration started\n')
+
+    def post(self):
+        query = Img.all()
+        cursor = self.request.get('cursor')
+        if cursor:
+            query.with_cursor(cursor)
+        imgs = query.fetch(MIGRATE_BATCH)
+        if len(imgs) == MIGRATE_BATCH:
+            taskqueue.Task(url='/migrate/', params={'cursor': query.cursor()}).add()
+
+        #ids sort before names, so keyed copies are only met after the rest
+        old = [img for img in imgs if img.key().name() is None]
+        if not old:
+            return
+        existing = Img.get_by_urls([img.url for img in old])
+        keyed = {}
+        for img, current in zip(old, existing):
+            key_name = img_key_name(img.url)
+            if current is None and key_name not in keyed:
+                keyed[key_name] = Img.create(img.url, img.picture)
+        db.put(keyed.values())
+        db.delete(old)
+        logging.info("re-keyed %d of %d Img entities" % (len(keyed), len(old)))
+
 def main():
     application = webapp.WSGIApplication([('/', MainHandler2),
                                           ('/image', GetImage),
+                                          ('/migrate/', MigrateImgs),
                                       ],
                                       debug=True)
     wsgiref.handlers.CGIHandler().run(application)
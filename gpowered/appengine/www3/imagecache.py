@@ -0,0 +1,203 @@
+"""Layered cache of image bytes for GetImage
+
+Images are looked up in a per-instance LRU bounded by total bytes, then in
+memcache, then in the datastore. A hit in a lower layer is copied into the
+layers above it. Memcache items are limited to 1MB, so larger images are
+stored as chunks under their own keys with a header item pointing at them.
+
+The layers only need get(url) and put(url, data), so the memcache client
+and the datastore model are passed in and can be replaced by local
+stand-ins.
+"""
+
+import hashlib
+
+# Largest value memcache takes, less room for the key and flags
+MEMCACHE_ITEM = 1000000 - 1024
+
+# Bytes kept in the per-instance LRU
+LRU_BYTES = 8 * 1024 * 1024
+
+CONTENT_TYPES = (
+    ('\x89PNG', 'image/png'),
+    ('GIF8', 'image/gif'),
+    ('\xff\xd8', 'image/jpeg'),
+    ('BM', 'image/bmp'),
+)
+
+def content_type(data):
+    """Returns the image type of 'data' from its first bytes
+
+    >>> content_type('GIF89a...'), content_type('\\xff\\xd8\\xff\\xe0')
+    ('image/gif', 'image/jpeg')
+    >>> content_type('<html>')
+    'application/octet-stream'
+    """
+    for magic, type in CONTENT_TYPES:
+        if data.startswith(magic):
+            return type
+    return 'application/octet-stream'
+
+class Image:
+    """Bytes of a cached image with their type and ETag"""
+
+    def __init__(self, data):
+        self.data = data
+        self.content_type = content_type(data)
+        self.etag = '"%s"' % hashlib.sha1(data).hexdigest()
+
+    def __len__(self):
+        return len(self.data)
+
+    def matches(self, if_none_match):
+        """True if an If-None-Match header value names this image"""
+        if if_none_match.strip() == '*':
+            return True
+        return self.etag in [tag.strip() for tag in if_none_match.split(',')]
+
+class LRUCache:
+    """Keeps the most recently used values whose lengths add up to at most
+    'max_bytes'"""
+
+    def __init__(self, max_bytes=LRU_BYTES):
+        self.max_bytes = max_bytes
+        self.size = 0
+        # key: [previous, next, key, value], in a ring around self.root
+        self.entries = {}
+        self.root = []
+        self.root[:] = [self.root, self.root, None, None]
+
+    def unlink(self, entry):
+        entry[0][1] = entry[1]
+        entry[1][0] = entry[0]
+
+    def link(self, entry):
+        # newest right before root, oldest right after it
+        last = self.root[0]
+        entry[0] = last
+        entry[1] = self.root
+        last[1] = entry
+        self.root[0] = entry
+
+    def get(self, key):
+        entry = self.entries.get(key)
+        if entry is None:
+            return None
+        self.unlink(entry)
+        self.link(entry)
+        return entry[3]
+
+    def put(self, key, value):
+        self.remove(key)
+        if len(value) > self.max_bytes:
+            return
+        entry = [None, None, key, value]
+        self.entries[key] = entry
+        self.link(entry)
+        self.size += len(value)
+        while self.size > self.max_bytes:
+            self.remove(self.root[1][2])
+
+    def remove(self, key):
+        entry = self.entries.pop(key, None)
+        if entry is not None:
+            self.unlink(entry)
+            self.size -= len(entry[3])
+
+    def __len__(self):
+        return len(self.entries)
+
+class MemcacheStore:
+    """Image bytes in memcache, split in chunks of 'chunk_size' bytes when
+    they do not fit one item"""
+
+    def __init__(self, client, prefix='img:', chunk_size=MEMCACHE_ITEM):
+        self.client = client
+        self.prefix = prefix
+        self.chunk_size = chunk_size
+
+    def key(self, url):
+        if isinstance(url, unicode):
+            url = url.encode('utf-8')
+        return '%s%s' % (self.prefix, hashlib.sha1(url).hexdigest())
+
+    def get(self, url):
+        key = self.key(url)
+        item = self.client.get(key)
+        if not isinstance(item, tuple):
+            return item
+        (chunks, size) = item
+        keys = ['%s:%d' % (key, i) for i in range(chunks)]
+        found = self.client.get_multi(keys)
+        if len(found) != chunks:
+            # some chunk was evicted
+            return None
+        data = ''.join([found[k] for k in keys])
+        if len(data) != size:
+            return None
+        return data
+
+    def put(self, url, data):
+        key = self.key(url)
+        if len(data) <= self.chunk_size:
+            self.client.set(key, data)
+            return
+        chunks = {}
+        for i in range(0, len(data), self.chunk_size):
+            chunks['%s:%d' % (key, i / self.chunk_size)] = data[i:i + self.chunk_size]
+        # the header goes last, so it never points at missing chunks.
+        # set_multi returns the keys it could not set
+        if self.client.set_multi(chunks):
+            return
+        self.client.set(key, (len(chunks), len(data)))
+
+class DatastoreStore:
+    """Image bytes in the 'picture' of 'model' entities keyed by url"""
+
+    def __init__(self, model):
+        self.model = model
+
+    def get(self, url):
+        img = self.model.get_by_url(url)
+        if img is None:
+            return None
+        return img.picture
+
+    def put(self, url, data):
+        self.model.create(url, data).put()
+
+class ImageCache:
+    """Looks images up in an LRU of Image objects, then in 'stores' in
+    order, copying hits into the layers above"""
+
+    def __init__(self, stores, max_bytes=LRU_BYTES):
+        self.lru = LRUCache(max_bytes)
+        self.stores = stores
+
+    def get(self, url):
+        """Returns the Image of 'url', or None if no layer has it"""
+        image = self.lru.get(url)
+        if image is not None:
+            return image
+        for index, store in enumerate(self.stores):
+            data = store.get(url)
+            if data:
+                data = str(data)
+                for upper in self.stores[:index]:
+                    upper.put(url, data)
+                image = Image(data)
+                self.lru.put(url, image)
+                return image
+        return None
+
+    def put(self, url, data):
+        for store in self.stores:
+            store.put(url, data)
+        self.lru.put(url, Image(data))
+
+# Do doctest if we're not imported
+if __name__ == "__main__":
+    import doctest
+    doctest.testmod()
+
+__all__ = ["ImageCache", "MemcacheStore", "DatastoreStore", "LRUCache", "Image"]
@@ -1,6 +1,41 @@
+import hashlib
+import urlparse
+
 from google.appengine.ext import db
 
+def normalize_url(url):
+    """Returns 'url' with the scheme and host lowercased, the default port
+    and the fragment dropped and an empty path made '/'"""
+    (scheme, netloc, path, query, fragment) = urlparse.urlsplit(url.strip())
+    scheme = scheme.lower()
+    netloc = netloc.lower()
+    if scheme == 'http' and netloc.endswith(':80'):
+        netloc = netloc[:-3]
+    elif scheme == 'https' and netloc.endswith(':443'):
+        netloc = netloc[:-4]
+    return urlparse.urlunsplit((scheme, netloc, path or '/', query, ''))
+
+def img_key_name(url):
+    """Key name of the Img stored for 'url'. Key names may not start with
+    a digit, so the digest gets a prefix."""
+    url = normalize_url(url)
+    if isinstance(url, unicode):
+        url = url.encode('utf-8')
+    return 'u%s' % hashlib.sha1(url).hexdigest()
+
 class Img(db.Model):
     url = db.StringProperty(required = True)
     picture = db.BlobProperty(default=None)
 
+    @classmethod
+    def create(cls, url, picture):
+        return cls(key_name=img_key_name(url), url=url, picture=picture)
+
+    @classmethod
+    def get_by_url(cls, url):
+        return cls.get_by_key_name(img_key_name(url))
+
+    @classmethod
+    def get_by_urls(cls, urls):
+        """Returns the Img of every one of 'urls', None where there is none"""
+        return cls.get_by_key_name([img_key_name(url) for url in urls])
@@ -0,0 +1,80 @@
+#!/usr/bin/python
+"""Benchmark of the www3 page rewrite: PageRewriter against BeautifulSoup
+
+Usage: rewriteBenchmark.py [blocks ...]
+
+Each block of the generated pages has links, images, a script, a form and
+some text. Every run is made in a child process, so its peak memory can be
+told apart.
+"""
+import os
+import sys
+import time
+import resource
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+import rewriter
+
+BLOCKS = (100, 1000, 5000)
+
+BLOCK = '''<div class="post" id="post%(i)d">
+<h2><a href="/posts/%(i)d">Post number %(i)d</a></h2>
+<p>Some text &amp; an entity, <b>bold</b> and <i>italic</i> words, and a
+<a href="http://example.com/elsewhere?a=%(i)d&amp;b=2">link away</a>.</p>
+<img src="/images/%(i)d.png" alt="picture %(i)d" width="100" height="80">
+<img src="http://cdn.example.com/thumbs/%(i)d.jpg">
+<script type="text/javascript">var n%(i)d = 1 < 2 && "<b>%(i)d</b>";</script>
+<form action="/comment/%(i)d" method="post"><input type="text" name="c"></form>
+</div>
+'''
+
+def page(blocks):
+    """Returns a page of 'blocks' blocks"""
+    return '<html><head><title>bench</title>' \
+           '<link rel="stylesheet" href="/style.css">' \
+           '<script src="/site.js"></script></head><body>\n%s</body></html>' % (
+               ''.join([BLOCK % {'i': i} for i in xrange(blocks)]))
+
+def streamed(content):
+    out = []
+    rewriter.rewrite_page('http://example.com', content, out.append)
+    return len(''.join(out))
+
+def souped(content):
+    return len(rewriter.soup_rewrite('http://example.com', content)[0])
+
+def measure(func, content):
+    """Returns (seconds, peak KB above the start) of func(content), run in
+    a child process"""
+    (read, write) = os.pipe()
+    pid = os.fork()
+    if pid == 0:
+        os.close(read)
+        before = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        start = time.time()
+        func(content)
+        took = time.time() - start
+        peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss - before
+        os.write(write, '%f %d' % (took, peak))
+        os._exit(0)
+    os.close(write)
+    result = os.read(read, 100)
+    os.close(read)
+    os.waitpid(pid, 0)
+    (took, peak) = result.split()
+    return (float(took), int(peak))
+
+def main(args):
+    blocks = [int(arg) for arg in args] or BLOCKS
+    print 'rewrite: seconds and peak KB per page'
+    for count in blocks:
+        content = page(count)
+        (soup_took, soup_peak) = measure(souped, content)
+        (took, peak) = measure(streamed, content)
+        print '  %5d blocks %8d bytes  soup %7.3f s %8d KB  ' \
+              'stream %7.3f s %8d KB  %5.1fx' % (
+                  count, len(content), soup_took, soup_peak, took, peak,
+                  soup_took / took)
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
@@ -0,0 +1,228 @@
+"""Page rewriting for the www3 proxy
+
+PageRewriter makes one pass over a page with sgmllib's start tag
+callbacks. It points img, script and style sources at /image and links,
+stylesheets and forms back at the proxy, and hands the output to 'write'
+piece by piece. No tree is built. Markup it does not rewrite is written
+out as it came in, and so are script and style bodies.
+
+soup_rewrite() is the BeautifulSoup version MainHandler2 used before. It
+builds the whole tree, finds the tags to rewrite with one findAll() and
+prettify()s it. rewriteBenchmark.py compares the two.
+"""
+
+import htmlentitydefs
+import re
+from sgmllib import SGMLParser, SGMLParseError, tagfind, attrfind
+
+# tag: attribute pointed at /image
+RESOURCE_ATTRS = {'img': 'src', 'script': 'src', 'style': 'src'}
+# tag: attribute pointed back at the proxy
+LINK_ATTRS = {'a': 'href', 'link': 'href', 'form': 'action'}
+
+# tags whose bodies are passed on without looking for markup in them
+QUOTE_TAG = re.compile(r'<(script|style)[\s>/]', re.I)
+
+def resource_url(base, src):
+    """Returns the absolute url of the sub-resource 'src' of page 'base'"""
+    loc = src.find('http:')
+    if loc < 0 or loc > 6:
+        if src[0] != '/':
+            src = '%s/1%s' % (base, src)
+        else:
+            loc2 = src.find('//')
+            if loc2 < 0:
+                src = '%s%s' % (base, src)
+            else:
+                src = 'http://google.com/%s/%s' % (base.split('//')[1].split('/'), src)
+    return src
+
+def proxy_link(base, href):
+    """Returns the proxy url of the link 'href' on page 'base'"""
+    loc = href.find('http')
+    if loc < 0 or loc > 5:
+        if href[0] != '/':
+            return '%s%s/%s' % ('?l=', base, href)
+        return '%s%s%s' % ('?l=', base, href)
+    return '%s%s' % ('?l=', href)
+
+def image_url(url):
+    return 'image?img=%s' % url
+
+def quote_attr(value):
+    return value.replace('&', '&amp;').replace('"', '&quot;')
+
+def replace_attr(text, name, value):
+    """Returns the start tag 'text' with the first 'name' attribute set to
+    'value'. The rest of the tag is left as it came, since sgmllib only
+    decodes a few entities in the attributes it parses."""
+    k = tagfind.match(text, 1).end()
+    while 1:
+        match = attrfind.match(text, k)
+        if not match:
+            return text
+        if match.group(1).lower() == name:
+            return '%s="%s"%s' % (text[:match.end(1)], quote_attr(value),
+                                  text[match.end():])
+        k = match.end()
+
+class PageRewriter(SGMLParser):
+    """Rewrites the page at 'base' as it is fed, passing the output to
+    write(). The absolute urls of the sub-resources pointed at /image are
+    collected in 'resources'."""
+
+    def __init__(self, base, write):
+        SGMLParser.__init__(self)
+        self.base = base
+        self.write = write
+        self.resources = []
+
+    def rewrite(self, tag, attrs):
+        """Returns the (attribute, value) to change in 'attrs', or None if
+        there is nothing to change"""
+        if tag in RESOURCE_ATTRS:
+            name = RESOURCE_ATTRS[tag]
+        elif tag in LINK_ATTRS:
+            name = LINK_ATTRS[tag]
+        else:
+            return None
+
+        for attr, value in attrs:
+            if attr != name:
+                continue
+            try:
+                if tag in RESOURCE_ATTRS:
+                    url = resource_url(self.base, value)
+                    self.resources.append(url)
+                    value = image_url(url)
+                else:
+                    value = proxy_link(self.base, value)
+            except IndexError:
+                # empty attribute, left as it is
+                return None
+            return (attr, value)
+        return None
+
+    def finish_starttag(self, tag, attrs):
+        text = self.get_starttag_text()
+        rewritten = self.rewrite(tag, attrs)
+        if rewritten is not None:
+            text = replace_attr(text, *rewritten)
+        self.write(text)
+
+    def parse_starttag(self, i):
+        rawdata = self.rawdata
+        quoted = QUOTE_TAG.match(rawdata, i)
+        if quoted:
+            # sgmllib ends a start tag at the first '>' too
+            j = rawdata.find('>', i)
+            if j < 0:
+                return -1
+            if rawdata[j - 1] == '/':
+                # <script src="..."/> has no body
+                quoted = None
+            else:
+                close = re.compile('</%s' % quoted.group(1), re.I)
+                if not close.search(rawdata, j):
+                    # wait for the rest of the body
+                    return -1
+        k = SGMLParser.parse_starttag(self, i)
+        if k < 0 or not quoted:
+            return k
+        end = close.search(rawdata, k).start()
+        self.write(rawdata[k:end])
+        return end
+
+    def parse_endtag(self, i):
+        k = SGMLParser.parse_endtag(self, i)
+        if k >= 0:
+            self.write(self.rawdata[i:k])
+        return k
+
+    def finish_endtag(self, tag):
+        pass
+
+    # comments, declarations and processing instructions are written out
+    # as they are
+    def parse_comment(self, i, report=1):
+        k = SGMLParser.parse_comment(self, i, report)
+        if k >= 0:
+            self.write(self.rawdata[i:k])
+        return k
+
+    def parse_declaration(self, i):
+        try:
+            k = SGMLParser.parse_declaration(self, i)
+        except SGMLParseError:
+            k = len(self.rawdata)
+        if k >= 0:
+            self.write(self.rawdata[i:k])
+        return k
+
+    def parse_pi(self, i):
+        k = SGMLParser.parse_pi(self, i)
+        if k >= 0:
+            self.write(self.rawdata[i:i + k])
+        return k
+
+    def handle_comment(self, data):
+        pass
+
+    def handle_decl(self, data):
+        pass
+
+    def handle_pi(self, data):
+        pass
+
+    def unknown_decl(self, data):
+        pass
+
+    def handle_data(self, data):
+        self.write(data)
+
+    def handle_charref(self, ref):
+        self.write('&#%s;' % ref)
+
+    def handle_entityref(self, ref):
+        # sgmllib does not tell whether there was a ';', so an unknown name
+        # is taken for a stray ampersand, as BeautifulSoup does
+        if ref in htmlentitydefs.entitydefs:
+            self.write('&%s;' % ref)
+        else:
+            self.write('&%s' % ref)
+
+def rewrite_page(base, content, write, chunk_size=8192):
+    """Rewrites 'content', the page at 'base', passing the output to
+    write() as it goes. Returns the sub-resource urls pointed at /image."""
+    rewriter = PageRewriter(base, write)
+    for i in range(0, len(content), chunk_size):
+        rewriter.feed(content[i:i + chunk_size])
+    rewriter.close()
+    return rewriter.resources
+
+def soup_rewrite(base, content):
+    """Rewrites 'content' like rewrite_page(), through a BeautifulSoup tree.
+    Returns the prettify()ed page and the sub-resource urls."""
+    from BeautifulSoup import BeautifulSoup
+
+    soup = BeautifulSoup(content)
+    names = set(RESOURCE_ATTRS.keys() + LINK_ATTRS.keys())
+    found = soup.findAll(names).groups
+    resources = []
+    for tag, attr in RESOURCE_ATTRS.items():
+        for e in found[tag]:
+            try:
+                url = resource_url(base, e[attr])
+            except (KeyError, IndexError):
+                continue
+            resources.append(url)
+            e[attr] = image_url(url)
+    for tag, attr in LINK_ATTRS.items():
+        for e in found[tag]:
+            try:
+                e[attr] = proxy_link(base, e[attr])
+            except (KeyError, IndexError):
+                pass
+    return (soup.prettify(), resources)
+
+__all__ = ["PageRewriter", "rewrite_page", "soup_rewrite"]
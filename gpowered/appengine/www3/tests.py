@@ -0,0 +1,246 @@
+"""
+Tests for www3. They use local stand-ins for memcache and the datastore,
+so no SDK is needed:
+
+    python tests.py
+"""
+
+import unittest
+
+import BeautifulSoup
+import imagecache
+import rewriter
+
+class FakeMemcache:
+    """The memcache calls MemcacheStore makes, on a dict"""
+
+    def __init__(self, item_limit=100):
+        self.items = {}
+        self.item_limit = item_limit
+        self.calls = 0
+
+    def get(self, key):
+        self.calls += 1
+        return self.items.get(key)
+
+    def get_multi(self, keys):
+        self.calls += 1
+        return dict([(key, self.items[key]) for key in keys if key in self.items])
+
+    def set(self, key, value):
+        self.calls += 1
+        if isinstance(value, str) and len(value) > self.item_limit:
+            return False
+        self.items[key] = value
+        return True
+
+    def set_multi(self, mapping):
+        self.calls += 1
+        failed = []
+        for key, value in mapping.items():
+            if len(value) > self.item_limit:
+                failed.append(key)
+            else:
+                self.items[key] = value
+        return failed
+
+class FakeStore:
+    """A datastore layer on a dict, counting reads"""
+
+    def __init__(self):
+        self.data = {}
+        self.reads = 0
+
+    def get(self, url):
+        self.reads += 1
+        return self.data.get(url)
+
+    def put(self, url, data):
+        self.data[url] = data
+
+class LRUCacheTest(unittest.TestCase):
+    def test_bytes_bound(self):
+        """
+        Tests that the least recently used values go first once the total
+        length is over max_bytes, and that oversized values are not kept.
+        """
+        lru = imagecache.LRUCache(10)
+        lru.put('a', 'aaaa')
+        lru.put('b', 'bbbb')
+        lru.get('a')
+        lru.put('c', 'cccc')
+        self.failUnlessEqual(lru.get('b'), None)
+        self.failUnlessEqual(lru.get('a'), 'aaaa')
+        self.failUnlessEqual(lru.get('c'), 'cccc')
+        self.failUnlessEqual(lru.size, 8)
+
+        lru.put('d', 'd' * 11)
+        self.failUnlessEqual(lru.get('d'), None)
+        lru.put('a', 'a' * 10)
+        self.failUnlessEqual(len(lru), 1)
+        self.failUnlessEqual(lru.size, 10)
+
+class ImageCacheTest(unittest.TestCase):
+    def setUp(self):
+        self.memcache = FakeMemcache(item_limit=100)
+        self.datastore = FakeStore()
+        self.memcache_store = imagecache.MemcacheStore(self.memcache, chunk_size=100)
+        self.cache = imagecache.ImageCache([self.memcache_store, self.datastore],
+                                           max_bytes=1000)
+
+    def test_layers(self):
+        """
+        Tests that a datastore hit is copied to memcache and the LRU, so
+        the next get reads neither.
+        """
+        self.datastore.put('http://a/1.gif', 'GIF89a' + 'x' * 50)
+        image = self.cache.get('http://a/1.gif')
+        self.failUnlessEqual(image.content_type, 'image/gif')
+        self.failUnlessEqual(self.memcache_store.get('http://a/1.gif'), image.data)
+
+        reads = (self.datastore.reads, self.memcache.calls)
+        self.failUnless(self.cache.get('http://a/1.gif') is image)
+        self.failUnlessEqual((self.datastore.reads, self.memcache.calls), reads)
+
+        # another instance, with an empty LRU, stops at memcache
+        other = imagecache.ImageCache([self.memcache_store, self.datastore])
+        self.failUnlessEqual(other.get('http://a/1.gif').etag, image.etag)
+        self.failUnlessEqual(self.datastore.reads, reads[0])
+
+        self.failUnlessEqual(self.cache.get('http://a/missing.gif'), None)
+
+    def test_chunks(self):
+        """
+        Tests that images over the memcache item limit are stored in
+        chunks, and that losing a chunk falls back to the datastore.
+        """
+        data = '\x89PNG' + ''.join([chr(i % 256) for i in range(345)])
+        self.datastore.put('http://a/big.png', data)
+        self.failUnlessEqual(self.cache.get('http://a/big.png').data, data)
+        self.failUnlessEqual(len(self.memcache.items), 5)
+        self.failUnlessEqual(self.memcache_store.get('http://a/big.png'), data)
+
+        key = self.memcache_store.key('http://a/big.png')
+        del self.memcache.items['%s:2' % key]
+        self.failUnlessEqual(self.memcache_store.get('http://a/big.png'), None)
+        other = imagecache.ImageCache([self.memcache_store, self.datastore])
+        self.failUnlessEqual(other.get('http://a/big.png').data, data)
+        self.failUnlessEqual(self.datastore.reads, 2)
+
+    def test_etag(self):
+        """
+        Tests that If-None-Match matches the image's own ETag only.
+        """
+        image = imagecache.Image('\xff\xd8\xff\xe0')
+        self.failUnless(image.matches(image.etag))
+        self.failUnless(image.matches('"other", %s' % image.etag))
+        self.failUnless(image.matches('*'))
+        self.failIf(image.matches('"other"'))
+        self.failIf(image.matches(''))
+
+class PageRewriterTest(unittest.TestCase):
+    PAGE = ('<!DOCTYPE html><html><head><link rel="stylesheet" href="/s.css">'
+            '<script src="a.js"></script>'
+            '<script>if (a<b) document.write("<img src=x>&amp;");</script>'
+            '<!-- <a href="/no"> --></head><body><p>AT&T &amp; &#169;'
+            '<img src="http://x/y.png" alt="a&quot;b"/>'
+            '<a href="http://ex.com/p?a=1&amp;b=2">x</a>'
+            '<a title="caf&eacute; &lt;1&gt;" HREF=/c class=x>c</a>'
+            '<form action="go"><input type=text></form><img src=""></body></html>')
+
+    def rewrite(self, chunk_size):
+        out = []
+        resources = rewriter.rewrite_page('http://ex.com', self.PAGE, out.append,
+                                          chunk_size)
+        return (''.join(out), resources)
+
+    def test_rewrite(self):
+        """
+        Tests that sources, links and form actions are rewritten and
+        everything else, other attributes, script bodies and comments
+        too, is passed on as it came.
+        """
+        (page, resources) = self.rewrite(8192)
+        self.failUnlessEqual(page, self.PAGE
+            .replace('href="/s.css"', 'href="?l=http://ex.com/s.css"')
+            .replace('src="a.js"', 'src="image?img=http://ex.com/1a.js"')
+            .replace('src="http://x/y.png"', 'src="image?img=http://x/y.png"')
+            .replace('href="http://ex.com/p', 'href="?l=http://ex.com/p')
+            .replace('HREF=/c', 'HREF="?l=http://ex.com/c"')
+            .replace('action="go"', 'action="?l=http://ex.com/go"'))
+        self.failUnlessEqual(resources, ['http://ex.com/1a.js', 'http://x/y.png'])
+
+    def test_chunks(self):
+        """
+        Tests that the output does not depend on how the page is split
+        when it is fed.
+        """
+        whole = self.rewrite(8192)
+        for chunk_size in (1, 3, 7, 64):
+            self.failUnlessEqual(self.rewrite(chunk_size), whole)
+
+    def test_self_closing(self):
+        """
+        Tests that a self-closing script or style has no body, so the
+        markup after it is still rewritten.
+        """
+        page = ('<script src="a.js"/><style type="text/css"/>'
+                '<a href="/x">x</a><img src="b.png">'
+                '<script>var a = "<a href=/no>";</script>')
+        for chunk_size in (1, 5, 8192):
+            out = []
+            resources = rewriter.rewrite_page('http://ex.com', page, out.append,
+                                              chunk_size)
+            self.failUnlessEqual(''.join(out),
+                '<script src="image?img=http://ex.com/1a.js"/>'
+                '<style type="text/css"/>'
+                '<a href="?l=http://ex.com/x">x</a>'
+                '<img src="image?img=http://ex.com/1b.png">'
+                '<script>var a = "<a href=/no>";</script>')
+            self.failUnlessEqual(resources, ['http://ex.com/1a.js',
+                                             'http://ex.com/1b.png'])
+
+class FindAllTest(unittest.TestCase):
+    PAGE = ('<div><a href="/1">1</a><img src="1.png"><p><a href="/2">2</a>'
+            '<img src="2.png"></p></div><form action="go"></form>')
+
+    def names(self, results):
+        return [(tag.name, tag.get('href') or tag.get('src')) for tag in results]
+
+    def test_groups(self):
+        """
+        Tests that a set of names finds the tags in document order and
+        grouped by name.
+        """
+        soup = BeautifulSoup.BeautifulSoup(self.PAGE)
+        found = soup.findAll(set(['a', 'img', 'script']))
+        self.failUnlessEqual(self.names(found), [('a', '/1'), ('img', '1.png'),
+                                                 ('a', '/2'), ('img', '2.png')])
+        self.failUnlessEqual(self.names(found.groups['a']), [('a', '/1'), ('a', '/2')])
+        self.failUnlessEqual(found.groups['script'], [])
+        self.failUnlessEqual(self.names(soup.p.findAll(['img', 'a'])),
+                             [('a', '/2'), ('img', '2.png')])
+        self.failUnlessEqual(len(soup.findAll('a', href='/2')), 1)
+
+    def test_changes(self):
+        """
+        Tests that the name index follows tags being added, moved and
+        taken out.
+        """
+        soup = BeautifulSoup.BeautifulSoup(self.PAGE)
+        self.failUnlessEqual(len(soup.findAll('img')), 2)
+
+        soup.p.extract()
+        self.failUnlessEqual(self.names(soup.findAll(set(['a', 'img']))),
+                             [('a', '/1'), ('img', '1.png')])
+
+        new = BeautifulSoup.Tag(soup, 'img', [('src', '0.png')])
+        soup.div.insert(0, new)
+        soup.form.append(soup.find('a'))
+        self.failUnlessEqual(self.names(soup.findAll(['img', 'a'])),
+                             [('img', '0.png'), ('img', '1.png'), ('a', '/1')])
+        self.failUnlessEqual(self.names(soup.form.findAll('a')), [('a', '/1')])
+        self.failUnlessEqual(soup.div.findAll('a'), [])
+
+if __name__ == '__main__':
+    unittest.main()
@@ -11,13 +11,30 @@ __date__ = "2008-04-23"
 # this behaviour using the abs() function
 
 import math
+import os
 import sys
+import threading
+import time
 import random   # For picking semi-random numbers
 import types
-from cPickle import dumps, loads
+from cPickle import dumps, Unpickler
+from cStringIO import StringIO
 import base64
+import binascii
+import hashlib
+import hmac
 import zlib
 
+try:
+    import gmpy2
+except ImportError:
+    gmpy2 = None
+
+try:
+    import multiprocessing
+except ImportError:
+    multiprocessing = None
+
 RANDOM_DEV="/dev/urandom"
 has_broken_randint = False
 
@@ -38,10 +55,17 @@ def gcd(p, q):
 
     >>> gcd(42, 6)
     6
+    >>> gcd(6, 42), gcd(-42, 6), gcd(42, 0)
+    (6, 6, 42)
     """
-    if p<q: return gcd(q, p)
-    if q == 0: return p
-    return gcd(q, abs(p%q))
+
+    p = abs(p)
+    q = abs(q)
+
+    while q:
+        (p, q) = (q, p % q)
+
+    return p
 
 def bytes2int(bytes):
     """Converts a list of bytes or a string to an integer
@@ -53,7 +77,12 @@ def bytes2int(bytes):
     8405007
     """
 
-    if not (type(bytes) is types.ListType or type(bytes) is types.StringType):
+    if type(bytes) is types.StringType:
+        if not bytes:
+            return 0
+        return int(binascii.hexlify(bytes), 16)
+
+    if not type(bytes) is types.ListType:
         raise TypeError("You must pass a string or a list")
 
     # Convert byte stream to integer
@@ -70,21 +99,54 @@ def int2bytes(number):
     
     >>> bytes2int(int2bytes(123456789))
     123456789
+    >>> int2bytes(0), int2bytes(65), int2bytes(0x4142)
+    ('', 'A', 'AB')
     """
 
     if not (type(number) is types.LongType or type(number) is types.IntType):
         raise TypeError("You must pass a long or an int")
 
-    string = ""
+    if number <= 0:
+        return ""
 
-    while number > 0:
-        string = "%s%s" % (chr(number & 0xFF), string)
-        number /= 256
-    
-    return string
+    hexed = '%x' % number
+    if len(hexed) & 1:
+        hexed = '0' + hexed
+
+    return binascii.unhexlify(hexed)
+
+def bit_size(number):
+    """Returns the number of bits needed to represent 'number'
 
-def fast_exponentiation(a, p, n):
-    """Calculates r = a^p mod n
+    >>> bit_size(0), bit_size(1), bit_size(255), bit_size(256)
+    (0, 1, 8, 9)
+    """
+
+    if number == 0:
+        return 0
+
+    hexed = '%x' % number
+    return (len(hexed) - 1) * 4 + HEX_DIGIT_BITS[hexed[0]]
+
+def block_size(n):
+    """Returns the number of message bytes that fit in one block when
+    working modulo n
+
+    >>> block_size(3233), block_size(2**1024 - 1)
+    (1, 127)
+    """
+
+    return (bit_size(n) - 1) / 8
+
+HEX_DIGIT_BITS = {'1': 1, '2': 2, '3': 2, '4': 3, '5': 3, '6': 3, '7': 3,
+                  '8': 4, '9': 4, 'a': 4, 'b': 4, 'c': 4, 'd': 4, 'e': 4,
+                  'f': 4}
+
+def bitlist_exponentiation(a, p, n):
+    """Calculates r = a^p mod n one exponent bit at a time
+
+    This is the original pure Python implementation, kept as a
+    reference for the benchmarks.
     """
     result = a % n
     remainders = []
@@ -96,16 +158,133 @@ def fast_exponentiation(a, p, n):
         result = ((a ** rem) * result ** 2) % n
     return result
 
+def window_exponentiation(a, p, n, window=5):
+    """Calculates r = a^p mod n using left-to-right sliding windows of
+    at most 'window' bits over the exponent.
+
+    >>> window_exponentiation(4, 13, 497)
+    445
+    >>> a, p, n = 3**90, 7**120 + 1, 11**75 + 2
+    >>> window_exponentiation(a, p, n) == pow(a, p, n)
+    True
+    """
+
+    if p == 0:
+        return 1 % n
+
+    # Precompute the odd powers a, a^3, a^5, ..., a^(2^window - 1)
+    a = a % n
+    square = (a * a) % n
+    powers = [a]
+    for i in range((1 << (window - 1)) - 1):
+        powers.append((powers[-1] * square) % n)
+
+    result = 1
+    bit = bit_size(p) - 1
+    while bit >= 0:
+        if not (p >> bit) & 1:
+            result = (result * result) % n
+            bit -= 1
+            continue
+
+        # Take the longest run of at most 'window' bits that ends in a 1
+        low = max(bit - window + 1, 0)
+        while not (p >> low) & 1:
+            low += 1
+        width = bit - low + 1
+
+        for i in range(width):
+            result = (result * result) % n
+        result = (result * powers[((p >> low) & ((1 << width) - 1)) >> 1]) % n
+        bit = low - 1
+
+    return result
+
+def pow_exponentiation(a, p, n):
+    """Calculates r = a^p mod n using the builtin three-argument pow()"""
+
+    return pow(a, p, n)
+
+def gmpy_exponentiation(a, p, n):
+    """Calculates r = a^p mod n using gmpy2.powmod()"""
+
+    return long(gmpy2.powmod(a, p, n))
+
+exponentiation_backends = {
+    'bitlist': bitlist_exponentiation,
+    'window': window_exponentiation,
+    'pow': pow_exponentiation,
+}
+
+if gmpy2 is not None:
+    exponentiation_backends['gmpy2'] = gmpy_exponentiation
+
+def use_exponentiation(name):
+    """Makes fast_exponentiation use the backend called 'name'. See
+    exponentiation_backends for the available ones."""
+
+    global fast_exponentiation
+
+    if name not in exponentiation_backends:
+        raise ValueError("Unknown exponentiation backend %r" % name)
+
+    fast_exponentiation = exponentiation_backends[name]
+
+# fast_exponentiation(a, p, n) calculates r = a^p mod n. It is bound to
+# the fastest available backend, unless the RSA_EXPONENTIATION
+# environment variable names another one.
+if gmpy2 is not None:
+    use_exponentiation(os.environ.get('RSA_EXPONENTIATION', 'gmpy2'))
+else:
+    use_exponentiation(os.environ.get('RSA_EXPONENTIATION', 'pow'))
+
+class RandomPool:
+    """Hands out random bytes from a buffer that is refilled from
+    os.urandom() 'size' bytes at a time, instead of opening RANDOM_DEV
+    for every number.
+
+    The buffer is dropped in forked child processes, so they never
+    reuse the parent's bytes.
+    """
+
+    def __init__(self, size=4096):
+        self.size = size
+        self.buffer = ''
+        self.offset = 0
+        self.pid = os.getpid()
+        self.lock = threading.Lock()
+
+    def read(self, nbytes):
+        """Returns a string of 'nbytes' random bytes"""
+
+        self.lock.acquire()
+        try:
+            if not self.pid == os.getpid():
+                self.buffer = ''
+                self.offset = 0
+                self.pid = os.getpid()
+
+            if self.offset + nbytes > len(self.buffer):
+                self.buffer = self.buffer[self.offset:] + \
+                              os.urandom(max(self.size, nbytes))
+                self.offset = 0
+
+            data = self.buffer[self.offset:self.offset+nbytes]
+            self.offset += nbytes
+            return data
+        finally:
+            self.lock.release()
+
+random_pool = RandomPool()
+
 def read_random_int(nbits):
-    """Reads a random integer from RANDOM_DEV of approximately nbits
+    """Reads a random integer from random_pool of approximately nbits
     bits rounded up to whole bytes"""
 
     nbytes = ceil(nbits/8)
 
     # Read 'nbits' bits of random data
-    fd = open(RANDOM_DEV)
-    randomdata = fd.read(nbytes)
-    fd.close()
+    randomdata = random_pool.read(nbytes)
 
     if len(randomdata) != nbytes:
         raise Exception("Unable to read enough random bytes")
@@ -195,6 +374,63 @@ def randomized_primality_testing(n, k):
     
     return True
 
+def small_primes(limit):
+    """Returns a list of the primes below 'limit'
+
+    >>> small_primes(30)
+    [2, 3, 5, 7, 11, 13, 17, 19, 23, 29]
+    """
+
+    sieve = [True] * limit
+    sieve[0:2] = [False, False]
+
+    for number in xrange(2, int(math.sqrt(limit)) + 1):
+        if sieve[number]:
+            sieve[number*number::number] = [False] * len(xrange(number*number, limit, number))
+
+    return [number for number in xrange(limit) if sieve[number]]
+
+# Trial division and sieving of prime candidates use these
+SMALL_PRIMES = small_primes(10000)
+
+# Miller-Rabin with these bases is exact below 3.3 * 10**24, and has a
+# negligible error rate for the random candidates of getprime()
+MILLER_RABIN_BASES = (2, 3, 5, 7, 11, 13, 17, 19, 23, 29, 31, 37, 41)
+
+def miller_rabin(number, bases=MILLER_RABIN_BASES):
+    """Returns False if one of 'bases' proves the odd 'number' composite,
+    and True if it is probably prime.
+
+    >>> miller_rabin(3215031751)
+    False
+    >>> miller_rabin(2**89 - 1)
+    True
+    """
+
+    # Write number - 1 as d * 2**s
+    d = number - 1
+    s = 0
+    while not d & 1:
+        d >>= 1
+        s += 1
+
+    for base in bases:
+        if base % number == 0:
+            continue
+
+        x = fast_exponentiation(base, d, number)
+        if x == 1 or x == number - 1:
+            continue
+
+        for i in xrange(s - 1):
+            x = (x * x) % number
+            if x == number - 1:
+                break
+        else:
+            return False
+
+    return True
+
 def is_prime(number):
     """Returns True if the number is prime, and False otherwise.
 
@@ -202,26 +438,51 @@ def is_prime(number):
     0
     >>> is_prime(41)
     1
+    >>> [n for n in range(50) if is_prime(n)] == small_primes(50)
+    True
     """
 
-    """
-    if not fermat_little_theorem(number) == 1:
-        # Not prime, according to Fermat's little theorem
+    if number < 2:
         return False
+
+    for prime in SMALL_PRIMES:
+        if number % prime == 0:
+            return number == prime
+
+    return miller_rabin(number)
+
+# Number of odd candidates getprime() sieves at a time
+SIEVE_WINDOW = 2048
+
+def sieve_window(start, size):
+    """Returns a list of 'size' flags, one for each odd number start,
+    start + 2, ..., that is True unless the number is divisible by one
+    of the SMALL_PRIMES below it. 'start' must be odd.
+
+    >>> sieve_window(9, 5)
+    [False, True, True, False, True]
     """
 
-    if randomized_primality_testing(number, 5):
-        # Prime, according to Jacobi
-        return True
-    
-    # Not prime
-    return False
+    flags = [True] * size
+
+    for prime in SMALL_PRIMES[1:]:
+        if prime >= start:
+            break
+
+        # First i for which start + 2i is a multiple of prime
+        first = ((prime - start % prime) * ((prime + 1) / 2)) % prime
+        flags[first::prime] = [False] * len(xrange(first, size, prime))
+
+    return flags
 
-    
 def getprime(nbits):
     """Returns a prime number of max. 'math.ceil(nbits/8)*8' bits. In
     other words: nbits is rounded up to whole bytes.
 
+    A random odd starting point is picked, and a window of odd numbers
+    from there is sieved with SMALL_PRIMES. Only the survivors go
+    through Miller-Rabin.
+
     >>> p = getprime(8)
     >>> is_prime(p-1)
     0
@@ -229,22 +490,23 @@ def getprime(nbits):
     1
     >>> is_prime(p+1)
     0
+    >>> bit_size(getprime(512))
+    512
     """
 
-    nbytes = int(math.ceil(nbits/8))
+    limit = 1L << nbits
 
     while True:
-        integer = read_random_int(nbits)
+        # Make sure it's odd and has the top bit set
+        start = read_random_int(nbits) | (1L << (nbits - 1)) | 1
+        size = min(SIEVE_WINDOW, (limit - start + 1) / 2)
 
-        # Make sure it's odd
-        integer |= 1
+        flags = sieve_window(start, size)
+        for i in xrange(size):
+            if flags[i] and miller_rabin(start + 2 * i):
+                return start + 2 * i
 
-        # Test for primeness
-        if is_prime(integer): break
-
-        # Retry if not prime
-
-    return integer
+        # Retry with a new window if none was prime
 
 def are_relatively_prime(a, b):
     """Returns True if a and b are relatively prime, and False if they
@@ -259,8 +521,30 @@ def are_relatively_prime(a, b):
     d = gcd(a, b)
     return (d == 1)
 
-def find_p_q(nbits):
-    """Returns a tuple of two different primes of nbits bits"""
+def find_p_q(nbits, workers=1):
+    """Returns a tuple of two different primes of nbits bits
+
+    With more than one worker, the primes are searched for in a pool of
+    'workers' processes, and the first two different ones are used.
+    Falls back to a single process without the multiprocessing module.
+
+    >>> (p, q) = find_p_q(64, workers=2)
+    >>> p != q and is_prime(p) and is_prime(q)
+    True
+    """
+
+    if workers > 1 and multiprocessing is not None:
+        pool = multiprocessing.Pool(workers)
+        try:
+            primes = []
+            while True:
+                for prime in pool.imap_unordered(getprime, [nbits] * max(workers, 2)):
+                    if prime not in primes:
+                        primes.append(prime)
+                    if len(primes) == 2:
+                        return tuple(primes)
+        finally:
+            pool.terminate()
 
     p = getprime(nbits)
     while True:
@@ -271,68 +555,118 @@ def find_p_q(nbits):
 
 def extended_euclid_gcd(a, b):
     """Returns a tuple (d, i, j) such that d = gcd(a, b) = ia + jb
+
+    >>> extended_euclid_gcd(240, 46)
+    (2, -9, 47)
+    """
+
+    (i, next_i) = (1, 0)
+    (j, next_j) = (0, 1)
+
+    while b:
+        r = a / b
+        (a, b) = (b, a - r*b)
+        (i, next_i) = (next_i, i - r*next_i)
+        (j, next_j) = (next_j, j - r*next_j)
+
+    return (a, i, j)
+
+def modular_inverse(a, n):
+    """Returns the x with 0 <= x < n such that a*x = 1 modulo n
+
+    >>> modular_inverse(17, 3120)
+    2753
+    >>> modular_inverse(6, 9)
+    Traceback (most recent call last):
+    ...
+    ValueError: 6 has no inverse modulo 9
     """
 
-    if b == 0:
-        return (a, 1, 0)
+    (d, i, j) = extended_euclid_gcd(a, n)
 
-    q = abs(a % b)
-    r = long(a / b)
-    (d, k, l) = extended_euclid_gcd(b, q)
+    if not d == 1:
+        raise ValueError("%d has no inverse modulo %d" % (a, n))
+
+    return i % n
 
-    return (d, l, k - l*r)
+# Commonly used fixed public exponent, see gen_pubpriv_keys()
+FIXED_EXPONENT = 65537
 
 # Main function: calculate encryption and decryption keys
-def calculate_keys(p, q, nbits):
+def calculate_keys(p, q, nbits, e=None):
     """Calculates an encryption and a decryption key for p and q, and
-    returns them as a tuple (e, d)"""
+    returns them as a tuple (e, d). A random prime e is searched for
+    unless one is given."""
 
     n = p * q
     phi_n = (p-1) * (q-1)
 
-    while True:
+    while e is None:
         # Make sure e has enough bits so we ensure "wrapping" through
         # modulo n
         e = getprime(max(8, nbits/2))
-        if are_relatively_prime(e, n) and are_relatively_prime(e, phi_n): break
+        if not (are_relatively_prime(e, n) and are_relatively_prime(e, phi_n)):
+            e = None
 
-    (d, i, j) = extended_euclid_gcd(e, phi_n)
-
-    if not d == 1:
+    if not are_relatively_prime(e, phi_n):
         raise Exception("e (%d) and phi_n (%d) are not relatively prime" % (e, phi_n))
 
-    if not (e * i) % phi_n == 1:
-        raise Exception("e (%d) and i (%d) are not mult. inv. modulo phi_n (%d)" % (e, i, phi_n))
+    d = modular_inverse(e, phi_n)
 
-    return (e, i)
+    if not (e * d) % phi_n == 1:
+        raise Exception("e (%d) and d (%d) are not mult. inv. modulo phi_n (%d)" % (e, d, phi_n))
 
+    return (e, d)
 
-def gen_keys(nbits):
+
+def gen_keys(nbits, workers=1, e=None):
     """Generate RSA keys of nbits bits. Returns (p, q, e, d).
     """
 
     while True:
-        (p, q) = find_p_q(nbits)
-        (e, d) = calculate_keys(p, q, nbits)
+        (p, q) = find_p_q(nbits, workers)
 
-        # For some reason, d is sometimes negative. We don't know how
-        # to fix it (yet), so we keep trying until everything is shiny
-        if d > 0: break
+        # A fixed e must be relatively prime to phi_n, or we need new p, q
+        if e is not None and not are_relatively_prime(e, (p-1) * (q-1)):
+            continue
 
-    return (p, q, e, d)
+        (found_e, d) = calculate_keys(p, q, nbits, e)
+        return (p, q, found_e, d)
 
-def gen_pubpriv_keys(nbits):
+def gen_pubpriv_keys(nbits, workers=1, e=None):
     """Generates public and private keys, and returns them as (pub,
     priv).
 
     The public key consists of a dict {e: ..., , n: ....). The private
     key consists of a dict {d: ...., p: ...., q: ....).
+
+    Primes are searched for in 'workers' processes. Pass
+    e=FIXED_EXPONENT to skip the search for a random prime e.
+
+    >>> (pub, priv) = gen_pubpriv_keys(64, workers=2, e=FIXED_EXPONENT)
+    >>> pub['e']
+    65537
+    >>> decrypt(encrypt('gpowered', pub), priv)
+    'gpowered'
     """
     
-    (p, q, e, d) = gen_keys(nbits)
+    (p, q, e, d) = gen_keys(nbits, workers, e)
 
     return ( {'e': e, 'n': p*q}, {'d': d, 'p': p, 'q': q} )
 
+def format_key(key):
+    """Returns the '!'-joined key string of 'key', as stored in RsaKey.
+    The inverse of parse_key().
+
+    >>> format_key({'e': 17, 'n': 3233}), format_key({'d': 2753, 'p': 61, 'q': 53})
+    ('17!3233', '2753!61!53')
+    """
+
+    if 'e' in key:
+        return '%d!%d' % (key['e'], key['n'])
+
+    return '%d!%d!%d' % (key['d'], key['p'], key['q'])
+
 def encrypt_int(message, ekey, n):
     """Encrypts a message using encryption key 'ekey', working modulo
     n"""
@@ -343,7 +677,7 @@ def encrypt_int(message, ekey, n):
     if not type(message) is types.LongType:
         raise TypeError("You must pass a long or an int")
 
-    if math.floor(log(message, 2)) > math.floor(log(n, 2)):
+    if bit_size(message) > bit_size(n):
         raise OverflowError("The message is too long")
 
     return fast_exponentiation(message, ekey, n)
@@ -364,6 +698,49 @@ def verify_int(signed, ekey, n):
 
     return encrypt_int(signed, ekey, n)
 
+# Chinese Remainder Theorem parameters, keyed by (d, p, q)
+crt_keys = {}
+
+def crt_key(key):
+    """Returns the CRT parameters (p, q, dP, dQ, qInv) of the private key
+    'key'. They are calculated once per key and cached in crt_keys.
+
+    >>> crt_key({'d': 2753, 'p': 61, 'q': 53}) == (61, 53, 53, 49, 38)
+    True
+    """
+
+    cache_key = (key['d'], key['p'], key['q'])
+
+    try:
+        return crt_keys[cache_key]
+    except KeyError:
+        pass
+
+    (d, p, q) = cache_key
+    params = (p, q, d % (p-1), d % (q-1), modular_inverse(q, p))
+    crt_keys[cache_key] = params
+    return params
+
+def crt_decrypt_int(cyphertext, params, n):
+    """Decrypts a cypher text using the CRT parameters 'params' as
+    returned by crt_key(), working modulo n = p*q. Gives the same result
+    as decrypt_int() with two half-size exponentiations.
+
+    >>> params = crt_key({'d': 2753, 'p': 61, 'q': 53})
+    >>> [crt_decrypt_int(c, params, 3233) for c in (0, 1, 855, 2790)] == [0, 1, 123, 65]
+    True
+    >>> [c for c in range(1, 3233)
+    ...  if crt_decrypt_int(c, params, 3233) != decrypt_int(c, 2753, 3233)]
+    []
+    """
+
+    (p, q, dp, dq, qinv) = params
+
+    m1 = fast_exponentiation(cyphertext % p, dp, p)
+    m2 = fast_exponentiation(cyphertext % q, dq, q)
+
+    return m2 + ((qinv * (m1 - m2)) % p) * q
+
 def picklechops(chops):
     """Pickles and base64encodes it's argument chops"""
 
@@ -372,9 +749,93 @@ def picklechops(chops):
     return encoded.strip()
 
 def unpicklechops(string):
-    """base64decodes and unpickes it's argument string into chops"""
+    """base64decodes and unpickes it's argument string into chops
+
+    The string may come from anyone, so the pickle may not name a global
+    and has to hold a list of integers.
+
+    >>> unpicklechops(picklechops([1, 258L]))
+    [1, 258L]
+    >>> unpicklechops(base64.encodestring(zlib.compress(
+    ...     "cos\\nsystem\\n(S'echo pwned'\\ntR.")))
+    Traceback (most recent call last):
+    UnpicklingError: Global and instance pickles are not supported.
+    >>> unpicklechops(picklechops({'d': 1}))
+    Traceback (most recent call last):
+    ValueError: Pickled chops are not a list of integers
+    """
 
-    return loads(zlib.decompress(base64.decodestring(string)))
+    unpickler = Unpickler(StringIO(zlib.decompress(base64.decodestring(string))))
+    unpickler.find_global = None
+    chops = unpickler.load()
+
+    if type(chops) is not types.ListType:
+        raise ValueError("Pickled chops are not a list of integers")
+    for chop in chops:
+        if type(chop) not in (types.IntType, types.LongType):
+            raise ValueError("Pickled chops are not a list of integers")
+    return chops
+
+# Version byte of the packchops() format
+CHOPS_VERSION = 1
+
+def packchops(chops, n):
+    """Packs chops working modulo n into a URL-safe string: a version
+    byte, the block width as two bytes, then every chop as a fixed-width
+    big-endian block, all base64 encoded without padding.
+
+    >>> packchops([1, 258], 3233)
+    'AQACAAEBAg'
+    >>> list(iter_unpackchops('AQACAAEBAg'))
+    [1, 258]
+    """
+
+    width = (bit_size(n) + 7) / 8
+    hexed = ['%02x%04x' % (CHOPS_VERSION, width)]
+
+    for chop in chops:
+        hexed.append('%0*x' % (width * 2, chop))
+
+    encoded = base64.urlsafe_b64encode(binascii.unhexlify(''.join(hexed)))
+    return encoded.rstrip('=')
+
+def iter_unpackchops(string):
+    """Yields the chops packed in 'string' by packchops(). Strings
+    pickled by picklechops() are accepted too.
+
+    >>> list(iter_unpackchops(picklechops([1, 258])))
+    [1, 258]
+    """
+
+    string = str(string)
+    version = chops_version(string)
+
+    if version == 0:
+        for chop in unpicklechops(string):
+            yield chop
+        return
+
+    if not version == CHOPS_VERSION:
+        raise ValueError("Unknown chops version %d" % version)
+
+    raw = base64.urlsafe_b64decode(string + '=' * (-len(string) % 4))
+
+    width = bytes2int(raw[1:3])
+
+    # buffer() slices the blocks without copying them
+    for offset in xrange(3, len(raw), width):
+        yield int(binascii.hexlify(buffer(raw, offset, width)), 16)
+
+def iter_chopstring(message, key, n, funcref):
+    """Splits 'message' into chops that are at most as long as n,
+    converts these into integers, and yields funcref(integer, key, n)
+    for each chop.
+    """
+
+    nbytes = block_size(n)
+
+    for offset in xrange(0, len(message), nbytes):
+        yield funcref(bytes2int(message[offset:offset+nbytes]), key, n)
 
 def chopstring(message, key, n, funcref):
     """Splits 'message' into chops that are at most as long as n,
@@ -384,24 +845,19 @@ def chopstring(message, key, n, funcref):
     Used by 'encrypt' and 'sign'.
     """
 
-    msglen = len(message)
-    mbits = msglen * 8
-    nbits = int(math.floor(log(n, 2)))
-    nbytes = nbits / 8
-    blocks = msglen / nbytes
+    return packchops(iter_chopstring(message, key, n, funcref), n)
 
-    if msglen % nbytes > 0:
-        blocks += 1
+def iter_gluechops(chops, key, n, funcref):
+    """Calls funcref(integer, key, n) for each chop and yields the
+    results as strings. 'chops' is either a string as returned by
+    chopstring() or picklechops(), or the chops themselves.
+    """
 
-    cypher = []
-    
-    for bindex in range(blocks):
-        offset = bindex * nbytes
-        block = message[offset:offset+nbytes]
-        value = bytes2int(block)
-        cypher.append(funcref(value, key, n))
+    if type(chops) in types.StringTypes:
+        chops = iter_unpackchops(chops)
 
-    return picklechops(cypher)
+    for cpart in chops:
+        yield int2bytes(funcref(cpart, key, n))
 
 def gluechops(chops, key, n, funcref):
     """Glues chops back together into a string.  calls
@@ -409,36 +865,337 @@ def gluechops(chops, key, n, funcref):
 
     Used by 'decrypt' and 'verify'.
     """
-    message = ""
 
-    chops = unpicklechops(chops)
-    
-    for cpart in chops:
-        mpart = funcref(cpart, key, n)
-        message += int2bytes(mpart)
-    
-    return message
+    return "".join(iter_gluechops(chops, key, n, funcref))
+
+def private_exponentiation(key):
+    """Returns (dkey, n, funcref) to exponentiate with the private key
+    'key'. Uses the Chinese Remainder Theorem whenever the key carries p
+    and q.
+    """
+
+    if 'p' in key and 'q' in key:
+        return (crt_key(key), key['p']*key['q'], crt_decrypt_int)
+
+    return (key['d'], key['n'], decrypt_int)
+
+# Version byte of the seal_envelope() format
+ENVELOPE_VERSION = 2
+
+# Number of bytes iter_open_envelope() yields at a time
+ENVELOPE_CHUNK = 65536
+
+def chops_version(string):
+    """Returns the format of an encrypted string: 0 for picklechops(),
+    CHOPS_VERSION for packchops() and ENVELOPE_VERSION for
+    seal_envelope()
+
+    >>> chops_version(packchops([1, 258], 3233))
+    1
+    """
+
+    string = str(string)
+
+    # zlib streams start with 0x78, which base64 encodes to 'e'
+    if string.startswith('e'):
+        return 0
+
+    return ord(base64.urlsafe_b64decode(string[:4])[0])
+
+def keystream(key, offset, length):
+    """Returns 'length' bytes of SHA-256 counter mode keystream for the
+    symmetric key 'key', starting at 'offset' (a multiple of 32)"""
+
+    blocks = []
+    for counter in xrange(offset / 32, (offset + length + 31) / 32):
+        blocks.append(hashlib.sha256('%s%016x' % (key, counter)).digest())
+
+    return ''.join(blocks)[:length]
+
+def xor_bytes(data, stream):
+    """XORs two strings of the same length. Both are converted into one
+    integer each, so the XOR runs in a single operation instead of one
+    per byte.
+
+    >>> xor_bytes(xor_bytes('gpowered', 'abcdefgh'), 'abcdefgh')
+    'gpowered'
+    """
+
+    if not data:
+        return ''
+
+    mixed = int(binascii.hexlify(data), 16) ^ int(binascii.hexlify(stream), 16)
+    return binascii.unhexlify('%0*x' % (len(data) * 2, mixed))
+
+def envelope_keys(seed):
+    """Derives the (cipher key, MAC key) pair of an envelope from the
+    integer 'seed'"""
+
+    hexed = '%x' % seed
+    return (hashlib.sha256('cipher' + hexed).digest(),
+            hashlib.sha256('mac' + hexed).digest())
+
+def seal_envelope(message, key):
+    """Encrypts a string 'message' for the public key 'key' with a single
+    RSA operation. A random seed is encrypted with RSA, and the message
+    with a keystream derived from the seed.
+
+    The result is URL-safe base64 without padding of: the version byte,
+    the block width as two bytes, the encrypted seed as one fixed-width
+    block, the HMAC-SHA256 of the body, and the body.
+
+    >>> (pub, priv) = gen_pubpriv_keys(64)
+    >>> cypher = seal_envelope('gpowered' * 10, pub)
+    >>> chops_version(cypher) == ENVELOPE_VERSION
+    True
+    >>> ''.join(iter_open_envelope(cypher, priv)) == 'gpowered' * 10
+    True
+    """
+
+    n = key['n']
+    width = (bit_size(n) + 7) / 8
+
+    seed = bytes2int(random_pool.read(block_size(n)))
+    (cipher_key, mac_key) = envelope_keys(seed)
+
+    body = xor_bytes(message, keystream(cipher_key, 0, len(message)))
+    header = '%02x%04x%0*x' % (ENVELOPE_VERSION, width, width * 2,
+                               encrypt_int(seed, key['e'], n))
+
+    raw = ''.join([binascii.unhexlify(header),
+                   hmac.new(mac_key, body, hashlib.sha256).digest(),
+                   body])
+    return base64.urlsafe_b64encode(raw).rstrip('=')
+
+def iter_open_envelope(cypher, key):
+    """Decrypts a cypher made by seal_envelope() with the private key
+    'key', yielding the message ENVELOPE_CHUNK bytes at a time. Raises
+    ValueError when the body does not match its MAC.
+    """
+
+    cypher = str(cypher)
+    raw = base64.urlsafe_b64decode(cypher + '=' * (-len(cypher) % 4))
+
+    width = bytes2int(raw[1:3])
+    start = 3 + width + 32
+
+    (dkey, n, funcref) = private_exponentiation(key)
+    seed = funcref(bytes2int(raw[3:3+width]), dkey, n)
+    (cipher_key, mac_key) = envelope_keys(seed)
+
+    body = raw[start:]
+    if not hmac.new(mac_key, body, hashlib.sha256).digest() == raw[start-32:start]:
+        raise ValueError("The envelope does not match its MAC")
+
+    for offset in xrange(0, len(body), ENVELOPE_CHUNK):
+        chunk = body[offset:offset+ENVELOPE_CHUNK]
+        yield xor_bytes(chunk, keystream(cipher_key, offset, len(chunk)))
 
 def encrypt(message, key):
-    """Encrypts a string 'message' with the public key 'key'"""
-    
+    """Encrypts a string 'message' with the public key 'key'
+
+    Messages that do not fit in a single block are sealed in an envelope,
+    so they cost one RSA operation whatever their length.
+
+    >>> (pub, priv) = gen_pubpriv_keys(64)
+    >>> chops_version(encrypt('gp', pub)) == CHOPS_VERSION
+    True
+    >>> cypher = encrypt('twitter2gTalk' * 100, pub)
+    >>> chops_version(cypher) == ENVELOPE_VERSION
+    True
+    >>> decrypt(cypher, priv) == 'twitter2gTalk' * 100
+    True
+    >>> decrypt(cypher[:-4] + 'AAAA', priv)
+    Traceback (most recent call last):
+    ...
+    ValueError: The envelope does not match its MAC
+    """
+
+    if len(message) > block_size(key['n']):
+        return seal_envelope(message, key)
+
     return chopstring(message, key['e'], key['n'], encrypt_int)
 
+def encrypt_many(messages, key, workers=1):
+    """Encrypts every string in 'messages' with the public key 'key' and
+    returns the results in the same order, as encrypt() would.
+
+    The block size is worked out once for the whole batch. With more than
+    one worker, the batch is split over a pool of 'workers' processes.
+
+    >>> (pub, priv) = gen_pubpriv_keys(64)
+    >>> messages = ['gp', '', 'twitter2gTalk' * 10]
+    >>> [decrypt(cypher, priv) for cypher in encrypt_many(messages, pub)] == messages
+    True
+    >>> [decrypt(cypher, priv) for cypher in encrypt_many(messages * 10, pub, workers=2)] == messages * 10
+    True
+    """
+
+    if workers > 1 and multiprocessing is not None and len(messages) > workers:
+        size = (len(messages) + workers - 1) / workers
+        batches = [(messages[start:start+size], key)
+                   for start in xrange(0, len(messages), size)]
+
+        pool = multiprocessing.Pool(workers)
+        try:
+            results = []
+            for cyphers in pool.map(encrypt_batch, batches):
+                results.extend(cyphers)
+            return results
+        finally:
+            pool.terminate()
+
+    e = key['e']
+    n = key['n']
+    nbytes = block_size(n)
+
+    results = []
+    for message in messages:
+        if len(message) > nbytes:
+            results.append(seal_envelope(message, key))
+        elif message:
+            results.append(packchops([fast_exponentiation(bytes2int(message), e, n)], n))
+        else:
+            results.append(packchops([], n))
+
+    return results
+
+def encrypt_batch(batch):
+    """Pool worker for encrypt_many(), 'batch' is (messages, key)"""
+
+    (messages, key) = batch
+    return encrypt_many(messages, key)
+
+def iter_encrypt(message, key):
+    """Encrypts a string 'message' with the public key 'key', yielding
+    the encrypted chops one by one
+
+    >>> (pub, priv) = gen_pubpriv_keys(64)
+    >>> chops = iter_encrypt('gpowered' * 10, pub)
+    >>> ''.join(iter_decrypt(chops, priv)) == 'gpowered' * 10
+    True
+    """
+
+    return iter_chopstring(message, key['e'], key['n'], encrypt_int)
+
 def sign(message, key):
     """Signs a string 'message' with the private key 'key'"""
-    
-    return chopstring(message, key['d'], key['p']*key['q'], decrypt_int)
+
+    (dkey, n, funcref) = private_exponentiation(key)
+    return chopstring(message, dkey, n, funcref)
 
 def decrypt(cypher, key):
-    """Decrypts a cypher with the private key 'key'"""
+    """Decrypts a cypher with the private key 'key'
+
+    The result is the same with and without the CRT parameters:
+
+    >>> (pub, priv) = gen_pubpriv_keys(64)
+    >>> cypher = encrypt('twitter2gTalk', pub)
+    >>> decrypt(cypher, priv)
+    'twitter2gTalk'
+    >>> n = priv['p'] * priv['q']
+    >>> decrypt(cypher, {'d': priv['d'], 'n': n})
+    'twitter2gTalk'
+    >>> verify(sign('gpowered', priv), pub)
+    'gpowered'
+    """
+
+    if type(cypher) in types.StringTypes and \
+       chops_version(cypher) == ENVELOPE_VERSION:
+        return ''.join(iter_open_envelope(cypher, key))
+
+    (dkey, n, funcref) = private_exponentiation(key)
+    return gluechops(cypher, dkey, n, funcref)
+
+def iter_decrypt(cypher, key):
+    """Decrypts a cypher, or the chops yielded by iter_encrypt(), with
+    the private key 'key', yielding the message block by block"""
 
-    return gluechops(cypher, key['d'], key['p']*key['q'], decrypt_int)
+    if type(cypher) in types.StringTypes and \
+       chops_version(cypher) == ENVELOPE_VERSION:
+        return iter_open_envelope(cypher, key)
+
+    (dkey, n, funcref) = private_exponentiation(key)
+    return iter_gluechops(cypher, dkey, n, funcref)
 
 def verify(cypher, key):
     """Verifies a cypher with the public key 'key'"""
 
     return gluechops(cypher, key['e'], key['n'], encrypt_int)
 
+def parse_key(keystring):
+    """Parses a '!'-joined key string, as stored in RsaKey, into a key
+    dict. Public keys are stored as 'e!n', private keys as 'd!p!q'.
+    Private keys also get n, and their CRT parameters are calculated
+    right away.
+
+    >>> parse_key('17!3233') == {'e': 17, 'n': 3233}
+    True
+    >>> parse_key('2753!61!53') == {'d': 2753, 'p': 61, 'q': 53, 'n': 3233}
+    True
+    """
+
+    parts = [long(part) for part in keystring.split('!')]
+
+    if len(parts) == 2:
+        return {'e': parts[0], 'n': parts[1]}
+
+    if len(parts) == 3:
+        key = {'d': parts[0], 'p': parts[1], 'q': parts[2],
+               'n': parts[1] * parts[2]}
+        crt_key(key)
+        return key
+
+    raise ValueError("Not a public or private key string")
+
+class KeyRegistry:
+    """Keeps named keys parsed, so they are loaded once per process.
+
+    'loader' is called with a key name and returns the key string stored
+    under that name. Keys are reloaded after 'ttl' seconds, or never if
+    ttl is None; call invalidate() when a stored key changes.
+
+    >>> loads = []
+    >>> def loader(name):
+    ...     loads.append(name)
+    ...     return '17!3233'
+    >>> keys = KeyRegistry(loader)
+    >>> keys.get('gp_pub') is keys.get('gp_pub')
+    True
+    >>> keys.invalidate('gp_pub')
+    >>> keys.get('gp_pub') == {'e': 17, 'n': 3233}
+    True
+    >>> loads
+    ['gp_pub', 'gp_pub']
+    """
+
+    def __init__(self, loader, ttl=None):
+        self.loader = loader
+        self.ttl = ttl
+        self.keys = {}
+
+    def get(self, name):
+        """Returns the parsed key called 'name'"""
+
+        try:
+            (key, loaded) = self.keys[name]
+            if self.ttl is None or time.time() - loaded < self.ttl:
+                return key
+        except KeyError:
+            pass
+
+        key = parse_key(self.loader(name))
+        self.keys[name] = (key, time.time())
+        return key
+
+    def invalidate(self, name=None):
+        """Forgets the key called 'name', or all keys if name is None"""
+
+        if name is None:
+            self.keys.clear()
+        else:
+            self.keys.pop(name, None)
+
 def makePubKey(k):
     temp = k.split('!')
     pubkey = {'e': long(temp[0]), 'n': long(temp[1])}
@@ -0,0 +1,4 @@
+from proxy.models import Job
+from django.contrib import admin
+
+admin.site.register(Job)
@@ -0,0 +1,178 @@
+"""Runs each xmppproxy request once per user and hour
+
+GAE retries a task that was slow to answer, and TaskLoader may queue a
+user again within the hour. A request is identified by a digest of the
+decrypted login, Twitter account and hour, so a duplicate waits for the
+request already running or gets the result of the one that finished,
+instead of fetching Twitter and logging in to gTalk again.
+"""
+
+import datetime
+import hashlib
+import os
+import tempfile
+import threading
+import time
+from cPickle import dumps, loads, UnpicklingError
+
+def request_digest(login, twitter, now=None):
+    """Returns the key of a request for 'login' and 'twitter' this hour"""
+
+    if now is None:
+        now = datetime.datetime.utcnow()
+    request = '%s\0%s\0%s' % (login, twitter, now.strftime('%Y%m%d%H'))
+    return hashlib.sha1(request).hexdigest()
+
+class ResultCache:
+    """Results by digest for 'ttl' seconds, kept in memory and, if
+    'directory' is given, in one file per digest there as well so other
+    processes and restarts see them. put() purges the expired results
+    once every 'ttl' seconds."""
+
+    def __init__(self, ttl=3600, directory=None):
+        self.ttl = ttl
+        self.directory = directory
+        self.results = {}
+        self.lock = threading.Lock()
+        self.clock = time.time
+        #when put() last purged, never yet so results left by the last
+        #process are purged too
+        self.purged = None
+
+    def path(self, digest):
+        return os.path.join(self.directory, digest)
+
+    def get(self, digest):
+        """Returns (True, result) for a cached digest, (False, None)
+        otherwise"""
+
+        now = self.clock()
+        self.lock.acquire()
+        try:
+            entry = self.results.get(digest)
+            if entry is not None and entry[0] <= now:
+                del self.results[digest]
+                entry = None
+        finally:
+            self.lock.release()
+        if entry is not None:
+            return (True, entry[1])
+
+        if self.directory is None:
+            return (False, None)
+        try:
+            file = open(self.path(digest), 'rb')
+            try:
+                (expires, result) = loads(file.read())
+            finally:
+                file.close()
+        except (IOError, EOFError, ValueError, UnpicklingError):
+            return (False, None)
+        if expires <= now:
+            self.remove(digest)
+            return (False, None)
+        return (True, result)
+
+    def put(self, digest, result):
+        now = self.clock()
+        expires = now + self.ttl
+        self.lock.acquire()
+        try:
+            self.results[digest] = (expires, result)
+            purge = self.purged is None or now - self.purged >= self.ttl
+            if purge:
+                self.purged = now
+        finally:
+            self.lock.release()
+        if purge:
+            self.purge()
+
+        if self.directory is not None:
+            (fd, temp) = tempfile.mkstemp(dir=self.directory)
+            os.write(fd, dumps((expires, result)))
+            os.close(fd)
+            os.rename(temp, self.path(digest))
+
+    def remove(self, digest):
+        try:
+            os.remove(self.path(digest))
+        except OSError:
+            pass
+
+    def purge(self):
+        """Forgets every expired result"""
+
+        now = self.clock()
+        self.lock.acquire()
+        try:
+            for digest, entry in self.results.items():
+                if entry[0] <= now:
+                    del self.results[digest]
+        finally:
+            self.lock.release()
+        if self.directory is not None:
+            try:
+                digests = os.listdir(self.directory)
+            except OSError:
+                return
+            for digest in digests:
+                self.get(digest)
+
+class Call:
+    """A request running in this process, for duplicates to wait on"""
+
+    def __init__(self):
+        self.finished = threading.Event()
+        self.result = None
+        self.error = None
+
+class Idempotent:
+    """Runs func once per digest while its result is in 'cache'"""
+
+    def __init__(self, cache):
+        self.cache = cache
+        self.running = {}
+        self.lock = threading.Lock()
+        self.suppressed = 0
+
+    def call(self, digest, func, *args):
+        """Returns func(*args), or the result of the call with the same
+        digest that is running or has finished. Failed calls are not
+        kept."""
+
+        owner = False
+        self.lock.acquire()
+        try:
+            (found, result) = self.cache.get(digest)
+            running = self.running.get(digest)
+            if found or running is not None:
+                self.suppressed += 1
+            else:
+                running = self.running[digest] = Call()
+                owner = True
+        finally:
+            self.lock.release()
+
+        if found:
+            return result
+        if not owner:
+            running.finished.wait()
+            if running.error is not None:
+                raise running.error
+            return running.result
+
+        try:
+            try:
+                running.result = func(*args)
+                self.cache.put(digest, running.result)
+            except Exception, e:
+                running.error = e
+                raise
+        finally:
+            self.lock.acquire()
+            try:
+                del self.running[digest]
+            finally:
+                self.lock.release()
+            running.finished.set()
+        return running.result
@@ -0,0 +1,230 @@
+"""Background work queue for the xmppproxy
+
+start() stores each request as a Job and returns right away. Worker
+threads in the same process claim queued jobs and run them, retrying
+failures later with a growing delay. Jobs are keyed on the digest of the
+encrypted key, so a request sent again while it waits or runs is only
+run once. Finished jobs are deleted once they are KEEP old. A job given
+up on after MAX_ATTEMPTS is passed to the 'failed' callback.
+"""
+
+import datetime
+import hashlib
+import logging
+import os
+import threading
+import traceback
+
+from django.db import connection, reset_queries
+from proxy.models import Job
+
+WORKERS = 4
+MAX_ATTEMPTS = 5
+#seconds an idle worker waits before looking for due jobs again
+POLL = 5
+#a job running this long was lost with its process
+STALE = datetime.timedelta(minutes=10)
+#done and failed jobs are kept this long, for the status page
+KEEP = datetime.timedelta(days=1)
+#how often an idle worker deletes the finished jobs past KEEP
+PURGE_EVERY = datetime.timedelta(minutes=10)
+
+COUNTERS = ('enqueued', 'duplicates', 'done', 'retried', 'failed', 'purged')
+
+def job_digest(key):
+    return hashlib.sha1(key).hexdigest()
+
+def retry_delay(attempts):
+    """Delay before retrying a job that failed 'attempts' times"""
+
+    return datetime.timedelta(minutes=2 ** (attempts - 1))
+
+class JobQueue:
+    """Runs run(key) for queued jobs on 'workers' threads, and failed(job)
+    for the jobs that failed 'max_attempts' times"""
+
+    def __init__(self, run, workers=WORKERS, max_attempts=MAX_ATTEMPTS,
+                 poll=POLL, keep=KEEP, failed=None):
+        self.run = run
+        self.failed = failed
+        self.workers = workers
+        self.max_attempts = max_attempts
+        self.poll = poll
+        self.keep = keep
+        self.purged = None
+        self.threads = []
+        self.ready = threading.Condition()
+        self.lock = threading.Lock()
+        self.counts = dict([(name, 0) for name in COUNTERS])
+
+    def count(self, name):
+        self.lock.acquire()
+        try:
+            self.counts[name] += 1
+        finally:
+            self.lock.release()
+
+    def enqueue(self, key, account=''):
+        """Queues 'key' for 'account' unless it already waits or runs.
+        Returns the Job."""
+
+        (job, created) = Job.objects.get_or_create(digest=job_digest(key),
+                                                   defaults={'key': key,
+                                                             'account': account})
+        if not created:
+            if job.state in (Job.QUEUED, Job.RUNNING):
+                self.count('duplicates')
+                return job
+            job.account = account
+            job.state = Job.QUEUED
+            job.attempts = 0
+            job.run_after = datetime.datetime.now()
+            job.owner = ''
+            job.error = ''
+            job.save()
+        self.count('enqueued')
+
+        self.start()
+        self.ready.acquire()
+        try:
+            self.ready.notify()
+        finally:
+            self.ready.release()
+        return job
+
+    def claim(self, owner):
+        """Marks the next due job as run by 'owner' and returns it, or
+        None if no job is due"""
+
+        now = datetime.datetime.now()
+        Job.objects.filter(state=Job.RUNNING,
+                           updated__lt=now - STALE).update(state=Job.QUEUED)
+        due = Job.objects.filter(state=Job.QUEUED,
+                                 run_after__lte=now).order_by('run_after')
+        for job in due[:self.workers + 1]:
+            Job.objects.filter(pk=job.pk, state=Job.QUEUED).update(
+                state=Job.RUNNING, owner=owner, updated=now)
+            job = Job.objects.get(pk=job.pk)
+            if job.state == Job.RUNNING and job.owner == owner:
+                return job
+        return None
+
+    def finish(self, job, error=None):
+        job.attempts += 1
+        if error is None:
+            job.state = Job.DONE
+            self.count('done')
+        elif job.attempts < self.max_attempts:
+            job.state = Job.QUEUED
+            job.run_after = datetime.datetime.now() + retry_delay(job.attempts)
+            job.error = error
+            self.count('retried')
+        else:
+            job.state = Job.FAILED
+            job.error = error
+            self.count('failed')
+        job.save()
+
+        if job.state == Job.FAILED and self.failed is not None:
+            try:
+                self.failed(job)
+            except Exception:
+                logging.exception('xmppproxy failed job %s' % job.digest)
+
+    def purge(self, now=None):
+        """Deletes the done and failed jobs last updated over 'keep' ago.
+        Returns how many there were."""
+
+        if now is None:
+            now = datetime.datetime.now()
+        old = Job.objects.filter(state__in=(Job.DONE, Job.FAILED),
+                                 updated__lt=now - self.keep)
+        purged = old.count()
+        if purged:
+            old.delete()
+            self.lock.acquire()
+            try:
+                self.counts['purged'] += purged
+            finally:
+                self.lock.release()
+        return purged
+
+    def purge_due(self):
+        """Purges if no worker did for PURGE_EVERY"""
+
+        now = datetime.datetime.now()
+        self.lock.acquire()
+        try:
+            if self.purged is not None and now - self.purged < PURGE_EVERY:
+                return
+            self.purged = now
+        finally:
+            self.lock.release()
+        self.purge(now)
+
+    def work_once(self, owner):
+        """Runs the next due job, if any, and returns it"""
+
+        job = self.claim(owner)
+        if job is None:
+            return None
+        try:
+            self.run(job.key)
+        except Exception:
+            self.finish(job, traceback.format_exc())
+        else:
+            self.finish(job)
+        return job
+
+    def work(self):
+        owner = '%d-%s' % (os.getpid(), threading.currentThread().getName())
+        while True:
+            try:
+                job = self.work_once(owner)
+                if job is None:
+                    self.purge_due()
+            except Exception:
+                logging.exception('xmppproxy queue')
+                job = None
+            reset_queries()
+            if job is None:
+                #don't hold a connection, or an old snapshot, while idle
+                connection.close()
+                self.ready.acquire()
+                try:
+                    self.ready.wait(self.poll)
+                finally:
+                    self.ready.release()
+
+    def start(self):
+        """Starts the worker threads, once"""
+
+        self.lock.acquire()
+        try:
+            while len(self.threads) < self.workers:
+                thread = threading.Thread(target=self.work)
+                thread.setDaemon(True)
+                thread.start()
+                self.threads.append(thread)
+        finally:
+            self.lock.release()
+
+    def stats(self):
+        """Returns queue depth by state, the age of the oldest queued job
+        and the counters of this process"""
+
+        stats = [(state, Job.objects.filter(state=state).count())
+                 for state in (Job.QUEUED, Job.RUNNING, Job.DONE, Job.FAILED)]
+        oldest = Job.objects.filter(state=Job.QUEUED).order_by('created')[:1]
+        if oldest:
+            age = datetime.datetime.now() - oldest[0].created
+            stats.append(('oldest', age.days * 86400 + age.seconds))
+        else:
+            stats.append(('oldest', 0))
+        stats.append(('workers', len(self.threads)))
+        self.lock.acquire()
+        try:
+            stats.extend([(name, self.counts[name]) for name in COUNTERS])
+        finally:
+            self.lock.release()
+        return stats
@@ -1,3 +1,26 @@
 from django.db import models
+import datetime
 
-# Create your models here.
+class Job(models.Model):
+    """An xmppproxy request waiting for, or done by, the queue workers"""
+
+    QUEUED = 'queued'
+    RUNNING = 'running'
+    DONE = 'done'
+    FAILED = 'failed'
+
+    #sha1 of the encrypted key, the same request is queued once
+    digest = models.CharField(max_length=40, unique=True)
+    key = models.TextField()
+    #key of the twitter2gTalk Account to tell if the job is given up on
+    account = models.CharField(max_length=500, blank=True)
+    state = models.CharField(max_length=8, default=QUEUED, db_index=True)
+    attempts = models.IntegerField(default=0)
+    run_after = models.DateTimeField(default=datetime.datetime.now, db_index=True)
+    owner = models.CharField(max_length=64, blank=True)
+    error = models.TextField(blank=True)
+    created = models.DateTimeField(auto_now_add=True)
+    updated = models.DateTimeField(auto_now=True)
+
+    def __unicode__(self):
+        return '%s %s' % (self.digest, self.state)
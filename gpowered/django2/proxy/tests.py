@@ -5,7 +5,34 @@ unittest). These will both pass when you run "manage.py test".
 Replace these with more appropriate tests for your application.
 """
 
+import base64
+import datetime
+import logging
+import os
+import re
+import shutil
+import socket
+import sys
+import tempfile
+import time
+import BaseHTTPServer
+import SocketServer
+import threading
+import unittest
+
+from django.conf import settings
 from django.test import TestCase
+from django.test.client import Client
+
+import sharedstatus
+import timeline
+import userlog
+from proxy import idempotency
+from proxy import jobs
+
+#no worker threads in proxy.views either, they would not see the test database
+settings.XMPPPROXY_WORKERS = 0
+from proxy.models import Job
 
 class SimpleTest(TestCase):
     def test_basic_addition(self):
@@ -14,6 +41,683 @@ class SimpleTest(TestCase):
         """
         self.failUnlessEqual(1 + 1, 2)
 
+class FakeTwitter(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    """Local stand-in for the timeline API, counting the connections made"""
+
+    daemon_threads = True
+
+    def __init__(self):
+        BaseHTTPServer.HTTPServer.__init__(self, ('127.0.0.1', 0), FakeTimeline)
+        self.tweets = {}
+        self.limited = 0
+        self.connections = 0
+        self.requests = []
+
+    def host(self):
+        return '127.0.0.1:%d' % self.server_address[1]
+
+class FakeTimeline(BaseHTTPServer.BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def setup(self):
+        BaseHTTPServer.BaseHTTPRequestHandler.setup(self)
+        self.server.connections += 1
+
+    def do_GET(self):
+        self.server.requests.append(self.path)
+        if self.server.limited:
+            self.server.limited -= 1
+            self.reply(420, 'rate limited', {'Retry-After': '1'})
+            return
+
+        (path, query) = self.path.split('?')
+        name = path.split('/')[-1][:-len('.json')]
+        since_id = 0
+        if 'since_id=' in query:
+            since_id = int(query.split('since_id=')[1])
+        if name not in self.server.tweets:
+            self.reply(404, 'Not found')
+            return
+
+        tweets = [(id, text) for id, text in self.server.tweets[name]
+                  if id > since_id]
+        self.reply(200, ''.join(['[{"id": %d, "text": "%s"}]' % tweet
+                                 for tweet in tweets[-1:]]) or '[]')
+
+    def reply(self, status, body, headers={}):
+        self.send_response(status)
+        self.send_header('Content-Length', str(len(body)))
+        for name, value in headers.items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+class TimelineTest(unittest.TestCase):
+    def setUp(self):
+        self.server = FakeTwitter()
+        self.server.tweets = {'one': [(1, 'first'), (2, 'second')],
+                              'two': [(3, 'third')],
+                              'quiet': []}
+        self.thread = threading.Thread(target=self.server.serve_forever)
+        self.thread.setDaemon(True)
+        self.thread.start()
+
+        self.slept = []
+        self.client = timeline.TimelineClient(self.server.host(),
+                                              timeline.HTTPTransport(limit=2))
+        self.client.sleep = self.slept.append
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def test_latest(self):
+        """
+        Tests the latest tweet, since_id and unknown users.
+        """
+        self.failUnlessEqual(self.client.latest('one'), (2, u'second'))
+        self.failUnlessEqual(self.client.latest('one', since_id=2), None)
+        self.failUnlessEqual(self.client.latest('quiet'), None)
+        self.failUnlessEqual(self.client.latest('nobody'), None)
+
+    def test_keep_alive(self):
+        """
+        Tests that one connection serves every request made one at a time.
+        """
+        for i in range(5):
+            self.client.latest('two')
+        self.failUnlessEqual(self.server.connections, 1)
+
+    def test_latest_many(self):
+        """
+        Tests a batch of names over at most 'limit' connections.
+        """
+        names = ['one', 'two', 'quiet', 'nobody'] * 5
+        tweets = self.client.latest_many(names, {'two': 3})
+        self.failUnlessEqual(tweets, {'one': (2, u'second'), 'two': None,
+                                      'quiet': None, 'nobody': None})
+        self.failUnlessEqual(len(self.server.requests), 20)
+        self.failUnless(self.server.connections <= 2)
+
+    def test_rate_limit(self):
+        """
+        Tests that rate-limited requests are retried after Retry-After,
+        and given up on after 'retries' attempts.
+        """
+        self.server.limited = 1
+        self.failUnlessEqual(self.client.latest('one'), (2, u'second'))
+        self.failUnlessEqual(len(self.slept), 1)
+        self.failUnless(0 < self.slept[0] <= 1)
+
+        self.client.reset = 0
+        self.server.limited = 3
+        self.failUnlessRaises(timeline.RateLimitError, self.client.latest, 'one')
+
+    def test_long_rate_limit(self):
+        """
+        Tests that a batch rate limited for longer than max_wait leaves the
+        names out instead of raising.
+        """
+        self.client.reset = time.time() + 3600
+        self.failUnlessEqual(self.client.latest_many(['one', 'two']), {})
+        results = self.client.fetch_many(['/a', '/b'])
+        self.failUnless(isinstance(results[0], timeline.RateLimitError))
+        self.failUnless(isinstance(results[1], timeline.RateLimitError))
+        self.failUnlessEqual(self.server.requests, [])
+        self.failUnlessRaises(timeline.RateLimitError, self.client.latest, 'one')
+
+    def test_unreachable(self):
+        """
+        Tests that a Twitter that does not answer is a TimelineError.
+        """
+        closed = socket.socket()
+        closed.bind(('127.0.0.1', 0))
+        host = '127.0.0.1:%d' % closed.getsockname()[1]
+        closed.close()
+        client = timeline.TimelineClient(host, timeline.HTTPTransport(limit=2))
+        self.failUnlessRaises(timeline.TimelineError, client.latest, 'one')
+        for result in client.fetch_many(['/a', '/b']):
+            self.failUnless(isinstance(result, timeline.TimelineError))
+        self.failUnlessEqual(client.latest_many(['one', 'two']), {})
+
+STANZA = re.compile(r'<(iq|auth|presence)\b[^>]*?(/>|>.*?</\1>)', re.S)
+
+class FakeTalk(SocketServer.ThreadingMixIn, SocketServer.TCPServer):
+    """Local stand-in for talk.google.com, speaking just enough XMPP to
+    authenticate and read and set google:shared-status"""
+
+    allow_reuse_address = True
+    daemon_threads = True
+
+    def __init__(self, accounts):
+        SocketServer.TCPServer.__init__(self, ('127.0.0.1', 0), FakeTalkHandler)
+        self.accounts = accounts
+        self.statuses = {}
+        self.connections = 0
+        self.auths = 0
+        self.handlers = []
+        self.silent = False
+        # the 'to' of every shared status set, None when there was none
+        self.set_to = []
+
+    def address(self):
+        return self.server_address
+
+class FakeTalkHandler(SocketServer.BaseRequestHandler):
+    def handle(self):
+        self.server.connections += 1
+        self.server.handlers.append(self)
+        self.user = None
+        buffer = ''
+        while True:
+            try:
+                data = self.request.recv(4096)
+            except Exception:
+                return
+            if not data:
+                return
+            buffer += data
+            while True:
+                if buffer.lstrip().startswith('<?xml'):
+                    buffer = buffer[buffer.index('?>') + 2:]
+                    continue
+                if buffer.lstrip().startswith('<stream:stream'):
+                    buffer = buffer[buffer.index('>') + 1:]
+                    self.open_stream()
+                    continue
+                if buffer.lstrip().startswith('</stream:stream>'):
+                    return
+                match = STANZA.search(buffer)
+                if match is None:
+                    break
+                buffer = buffer[match.end():]
+                self.stanza(match.group(1), match.group(0))
+
+    def send(self, data):
+        self.request.sendall(data)
+
+    def open_stream(self):
+        self.send("<?xml version='1.0'?><stream:stream xmlns='jabber:client' "
+                  "xmlns:stream='http://etherx.jabber.org/streams' id='fake' "
+                  "from='gmail.com' version='1.0'>")
+        if self.user is None:
+            self.send("<stream:features><mechanisms "
+                      "xmlns='urn:ietf:params:xml:ns:xmpp-sasl'><mechanism>PLAIN"
+                      "</mechanism></mechanisms></stream:features>")
+        else:
+            self.send("<stream:features><bind xmlns='urn:ietf:params:xml:ns:xmpp-bind'/>"
+                      "<session xmlns='urn:ietf:params:xml:ns:xmpp-session'/>"
+                      "</stream:features>")
+
+    def stanza(self, name, xml):
+        if name == 'auth':
+            self.auth(xml)
+        elif name == 'iq':
+            self.iq(xml)
+
+    def auth(self, xml):
+        plain = base64.b64decode(re.search(r'>([^<]*)</auth>', xml).group(1))
+        (zid, user, password) = plain.split('\0')
+        if self.server.accounts.get(user) == password:
+            self.server.auths += 1
+            self.user = user
+            self.send("<success xmlns='urn:ietf:params:xml:ns:xmpp-sasl'/>")
+        else:
+            self.send("<failure xmlns='urn:ietf:params:xml:ns:xmpp-sasl'>"
+                      "<not-authorized/></failure>")
+
+    def iq(self, xml):
+        id = re.search(r'''\bid=["']([^"']*)''', xml).group(1)
+        if 'urn:ietf:params:xml:ns:xmpp-bind' in xml:
+            self.result(id, "<bind xmlns='urn:ietf:params:xml:ns:xmpp-bind'>"
+                            "<jid>%s@gmail.com/fake</jid></bind>" % self.user)
+        elif 'google:shared-status' in xml and self.server.silent:
+            pass
+        elif 'google:shared-status' in xml and 'type="get"' in xml:
+            self.result(id, "<query xmlns='google:shared-status' status-max='512' "
+                            "status-list-max='3' status-list-contents-max='5'>"
+                            "<status>%s</status><show>default</show></query>"
+                            % self.server.statuses.get(self.user, ''))
+        elif 'google:shared-status' in xml:
+            to = re.search(r'''^<iq[^>]*\bto=["']([^"']*)''', xml)
+            to = to and to.group(1)
+            self.server.set_to.append(to)
+            # a set sent to a full JID goes to that resource, not the server
+            if to is None or '/' not in to:
+                self.server.statuses[self.user] = re.search(r'<status>([^<]*)</status>',
+                                                            xml).group(1)
+            self.result(id)
+        else:
+            self.result(id)
+
+    def result(self, id, child=''):
+        # like Google Talk, address results to the full JID
+        to = ''
+        if self.user is not None:
+            to = " to='%s@gmail.com/fake'" % self.user
+        self.send("<iq type='result' id='%s'%s>%s</iq>" % (id, to, child))
+
+    def drop(self):
+        self.request.shutdown(socket.SHUT_RDWR)
+        self.request.close()
+
+class SessionPoolTest(unittest.TestCase):
+    def setUp(self):
+        self.server = FakeTalk({'one': 'secret', 'two': 'secret'})
+        self.thread = threading.Thread(target=self.server.serve_forever)
+        self.thread.setDaemon(True)
+        self.thread.start()
+        self.pool = sharedstatus.SessionPool(self.server.address(), timeout=2)
+
+    def tearDown(self):
+        self.pool.close()
+        self.server.shutdown()
+        self.server.server_close()
+
+    def test_reuse(self):
+        """
+        Tests that updates for one JID share one authenticated stream.
+        """
+        self.failUnless(self.pool.update_status('one@gmail.com', 'secret', 'first'))
+        self.failUnless(self.pool.update_status('one@gmail.com', 'secret', 'second'))
+        self.failIf(self.pool.update_status('one@gmail.com', 'secret', 'second'))
+        self.failUnless(self.pool.update_status('two@gmail.com', 'secret', 'third'))
+
+        self.failUnlessEqual(self.server.statuses, {'one': 'second', 'two': 'third'})
+        self.failUnlessEqual(self.server.set_to, [None, None, None])
+        self.failUnlessEqual(self.server.connections, 2)
+        self.failUnlessEqual(self.server.auths, 2)
+
+    def test_reconnect(self):
+        """
+        Tests that a stream closed by the server is replaced.
+        """
+        self.pool.update_status('one@gmail.com', 'secret', 'first')
+        self.server.handlers[0].drop()
+        self.failUnless(self.pool.update_status('one@gmail.com', 'secret', 'second'))
+        self.failUnlessEqual(self.server.statuses, {'one': 'second'})
+        self.failUnlessEqual(self.server.connections, 2)
+
+    def test_expire(self):
+        """
+        Tests that idle sessions are closed.
+        """
+        self.pool.update_status('one@gmail.com', 'secret', 'first')
+        self.pool.expire(self.pool.sessions['one@gmail.com'].used + self.pool.idle + 1)
+        self.failUnlessEqual(self.pool.sessions, {})
+        self.pool.update_status('one@gmail.com', 'secret', 'second')
+        self.failUnlessEqual(self.server.connections, 2)
+
+    def test_expire_timer(self):
+        """
+        Tests that the dispatcher closes idle sessions with no other
+        update coming, and that the default outlasts the hourly push.
+        """
+        self.failUnless(sharedstatus.IDLE > 3600)
+        pool = sharedstatus.SessionPool(self.server.address(), idle=0.2,
+                                        dispatcher=self.pool.dispatcher,
+                                        expire_every=0.1)
+        pool.update_status('one@gmail.com', 'secret', 'first')
+        session = pool.sessions['one@gmail.com']
+        for i in range(40):
+            if not pool.sessions:
+                break
+            time.sleep(0.05)
+        self.failUnlessEqual(pool.sessions, {})
+        self.failIf(session.connected())
+        pool.close()
+
+    def test_one_thread(self):
+        """
+        Tests updates of many JIDs in flight together on the dispatcher
+        thread, and reports their latency.
+        """
+        for i in range(20):
+            self.server.accounts['user%d' % i] = 'secret'
+        for label, status in (('connecting', 'hi'), ('pooled', 'hello')):
+            futures = [self.pool.update_async('user%d@gmail.com' % i, 'secret',
+                                              status)
+                       for i in range(20)]
+            self.failUnlessEqual([future.result() for future in futures],
+                                 [True] * 20)
+
+            latencies = [future.latency() for future in futures]
+            latencies.sort()
+            sys.stderr.write('\n%s update latency: median %.1f ms, max %.1f ms ' % (
+                label, latencies[10] * 1000, latencies[-1] * 1000))
+            self.failUnless(latencies[-1] < 1)
+        self.failUnlessEqual(self.server.connections, 20)
+
+    def test_timeout(self):
+        """
+        Tests that an unanswered update fails after the pool's timeout.
+        """
+        self.pool.timeout = 0.2
+        self.server.silent = True
+        future = self.pool.update_async('one@gmail.com', 'secret', 'first')
+        self.failUnlessRaises(sharedstatus.StatusError, future.result)
+        self.failUnless(future.latency() < 1)
+
+    def test_bad_password(self):
+        """
+        Tests that a refused login is reported.
+        """
+        self.failUnlessRaises(sharedstatus.StatusError, self.pool.update_status,
+                              'one@gmail.com', 'wrong', 'first')
+
+class UserLogTest(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.writer = userlog.LogWriter(self.directory, max_open=2,
+                                        max_bytes=1000, backups=2)
+        self.logger = logging.getLogger('userlog-test')
+        self.logger.propagate = False
+        self.logger.setLevel(logging.INFO)
+        self.logger.addHandler(userlog.UserLogHandler(self.writer))
+
+    def tearDown(self):
+        self.logger.handlers = []
+        self.writer.stop()
+        shutil.rmtree(self.directory)
+
+    def read(self, name):
+        return open(os.path.join(self.directory, name)).read().splitlines()
+
+    def test_lines_per_request(self):
+        """
+        Tests that every request writes its lines once, however many
+        requests there were, with more users than open files.
+        """
+        for request in range(10):
+            for user in ('one', 'two', 'three'):
+                log = userlog.UserLog(self.logger, user)
+                log.info('request %d' % request)
+                log.debug('not written')
+        self.writer.flush()
+
+        for user in ('one', 'two', 'three'):
+            lines = self.read(user)
+            self.failUnlessEqual(len(lines), 10)
+            self.failUnless(lines[-1].endswith('INFO    "request 9"'))
+        self.failUnlessEqual(len(self.logger.handlers), 1)
+        self.failUnless(len(self.writer.files) <= 2)
+
+    def test_rotate(self):
+        """
+        Tests that a full file moves to name.1 and the oldest is removed.
+        """
+        log = userlog.UserLog(self.logger, 'one')
+        for i in range(100):
+            log.error('x' * 50)
+        self.writer.flush()
+
+        names = os.listdir(self.directory)
+        names.sort()
+        self.failUnlessEqual(names, ['one', 'one.1', 'one.2'])
+        for name in names:
+            self.failUnless(os.path.getsize(os.path.join(self.directory, name)) <= 1100)
+
+    def test_non_ascii(self):
+        """
+        Tests that unicode lines are written as UTF-8, and that a line
+        that can not be written does not stop the writer.
+        """
+        log = userlog.UserLog(self.logger, 'one')
+        log.info(u'caf\xe9 \u2603')
+        self.writer.put('one', object())
+        log.info('after')
+        self.writer.flush()
+
+        lines = self.read('one')
+        self.failUnless(lines[0].endswith('"caf\xc3\xa9 \xe2\x98\x83"'))
+        self.failUnless(lines[-1].endswith('"after"'))
+        self.failUnlessEqual(self.writer.dropped, 1)
+
+class Undelivered(BaseHTTPServer.BaseHTTPRequestHandler):
+    """Local stand-in for /undelivered/ of twitter2gTalk"""
+
+    def do_POST(self):
+        body = self.rfile.read(int(self.headers['Content-Length']))
+        self.server.posts.append((self.path, body))
+        self.send_response(200)
+        self.end_headers()
+
+    def log_message(self, *args):
+        pass
+
+class JobQueueTest(TestCase):
+    def setUp(self):
+        self.ran = []
+        self.fail = False
+        self.failed = []
+        #no worker threads, the tests run the queue by hand
+        self.queue = jobs.JobQueue(self.run_job, workers=0, max_attempts=2,
+                                   failed=self.failed.append)
+
+    def run_job(self, key):
+        self.ran.append(key)
+        if self.fail:
+            raise IOError('talk.google.com is down')
+
+    def test_duplicates(self):
+        """
+        Tests that a key queued twice runs once, and can be queued again
+        once it ran.
+        """
+        self.queue.enqueue('abc')
+        self.queue.enqueue('abc')
+        self.queue.enqueue('def')
+        self.failUnlessEqual(Job.objects.count(), 2)
+
+        while self.queue.work_once('test'):
+            pass
+        self.failUnlessEqual(self.ran, ['abc', 'def'])
+
+        self.queue.enqueue('abc')
+        self.queue.work_once('test')
+        self.failUnlessEqual(self.ran, ['abc', 'def', 'abc'])
+        self.failUnlessEqual(self.queue.counts['duplicates'], 1)
+        self.failUnlessEqual(self.queue.counts['done'], 3)
+
+    def test_retry(self):
+        """
+        Tests that a failed job waits before its retry and is given up on
+        after max_attempts.
+        """
+        self.fail = True
+        self.queue.enqueue('abc')
+        self.queue.work_once('test')
+        job = Job.objects.get()
+        self.failUnlessEqual((job.state, job.attempts), (Job.QUEUED, 1))
+        self.failUnless('talk.google.com is down' in job.error)
+        self.failUnlessEqual(self.queue.work_once('test'), None)
+
+        job.run_after = job.created
+        job.save()
+        self.queue.work_once('test')
+        self.failUnlessEqual(Job.objects.get().state, Job.FAILED)
+        self.failUnlessEqual(len(self.ran), 2)
+
+    def test_failed(self):
+        """
+        Tests that twitter2gTalk is told about the account of a request
+        given up on, so the tweet it noted as pushed is pushed again.
+        """
+        from proxy import views
+
+        server = BaseHTTPServer.HTTPServer(('127.0.0.1', 0), Undelivered)
+        server.posts = []
+        thread = threading.Thread(target=server.handle_request)
+        thread.start()
+        url = views.UNDELIVERED_URL
+        views.UNDELIVERED_URL = 'http://127.0.0.1:%d/undelivered/' % server.server_address[1]
+        try:
+            response = Client().get('/xmppproxy/abc', {'account': 'agx1'})
+            self.failUnlessEqual(response.status_code, 200)
+            self.failUnlessEqual(Job.objects.get().account, 'agx1')
+
+            #the same key for another account is queued for it once done
+            self.queue.enqueue('def', 'agx2')
+            self.queue.enqueue('def', 'agx3')
+            self.failUnlessEqual(Job.objects.get(key='def').account, 'agx2')
+            self.queue.work_once('test')
+            self.queue.work_once('test')
+            self.failUnlessEqual(self.failed, [])
+
+            self.fail = True
+            self.queue.enqueue('def', 'agx3')
+            for i in range(2):
+                Job.objects.filter(key='def').update(run_after=datetime.datetime.now())
+                self.queue.work_once('test')
+            self.failUnlessEqual([job.account for job in self.failed], ['agx3'])
+
+            views.job_failed(self.failed[0])
+            thread.join()
+            self.failUnlessEqual(server.posts, [('/undelivered/', 'account=agx3')])
+        finally:
+            views.UNDELIVERED_URL = url
+            server.server_close()
+
+    def test_purge(self):
+        """
+        Tests that done and failed jobs are deleted once they are 'keep'
+        old, and queued ones are not.
+        """
+        for key in ('done', 'failed', 'recent', 'queued'):
+            self.queue.enqueue(key)
+        Job.objects.filter(key__in=('done', 'recent')).update(state=Job.DONE)
+        Job.objects.filter(key='failed').update(state=Job.FAILED)
+        old = datetime.datetime.now() - jobs.KEEP - datetime.timedelta(hours=1)
+        Job.objects.exclude(key='recent').update(updated=old)
+
+        self.failUnlessEqual(self.queue.purge(), 2)
+        keys = [job.key for job in Job.objects.order_by('key')]
+        self.failUnlessEqual(keys, ['queued', 'recent'])
+        self.failUnlessEqual(self.queue.counts['purged'], 2)
+
+        #an idle worker purges at most every PURGE_EVERY
+        Job.objects.filter(key='recent').update(updated=old)
+        self.queue.purge_due()
+        self.failUnlessEqual(Job.objects.count(), 1)
+        Job.objects.filter(key='queued').update(state=Job.DONE)
+        self.queue.purge_due()
+        self.failUnlessEqual(Job.objects.count(), 1)
+        self.queue.purged = old
+        self.queue.purge_due()
+        self.failUnlessEqual(Job.objects.count(), 0)
+
+    def test_status(self):
+        """
+        Tests the queue depth page.
+        """
+        jobs.JobQueue(self.run_job, workers=0).enqueue('abc')
+        response = Client().get('/xmppqueue/')
+        self.failUnlessEqual(response.status_code, 200)
+        self.failUnless('queued 1\n' in response.content)
+
+class IdempotentTest(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.cache = idempotency.ResultCache(ttl=3600, directory=self.directory)
+        self.requests = idempotency.Idempotent(self.cache)
+        self.calls = 0
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def update(self, result='updated'):
+        self.calls += 1
+        return result
+
+    def test_digest(self):
+        """
+        Tests that requests of one user are told apart by the hour only.
+        """
+        nine = datetime.datetime(2009, 1, 1, 9, 5)
+        digest = idempotency.request_digest('a@gmail.com', 'a', nine)
+        self.failUnlessEqual(digest, idempotency.request_digest(
+            'a@gmail.com', 'a', nine.replace(minute=55)))
+        self.failIfEqual(digest, idempotency.request_digest(
+            'a@gmail.com', 'a', nine.replace(hour=10)))
+        self.failIfEqual(digest, idempotency.request_digest(
+            'a@gmail.com', 'b', nine))
+
+    def test_finished(self):
+        """
+        Tests that a duplicate gets the cached result, in this process
+        and from the file in another, until it expires.
+        """
+        self.failUnlessEqual(self.requests.call('d', self.update), 'updated')
+        self.failUnlessEqual(self.requests.call('d', self.update, 'x'), 'updated')
+        self.failUnlessEqual((self.calls, self.requests.suppressed), (1, 1))
+
+        other = idempotency.Idempotent(idempotency.ResultCache(
+            ttl=3600, directory=self.directory))
+        self.failUnlessEqual(other.call('d', self.update, 'x'), 'updated')
+        self.failUnlessEqual(self.calls, 1)
+
+        other.cache.clock = lambda: time.time() + 3601
+        self.failUnlessEqual(other.call('d', self.update, 'x'), 'x')
+        self.failUnlessEqual(self.calls, 2)
+
+    def test_purge(self):
+        """
+        Tests that results expired in memory and on disk are forgotten
+        by a put() a ttl after the last purge.
+        """
+        now = [1000.0]
+        self.cache.clock = lambda: now[0]
+        self.cache.put('a', 'one')
+        now[0] += 1800
+        self.cache.put('b', 'two')
+        self.failUnlessEqual(sorted(os.listdir(self.directory)), ['a', 'b'])
+
+        now[0] += 1800
+        self.cache.put('c', 'three')
+        self.failUnlessEqual(sorted(self.cache.results.keys()), ['b', 'c'])
+        self.failUnlessEqual(sorted(os.listdir(self.directory)), ['b', 'c'])
+
+    def test_in_flight(self):
+        """
+        Tests that duplicates arriving while the request runs wait for it
+        and share its result.
+        """
+        started = threading.Event()
+        release = threading.Event()
+        def slow():
+            started.set()
+            release.wait()
+            return self.update()
+
+        results = []
+        threads = [threading.Thread(target=lambda: results.append(
+                       self.requests.call('d', slow)))
+                   for i in range(5)]
+        threads[0].start()
+        started.wait()
+        for thread in threads[1:]:
+            thread.start()
+        while self.requests.suppressed < 4:
+            time.sleep(0.01)
+        release.set()
+        for thread in threads:
+            thread.join()
+
+        self.failUnlessEqual(results, ['updated'] * 5)
+        self.failUnlessEqual(self.calls, 1)
+
+    def test_failure_not_kept(self):
+        """
+        Tests that a failed request runs again.
+        """
+        def fail():
+            raise IOError('down')
+        self.failUnlessRaises(IOError, self.requests.call, 'd', fail)
+        self.failUnlessEqual(self.requests.call('d', self.update), 'updated')
+
 __test__ = {"doctest": """
 Another way to test that 1 + 1 is equal to 2.
 
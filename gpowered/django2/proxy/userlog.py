@@ -0,0 +1,164 @@
+"""Per-user log files for the xmppproxy
+
+Records for every user go through one logger and one handler. The handler
+queues them for a single writer thread, which keeps the least recently
+used files open and rotates a file once it grows past max_bytes.
+"""
+
+import logging
+import os
+import threading
+import Queue
+
+LOG_DIR = '/home/gpowered/logs/user/twitter2gtalk'
+
+FORMATTER = logging.Formatter('[%(asctime)s]%(levelname)-8s"%(message)s"',
+                              '%Y-%m-%d %a %H:%M:%S')
+
+class LogWriter:
+    """Writes lines to per-user files in 'directory' from one thread
+
+    At most 'max_queued' lines wait to be written, more are counted in
+    'dropped' rather than held in memory. At most 'max_open' files are kept
+    open. A file reaching 'max_bytes' is renamed to name.1, name.1 to name.2
+    and so on, keeping 'backups' old files.
+    """
+
+    def __init__(self, directory=LOG_DIR, max_open=64, max_bytes=1048576,
+                 backups=3, max_queued=10000):
+        self.directory = directory
+        self.max_open = max_open
+        self.max_bytes = max_bytes
+        self.backups = backups
+        self.queue = Queue.Queue(max_queued)
+        self.files = {}
+        self.used = []
+        self.dropped = 0
+        self.thread = threading.Thread(target=self.run)
+        self.thread.setDaemon(True)
+        self.thread.start()
+
+    def put(self, name, line):
+        try:
+            self.queue.put_nowait((name, line))
+        except Queue.Full:
+            self.dropped += 1
+
+    def open(self, name):
+        """Returns the open file for 'name', closing the least recently
+        used one if there are too many"""
+
+        if name in self.files:
+            self.used.remove(name)
+            self.used.append(name)
+            return self.files[name]
+
+        if len(self.files) >= self.max_open:
+            self.close(self.used[0])
+        self.files[name] = open(os.path.join(self.directory, name), 'a')
+        self.used.append(name)
+        return self.files[name]
+
+    def close(self, name):
+        self.files.pop(name).close()
+        self.used.remove(name)
+
+    def rotate(self, name):
+        self.close(name)
+        path = os.path.join(self.directory, name)
+        for i in range(self.backups - 1, 0, -1):
+            if os.path.exists('%s.%d' % (path, i)):
+                os.rename('%s.%d' % (path, i), '%s.%d' % (path, i + 1))
+        if self.backups:
+            os.rename(path, '%s.1' % path)
+        else:
+            os.remove(path)
+
+    def write(self, name, line):
+        if isinstance(line, unicode):
+            line = line.encode('utf-8')
+        file = self.open(name)
+        file.write(line + '\n')
+        if file.tell() >= self.max_bytes:
+            self.rotate(name)
+
+    def run(self):
+        while True:
+            (name, line) = self.queue.get()
+            try:
+                if name is None:
+                    for name in self.files.keys():
+                        self.close(name)
+                    return
+                try:
+                    self.write(name, line)
+                except Exception:
+                    # one bad line must not stop the only writer
+                    self.dropped += 1
+                    logging.exception('could not write the log of %s' % name)
+                if self.queue.empty():
+                    for file in self.files.values():
+                        file.flush()
+            finally:
+                self.queue.task_done()
+
+    def flush(self):
+        """Waits until everything queued so far is written"""
+
+        self.queue.join()
+
+    def stop(self):
+        self.queue.put((None, None))
+        self.thread.join()
+
+class UserLogHandler(logging.Handler):
+    """Hands records to a LogWriter, by the 'user' they were logged for"""
+
+    def __init__(self, writer):
+        logging.Handler.__init__(self)
+        self.writer = writer
+        self.setFormatter(FORMATTER)
+
+    def emit(self, record):
+        try:
+            self.writer.put(getattr(record, 'user', 'unknown'), self.format(record))
+        except Exception:
+            self.handleError(record)
+
+class UserLog:
+    """Logger for one user's file"""
+
+    def __init__(self, logger, user):
+        self.logger = logger
+        self.user = user
+
+    def log(self, level, msg):
+        self.logger.log(level, msg, extra={'user': self.user})
+
+    def debug(self, msg):
+        self.log(logging.DEBUG, msg)
+
+    def info(self, msg):
+        self.log(logging.INFO, msg)
+
+    def error(self, msg):
+        self.log(logging.ERROR, msg)
+
+logger = logging.getLogger('twitter2gtalk')
+logger.propagate = False
+writer = None
+lock = threading.Lock()
+
+def getlogger(user, directory=LOG_DIR):
+    """Returns the log of 'user', starting the writer on first use"""
+
+    global writer
+    lock.acquire()
+    try:
+        if writer is None:
+            writer = LogWriter(directory)
+            logger.addHandler(UserLogHandler(writer))
+            logger.setLevel(logging.INFO)
+    finally:
+        lock.release()
+    return UserLog(logger, user)
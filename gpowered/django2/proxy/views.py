@@ -1,14 +1,29 @@
+from django.conf import settings
 from django.http import HttpResponse
 import datetime
 import logging
 
 
-import sys, xmpp, os, urllib2, time, simplejson
+import sys, xmpp, os, urllib, urllib2, time, simplejson
 from time import gmtime, strftime
 
 from service.models import *
 from rsa.models import *
 import crypt
+import idempotency
+import jobs
+import sharedstatus
+import userlog
+import timeline
+
+twitter = timeline.TimelineClient()
+
+#authenticated gTalk streams, kept between requests
+sessions = sharedstatus.SessionPool()
+
+#results of this hour's requests, in XMPPPROXY_RESULTS too if it is set
+requests = idempotency.Idempotent(
+    idempotency.ResultCache(directory=getattr(settings, 'XMPPPROXY_RESULTS', None)))
 
 class Twitter2gChat:
     
@@ -21,180 +36,42 @@ class Twitter2gChat:
     
         self.twitter_status = None
         self.updated = None
-        self.catches = 0
-    
-    #keep looping and wait for xmpp response
-    def GoOn(self,conn):
-        while self.StepOn(conn):
-            pass
     
-    #keep listening for responses
-    def StepOn(self,conn):
-        self.logger.error('StepOn')
-        if self.updated:
-            return 0
-        try:
-            conn.Process(1)
-        except KeyboardInterrupt:
-            return 0
-        return 1
-
-    #handle responses
-    def iqHandler(self, conn,iq_node):
-        self.logger.error('in iqHandler')
-        #self.logger.error(strftime("%a, %d %b %Y %H:%M:%S +0000", gmtime()))
-        self.catches = self.catches + 1
-        
-        #we have looped enough, die
-        if self.catches == 4:
-            self.logger.error('i think we did it')
-            #sys.exit(0)
-            self.updated = True
-            #return
-            self.logger.handlers[0].close()
-            return HttpResponse("")
-        
-        #print response, don't need to send anything back    
-        if self.updated == True:
-            try:
-                self.logger.error(iq_node)
-            except:
-                pass
-        
-        #havn't updated yet, sent status update
-        else:
-            #we can build of response
-            node = iq_node.getChildren()[0]
-            
-            #remove what we don't ned
-            node.delAttr('status-list-max')
-            node.delAttr('status-max')
-            node.delAttr('status-list-contents-max')
-            iq_node.delAttr('from')
-            iq_node.delAttr('type')
-            iq_node.delAttr('to')
-           
-           #update the current status
-
-            try:
-                curr_status = node.getChildren()[0]
-                self.logger.error( curr_status)
-            except IndexError:
-                curr_status = node
-                curr_status.setData('twitter2gTalk will not work with protected tweets')
-            
-            #no need to update
-            if curr_status.getData() == self.twitter_status:
-                self.logger.error( 'status is already tweet')
-                #sys.exit(0)
-                self.updated = True
-                #return
-                self.logger.handlers[0].close()
-                return HttpResponse("")
-            else:    
-                curr_status.setData(self.twitter_status)
-    
-                #set response
-                iq_node.setType('set')
-                
-                self.logger.error( 'sending')
-                try:
-                    self.logger.error( iq_node)
-                except:
-                    pass
-                self.updated = True
-                conn.send(iq_node)
-                self.logger.error( 'end of iqHandler\n\n')
-
-    #start talking to the server and update status
+    #update the gTalk status over the pooled stream
     def updateGtalkStatus(self, google_username, google_pass):
         if '@' not in google_username:
             google_username = '%s@gmail.com' % google_username
-        self.logger.error( google_username)
-        #connect
-        jid=xmpp.protocol.JID(google_username)
-        cl=xmpp.Client(jid.getDomain(),debug=[])
-        if not cl.connect(('talk.google.com',5222)):
-            self.logger.error( 'Can not connect to server.')
-            #sys.exit(1)
-            self.updated = True
-            #return
-            self.logger.handlers[0].close()
-            return HttpResponse("")
-        if not cl.auth(jid.getNode(),google_pass):
-            self.logger.error( 'Can not auth with server %s ' % google_username)
-            self.updated = True
-            return 
-            
-        #build query to get current status
-        iq = xmpp.Iq()
-        iq.setType('get')
-        iq.setTo(google_username)
-
-        node = xmpp.Node()
-        node.setName('query')
-        node.setAttr('xmlns', 'google:shared-status')
-
-        iq.addChild(node=node) 
-        self.logger.error( iq)
-
-        #register with server and send subscribe to status updates
-        cl.RegisterHandler('iq',self.iqHandler)
-        cl.send(iq)
-
-        self.GoOn(cl)
-        cl.disconnect()
+        self.logger.info(google_username)
+        try:
+            if sessions.update_status(google_username, google_pass,
+                                      self.twitter_status):
+                result = 'status updated'
+            else:
+                result = 'status is already tweet'
+        except sharedstatus.StatusError, e:
+            #the queue retries it later
+            self.logger.error('Can not update %s: %s' % (google_username, e))
+            raise
+        self.logger.info(result)
+        self.updated = True
+        return result
         
     #get current twitter status
     def getTwitterStatus(self, username):
-        twitter_url = 'http://twitter.com/statuses/user_timeline/%s.json?count=1'
-        url = twitter_url % username
-        self.logger.error( url)
+        self.logger.debug(timeline.timeline_path(username))
         try:
-            f = urllib2.urlopen(url)
-            result = f.read()
-            
-            json = simplejson.loads(str(result))
-    
-            return json[0].get('text')
-        except urllib2.HTTPError:
-            self.logger.error( 'urllib2.HTTPError')
+            tweet = twitter.latest(username)
+        except timeline.TimelineError, e:
+            self.logger.error(e)
             return ''
-        except IndexError:
-            self.logger.error( 'IndexError')
+        if tweet is None:
+            self.logger.info('no account')
             return ''
-        except ValueError:
-            self.logger.error( 'no account')
-            return ''
-
-    def makePubKey(self, k):
-        temp = k.split('!')
-        pubkey = {'e': long(temp[0]), 'n': long(temp[1])}
-        return pubkey
-
-    def makePrivKey(self, k):
-        temp = k.split('!')
-#        print "k %s" % k
-        privkey = {'d': long(temp[0]), 'p': long(temp[1]), 'q': long(temp[2])}        
-        return privkey    
-    
-    def getlogger(self, username):
-        logger = logging.getLogger("%s" % username)
-        hdlr = logging.FileHandler("/home/gpowered/logs/user/twitter2gtalk/%s" % username)
-
-        formatter = logging.Formatter('[%(asctime)s]%(levelname)-8s"%(message)s"','%Y-%m-%d %a %H:%M:%S') 
-        
-        hdlr.setFormatter(formatter)
-        logger.addHandler(hdlr)
-        logger.setLevel(logging.NOTSET)
-    
-        return logger
+        return tweet[1]
 
     def loop(self, slug):
-        gae_pub = RsaKey.objects.get(name="gae_pub").key
-        gp_priv = RsaKey.objects.get(name="gp_priv").key
-        gp_privkey = self.makePrivKey(gp_priv)
-        gae_pubkey = self.makePubKey(gae_pub)
+        gp_privkey = keys.get("gp_priv")
+        gae_pubkey = keys.get("gae_pub")
 
         gtalk_service = Service.objects.get(name='google')
 
@@ -206,38 +83,61 @@ class Twitter2gChat:
         gPass = decrypted[1]
         twit = decrypted[2]
         
-        self.logger = self.getlogger("%s_%s.txt" % (gLogin, twit))
-        self.logger.error("HIIIiiii %s" % gLogin)
-        
+        self.logger = userlog.getlogger("%s_%s.txt" % (gLogin, twit))
+        self.logger.info("HIIIiiii %s" % gLogin)
+
+        digest = idempotency.request_digest(gLogin, twit)
+        return requests.call(digest, self.update, gLogin, gPass, twit)
+
+    def update(self, gLogin, gPass, twit):
         self.twitter_status = ''
         self.updated = None
-        self.catches = 0
 
         self.twitter_status = self.getTwitterStatus(twit)
         try:
-            self.logger.error( self.twitter_status)
+            self.logger.info(self.twitter_status)
         except:
             pass
 
         if self.twitter_status != '' and '@' not in self.twitter_status:
 
-            self.updateGtalkStatus(gLogin, gPass)
+            return self.updateGtalkStatus(gLogin, gPass)
         else:
             self.updated = True             
+            return 'no tweet'
 
-        while not self.updated:
-            self.logger.error( self.updated)
-            time.sleep(2)
-        try:
-            self.logger.handlers[0].close()
-        except:
-            pass
 
+#twitter2gTalk notes a tweet as pushed once the job is queued, it is told
+#here when the job is given up on so it pushes the tweet again
+UNDELIVERED_URL = getattr(settings, 'XMPPPROXY_UNDELIVERED',
+                          'http://twitter2gtalk.appspot.com/undelivered/')
+
+def run_job(slug):
+    t = Twitter2gChat()
+    t.loop(slug)
+
+def job_failed(job):
+    if not job.account:
+        return
+    urllib2.urlopen(UNDELIVERED_URL, urllib.urlencode({'account': job.account})).read()
+
+#requests are run by background workers, the task just queues them.
+#The workers start with the proxy, so jobs left queued or waiting for a
+#retry by the last process are picked up without a new request
+queue = jobs.JobQueue(run_job,
+                      workers=getattr(settings, 'XMPPPROXY_WORKERS', jobs.WORKERS),
+                      failed=job_failed)
+queue.start()
 
 def start(request, slug):
     now = datetime.datetime.now()
     html = "<html><body>It is now %s.</body></html>" % now
+    #tasks queued before the URL-safe chops format
     slug = slug.replace('!gp!', '\n')
-    t = Twitter2gChat()
-    t.loop(slug)
+    queue.enqueue(slug, request.GET.get('account', ''))
     return HttpResponse(html)
+
+def queue_status(request):
+    stats = queue.stats() + [('suppressed', requests.suppressed)]
+    lines = ['%s %s' % stat for stat in stats]
+    return HttpResponse('\n'.join(lines) + '\n', mimetype='text/plain')
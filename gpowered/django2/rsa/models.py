@@ -1,4 +1,6 @@
 from django.db import models
+from django.db.models.signals import post_save, post_delete
+import crypt
 
 class RsaKey(models.Model):
     name = models.CharField(max_length=32)
@@ -6,4 +8,15 @@ class RsaKey(models.Model):
     
     def __unicode__(self):
         return self.name
-    
\ No newline at end of file
+
+def load_key(name):
+    return RsaKey.objects.get(name=name).key
+
+#parsed keys, other processes pick up a changed RsaKey after ten minutes
+keys = crypt.KeyRegistry(load_key, ttl=600)
+
+def invalidate_key(sender, instance, **kwargs):
+    keys.invalidate()
+
+post_save.connect(invalidate_key, sender=RsaKey)
+post_delete.connect(invalidate_key, sender=RsaKey)
@@ -5,7 +5,12 @@ unittest). These will both pass when you run "manage.py test".
 Replace these with more appropriate tests for your application.
 """
 
+import sys
+import time
+
 from django.test import TestCase
+from rsa.models import RsaKey, keys
+import crypt
 
 class SimpleTest(TestCase):
     def test_basic_addition(self):
@@ -14,6 +19,55 @@ class SimpleTest(TestCase):
         """
         self.failUnlessEqual(1 + 1, 2)
 
+class KeyRegistryTest(TestCase):
+    def setUp(self):
+        keys.invalidate()
+        self.stored = RsaKey.objects.create(name='gae_pub', key='17!3233')
+
+    def test_parsed_once(self):
+        """
+        Tests that a key is loaded and parsed once, then served from memory.
+        """
+        key = keys.get('gae_pub')
+        self.failUnlessEqual(key, {'e': 17, 'n': 3233})
+        self.failUnless(keys.get('gae_pub') is key)
+
+    def test_invalidated_on_save(self):
+        """
+        Tests that saving an RsaKey drops the parsed copy.
+        """
+        keys.get('gae_pub')
+        self.stored.key = '7!3233'
+        self.stored.save()
+        self.failUnlessEqual(keys.get('gae_pub'), {'e': 7, 'n': 3233})
+
+class EuclidTest(TestCase):
+    def test_deep_inputs(self):
+        """
+        Tests that consecutive Fibonacci numbers, the slowest case for
+        Euclid, work far beyond the recursion limit.
+        """
+        (a, b) = (1, 1)
+        for i in xrange(sys.getrecursionlimit() * 2):
+            (a, b) = (b, a + b)
+        (d, i, j) = crypt.extended_euclid_gcd(b, a)
+        self.failUnlessEqual(d, 1)
+        self.failUnlessEqual(i * b + j * a, 1)
+        self.failUnlessEqual(crypt.modular_inverse(a, b) * a % b, 1)
+
+    def test_calls_per_second(self):
+        """
+        Records how many 2048 bit modular inverses run per second.
+        """
+        phi_n = (1L << 2047) + 12345
+        rounds = 200
+        start = time.time()
+        for e in xrange(3, 3 + 2 * rounds, 2):
+            if crypt.gcd(e, phi_n) == 1:
+                self.failUnlessEqual(crypt.modular_inverse(e, phi_n) * e % phi_n, 1)
+        rate = rounds / max(time.time() - start, 1e-6)
+        sys.stderr.write('\nmodular_inverse, 2048 bits: %d calls/s\n' % rate)
+
 __test__ = {"doctest": """
 Another way to test that 1 + 1 is equal to 2.
 
@@ -1,11 +1,12 @@
 from django.conf.urls.defaults import *
-from proxy.views import start
+from proxy.views import start, queue_status
 
 # Uncomment the next two lines to enable the admin:
 from django.contrib import admin
 admin.autodiscover()
 
 urlpatterns = patterns('',
+    (r'^xmppqueue/$', queue_status),
     (r'^xmppproxy/(?P<slug>.*)', start),
 
     # Uncomment the admin/doc line below and add 'django.contrib.admindocs' 
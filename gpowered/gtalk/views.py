@@ -1,163 +1,58 @@
 # Create your views here
 
-import xmpp,sys
+import sys
 from django.shortcuts import render_to_response
+from django.db.models.signals import post_save, post_delete
 import gpowered.rsa
+import gpowered.sharedstatus
 from gpowered.core.models import RsaKey
 
+#authenticated gTalk streams, kept between requests
+sessions = gpowered.sharedstatus.SessionPool()
+
 class gTalkStatus:    
     def __init__(self, username, password, msg):
         self.username = username
         self.password = password
         self.twitter_status = msg
         self.updated = False
-        self.catches = 0
-        
-    #keep looping and wait for xmpp response
-    def GoOn(self,conn):
-        while self.StepOn(conn):
-            if(self.updated):
-                return
-            pass
-    
-    #keep listening for responses
-    def StepOn(self,conn):
-        if(self.updated):
-            return
-        
-        try:
-            conn.Process(1)
-        except KeyboardInterrupt:
-                return 0
-        return 1
-
-    #handle responses
-    def iqHandler(self, conn,iq_node):
-        if(self.updated):
-            return
-        print 'in iqHandler'
-        self.catches = self.catches + 1
-        
-        #we have looped enough, die
-        if self.catches == 4:
-            print 'i think we did it'
-            #sys.exit(0)
-            return
-            return render_to_response('gtalk/gtalk.html', 
-                          {    
-                           'login': self.username,
-                           'password': self.password,
-                           'msg': self.twitter_status,
-                           })
-        
-        #print response, don't need to send anything back    
-        if self.updated == True:
-            print iq_node
-        
-        #havn't updated yet, sent status update
-        else:
-            #we can build of response
-            node = iq_node.getChildren()[0]
-            #return render_to_response('gtalk/gtalk.html', 
-            #              {    
-            #               'debug': node,
-            #               })
-            #remove what we don't ned
-            node.delAttr('status-list-max')
-            node.delAttr('status-max')
-            node.delAttr('status-list-contents-max')
-            iq_node.delAttr('from')
-            iq_node.delAttr('type')
-            iq_node.delAttr('to')
-           
-           #update the current status
-            curr_status = node.getChildren()[0]
-            
-            #no need to update
-            #TODO
-            #if curr_status.getData() == self.twitter_status:
-            #    print 'status is already tweet'
-            #    sys.exit(0)
-                #self.__del__()
-                #return
-            #    return render_to_response('gtalk/gtalk.html', 
-            #              {    
-            #               'login': self.username,
-            #               'password': self.password,
-            #               'msg': self.twitter_status,
-            #               }                
-                
-            curr_status.setData(self.twitter_status)
-
-            #set response
-            iq_node.setType('set')
-            
-            print 'sending'
-            print iq_node
-            self.updated = True
-            conn.send(iq_node)
-            print 'end of iqHandler\n\n'
 
-    #start talking to the server and update status
+    #update the status over the pooled stream
     def updateGtalkStatus(self):
-        #connect
-        jid=xmpp.protocol.JID(self.username)
-        cl=xmpp.Client(jid.getDomain(),debug=[])
-        if not cl.connect(('talk.google.com',5222)):
-            print 'Can not connect to server.'
-            return render_to_response('gtalk/gtalk.html', 
-                          {    
-                           'error': 'could not connect to server',
-                           })
-        if not cl.auth(jid.getNode(),self.password):
-            print 'Can not auth with server'
+        try:
+            sessions.update_status(self.username, self.password,
+                                   self.twitter_status)
+        except gpowered.sharedstatus.StatusError, e:
+            print 'Can not update status: %s' % e
             return render_to_response('gtalk/gtalk.html', 
                           {    
-                           'error': 'coult not auth with server',
+                           'error': 'could not update status',
                            })
-            
-        #build query to get current status
-        iq = xmpp.Iq()
-        iq.setType('get')
-        iq.setTo(self.username)
-
-        node = xmpp.Node()
-        node.setName('query')
-        node.setAttr('xmlns', 'google:shared-status')
-
-        iq.addChild(node=node) 
-        print iq
-
-        #register with server and send subscribe to status updates
-        cl.RegisterHandler('iq',self.iqHandler)
-        cl.send(iq)
-
-        self.GoOn(cl)
-        cl.disconnect()
+        self.updated = True
 
     #get current twitter status
 
 #def status_update(request, login, password, msg):
 
-def makePubKey(k):
-    temp = k.split('!')
-    pubkey = {'e': long(temp[0]), 'n': long(temp[1])}
-    return pubkey
+def load_key(name):
+    return RsaKey.objects.filter(name=name)[0].key
+
+#parsed keys, other processes pick up a changed RsaKey after ten minutes
+keys = gpowered.rsa.KeyRegistry(load_key, ttl=600)
 
-def makePrivKey(k):
-    temp = k.split('!')
-    privkey = {'d': long(temp[0]), 'p': long(temp[1]), 'q': long(temp[2])}        
-    return privkey
+def invalidate_key(sender, instance, **kwargs):
+    keys.invalidate()
+
+post_save.connect(invalidate_key, sender=RsaKey)
+post_delete.connect(invalidate_key, sender=RsaKey)
 
 def status_update(request, url):
     
+    #urls built before the URL-safe chops format
     url = url.replace('!GP!', '/')
     
-    gae_pub = RsaKey.objects.filter(name="gae_pub")[0].key
-    gp_priv = RsaKey.objects.filter(name="gp_priv")[0].key
-    
-    gp_privkey = makePrivKey(gp_priv)
-    gae_pubkey = makePubKey(gae_pub)
+    gp_privkey = keys.get("gp_priv")
+    gae_pubkey = keys.get("gae_pub")
     
     #gp_one = gpowered.rsa.verify(url, gae_pubkey)
     enc = gpowered.rsa.decrypt(url, gp_privkey)
@@ -5,6 +5,9 @@ import os
 import signal
 import time
 
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', '..'))
+from gpowered.sharedstatus import Dispatcher
+
 def presenceCB(conn,msg):
         print str(msg)
         prs_type=msg.getType()
@@ -14,15 +17,13 @@ def presenceCB(conn,msg):
                 conn.send(xmpp.Presence(to=who, typ = 'subscribe'))
 
 
-def StepOn(conn):
+def GoOn(conn):
+    dispatcher = Dispatcher()
+    dispatcher.add(conn)
     try:
-        conn.Process(1)
+        while dispatcher.clients:
+            dispatcher.step()
     except KeyboardInterrupt:
-            return 0
-    return 1
-
-def GoOn(conn):
-    while StepOn(conn):
             pass
 
 
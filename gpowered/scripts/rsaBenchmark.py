@@ -0,0 +1,200 @@
+#!/usr/bin/python
+"""Benchmarks for gpowered.rsa
+
+Usage: rsaBenchmark.py [name ...]
+
+Runs every benchmark when no names are given.
+"""
+import os
+import sys
+import time
+import random
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', '..'))
+from gpowered import rsa
+
+KEY_SIZES = (256, 512, 1024, 2048)
+
+def timed(func, args, rounds):
+    """Returns the average number of seconds one func(*args) call takes"""
+    start = time.time()
+    for i in xrange(rounds):
+        func(*args)
+    return (time.time() - start) / rounds
+
+def bench_exponentiation():
+    print 'modexp: private-key sized exponent, ms per call'
+    names = rsa.exponentiation_backends.keys()
+    names.sort()
+    for nbits in KEY_SIZES:
+        n = random.getrandbits(nbits) | (1L << (nbits - 1)) | 1
+        a = random.getrandbits(nbits - 1)
+        d = random.getrandbits(nbits)
+        rounds = max(1, 20480 / nbits)
+
+        reference = timed(rsa.bitlist_exponentiation, (a, d, n), rounds)
+        for name in names:
+            took = timed(rsa.exponentiation_backends[name], (a, d, n), rounds)
+            print '  %4d bits %-8s %9.3f ms  %6.1fx' % (nbits, name,
+                                                       took * 1000,
+                                                       reference / took)
+
+def legacy_int2bytes(number):
+    """int2bytes() as it was, prepending one byte at a time"""
+    string = ""
+    while number > 0:
+        string = "%s%s" % (chr(number & 0xFF), string)
+        number /= 256
+    return string
+
+def legacy_bytes2int(bytes):
+    """bytes2int() as it was, one byte at a time"""
+    integer = 0
+    for byte in bytes:
+        integer = integer * 256 + ord(byte)
+    return integer
+
+def bench_bytes():
+    print 'bytes: block conversion, us per block'
+    for nbits in KEY_SIZES:
+        block = os.urandom(nbits / 8 - 1)
+        number = rsa.bytes2int(block)
+        rounds = 2000
+        for name, func, arg in (('bytes2int', rsa.bytes2int, block),
+                                ('int2bytes', rsa.int2bytes, number)):
+            legacy = globals()['legacy_' + name]
+            before = timed(legacy, (arg,), rounds)
+            after = timed(func, (arg,), rounds)
+            print '  %4d bits %-9s %8.2f us -> %8.2f us  %6.1fx' % (
+                nbits, name, before * 1e6, after * 1e6, before / after)
+
+def userlist(users):
+    """Builds a ListHandler style payload for 'users' accounts"""
+    return ''.join(['user%d@gmail.com!gp!secret%d!gp!twitter%d!GP!' % (i, i, i)
+                    for i in xrange(users)])
+
+def bench_userlist():
+    print 'userlist: ListHandler payload, 1024 bit key, seconds'
+    (pub, priv) = rsa.gen_pubpriv_keys(512)
+    for users in (1000, 10000, 100000):
+        message = userlist(users)
+        for mode, seal in (('blocks', encrypt_blocks),
+                           ('envelope', rsa.seal_envelope)):
+            start = time.time()
+            cypher = seal(message, pub)
+            encrypted = time.time() - start
+
+            start = time.time()
+            for block in rsa.iter_decrypt(cypher, priv):
+                pass
+            streamed = time.time() - start
+
+            start = time.time()
+            assert rsa.decrypt(cypher, priv) == message
+            decrypted = time.time() - start
+
+            print '  %6d users %8d bytes %-8s  encrypt %7.2f  ' \
+                  'decrypt %7.2f  iter_decrypt %7.2f' % (
+                      users, len(message), mode, encrypted, decrypted,
+                      streamed)
+
+def encrypt_blocks(message, key):
+    """Encrypts 'message' block by block, without an envelope"""
+    return rsa.chopstring(message, key['e'], key['n'], rsa.encrypt_int)
+
+def bench_wire():
+    print 'wire: picklechops vs packchops, 1024 bit chops'
+    n = (1L << 1024) - 1
+    for count in (1, 10, 100):
+        chops = [random.getrandbits(1023) for i in xrange(count)]
+        rounds = max(10, 2000 / count)
+        pickled = rsa.picklechops(chops)
+        packed = rsa.packchops(chops, n)
+
+        unpack = lambda string: list(rsa.iter_unpackchops(string))
+        print '  %3d chops  pickle %6d bytes %7.1f us %7.1f us  ' \
+              'pack %6d bytes %7.1f us %7.1f us' % (
+                  count,
+                  len(pickled), timed(rsa.picklechops, (chops,), rounds) * 1e6,
+                  timed(unpack, (pickled,), rounds) * 1e6,
+                  len(packed), timed(rsa.packchops, (chops, n), rounds) * 1e6,
+                  timed(unpack, (packed,), rounds) * 1e6)
+
+def legacy_getprime(nbits):
+    """getprime() as it was: fresh RANDOM_DEV reads and Solovay-Strassen
+    on every odd candidate"""
+    while True:
+        fd = open(rsa.RANDOM_DEV)
+        integer = legacy_bytes2int(fd.read(nbits / 8)) | 1
+        fd.close()
+        if rsa.randomized_primality_testing(integer, 5):
+            return integer
+
+def bench_keygen():
+    print 'keygen: seconds per prime / per gen_pubpriv_keys, by modulus size'
+    for nbits in KEY_SIZES:
+        rounds = max(1, 4096 / nbits)
+        prime = timed(rsa.getprime, (nbits / 2,), rounds)
+        keys = timed(rsa.gen_pubpriv_keys, (nbits / 2,), rounds)
+        if nbits <= 512:
+            legacy = '%8.3f' % timed(legacy_getprime, (nbits / 2,), rounds)
+        else:
+            legacy = '     n/a'
+        print '  %4d bits  getprime %8.3f (legacy %s)  gen_pubpriv_keys %8.3f' % (
+            nbits, prime, legacy, keys)
+
+def legacy_extended_euclid_gcd(a, b):
+    """extended_euclid_gcd() as it was, one recursion level per step"""
+    if b == 0:
+        return (a, 1, 0)
+    q = abs(a % b)
+    r = long(a / b)
+    (d, k, l) = legacy_extended_euclid_gcd(b, q)
+    return (d, l, k - l*r)
+
+def bench_euclid():
+    print 'euclid: extended_euclid_gcd calls per second, e against phi_n'
+    for nbits in KEY_SIZES:
+        phi_n = random.getrandbits(nbits) | (1L << (nbits - 1))
+        e = random.getrandbits(nbits / 2) | 1
+        rounds = 2000
+        before = 1 / timed(legacy_extended_euclid_gcd, (e, phi_n), rounds)
+        after = 1 / timed(rsa.extended_euclid_gcd, (e, phi_n), rounds)
+        print '  %4d bits  recursive %9.0f/s  iterative %9.0f/s  %5.1fx' % (
+            nbits, before, after, after / before)
+
+def bench_batch():
+    print 'batch: TaskLoader messages, 1024 bit key, seconds'
+    for label, e in (('random e', None), ('e=65537', rsa.FIXED_EXPONENT)):
+        (pub, priv) = rsa.gen_pubpriv_keys(512, e=e)
+        for users in (100, 1000, 5000):
+            messages = ['user%d@gmail.com!gp!secret%d!gp!twitter%d' % (i, i, i)
+                        for i in xrange(users)]
+            start = time.time()
+            for message in messages:
+                rsa.encrypt(message, pub)
+            single = time.time() - start
+
+            start = time.time()
+            rsa.encrypt_many(messages, pub)
+            batched = time.time() - start
+            print '  %-8s %5d users  encrypt %7.3f  encrypt_many %7.3f' % (
+                label, users, single, batched)
+
+BENCHMARKS = [
+    ('modexp', bench_exponentiation),
+    ('bytes', bench_bytes),
+    ('userlist', bench_userlist),
+    ('wire', bench_wire),
+    ('keygen', bench_keygen),
+    ('euclid', bench_euclid),
+    ('batch', bench_batch),
+]
+
+def main(names):
+    for name, bench in BENCHMARKS:
+        if not names or name in names:
+            bench()
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
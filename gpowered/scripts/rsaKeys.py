@@ -0,0 +1,31 @@
+#!/usr/bin/python
+"""Generates new gp and gae key pairs for twitter2gTalk and the django
+xmppproxy, and prints them as RsaKey name and key string.
+
+Usage: rsaKeys.py [nbits] [workers]
+"""
+import os
+import sys
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', '..'))
+from gpowered import rsa
+
+def main(args):
+    # Private key strings must fit the 500 characters of RsaKey.keystring
+    nbits = 256
+    workers = 1
+    if rsa.multiprocessing is not None:
+        workers = rsa.multiprocessing.cpu_count()
+
+    if args:
+        nbits = int(args[0])
+    if args[1:]:
+        workers = int(args[1])
+
+    for name in ('gp', 'gae'):
+        (pub, priv) = rsa.gen_pubpriv_keys(nbits, workers, rsa.FIXED_EXPONENT)
+        print '%s_pub %s' % (name, rsa.format_key(pub))
+        print '%s_priv %s' % (name, rsa.format_key(priv))
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
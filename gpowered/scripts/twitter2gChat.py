@@ -11,145 +11,57 @@ setup_environ(settings)
 
 from gpowered.core.models import ServiceLogin, Service, RsaKey
 import gpowered.rsa
+from gpowered.timeline import TimelineClient, TimelineError
+from gpowered.sharedstatus import SessionPool, StatusError
 
-import sys, xmpp, os, twitter, urllib2, time, simplejson
+import sys, xmpp, os, twitter, urllib2, time, simplejson, threading, Queue
 from time import gmtime, strftime
 
+#users updated at once, override with the first argument
+CONCURRENCY = 10
+#users whose tweets are fetched together
+TWEET_BATCH = 20
+
+class UserUpdate:
+    """One user's status update and how it went"""
+
+    def __init__(self, login, password, twitter):
+        if '@' not in login:
+            login = '%s@gmail.com' % login
+        self.login = login
+        self.password = password
+        self.twitter = twitter
+        self.twitter_status = ''
+        self.result = None
+        self.latency = 0.0
+
+    def run(self, sessions):
+        start = time.time()
+        if self.twitter_status == '':# or '@' in self.twitter_status:
+            self.result = 'no tweet'
+        else:
+            try:
+                if sessions.update_status(self.login, self.password,
+                                          self.twitter_status):
+                    self.result = 'updated'
+                else:
+                    self.result = 'already tweet'
+            except StatusError, e:
+                self.result = 'failed: %s' % e
+        self.latency = time.time() - start
+
 class Twitter2gChat:
     
-    def __init__(self):
+    def __init__(self, concurrency=CONCURRENCY):
         self.twitter_service = Service.objects.get(name='Twitter')
         twitter_service_login = self.twitter_service.servicelogin_set.all()[:1][0]
         
         self.ts_login = twitter_service_login.username
         self.ts_pass = twitter_service_login.password
     
-        self.twitter_status = None
-        self.updated = None
-        self.catches = 0
-    
-    #keep looping and wait for xmpp response
-    def GoOn(self,conn):
-        while self.StepOn(conn):
-            pass
-    
-    #keep listening for responses
-    def StepOn(self,conn):
-        print 'StepOn'
-        if self.updated:
-            return 0
-        try:
-            conn.Process(1)
-        except KeyboardInterrupt:
-                return 0
-        return 1
-
-    #handle responses
-    def iqHandler(self, conn,iq_node):
-        print 'in iqHandler'
-        print strftime("%a, %d %b %Y %H:%M:%S +0000", gmtime())
-        self.catches = self.catches + 1
-        
-        #we have looped enough, die
-        if self.catches == 4:
-            print 'i think we did it'
-            #sys.exit(0)
-            self.updated = True
-            return
-        
-        #print response, don't need to send anything back    
-        if self.updated == True:
-            try:
-            	print iq_node
-            except:
-            	pass
-        
-        #havn't updated yet, sent status update
-        else:
-            #we can build of response
-            node = iq_node.getChildren()[0]
-            
-            #remove what we don't ned
-            node.delAttr('status-list-max')
-            node.delAttr('status-max')
-            node.delAttr('status-list-contents-max')
-            iq_node.delAttr('from')
-            iq_node.delAttr('type')
-            iq_node.delAttr('to')
-           
-           #update the current status
-            curr_status = node.getChildren()[0]
-            
-            #no need to update
-            if curr_status.getData() == self.twitter_status:
-                print 'status is already tweet'
-                #sys.exit(0)
-                self.updated = True
-                
-            curr_status.setData(self.twitter_status)
-
-            #set response
-            iq_node.setType('set')
-            
-            print 'sending'
-            try:
-            	print iq_node
-            except:
-            	pass
-            self.updated = True
-            conn.send(iq_node)
-            print 'end of iqHandler\n\n'
-
-    #start talking to the server and update status
-    def updateGtalkStatus(self, google_username, google_pass):
-        if '@' not in google_username:
-        	google_username = '%s@gmail.com' % google_username
-        print google_username
-        #connect
-        jid=xmpp.protocol.JID(google_username)
-        cl=xmpp.Client(jid.getDomain(),debug=[])
-        if not cl.connect(('talk.google.com',5222)):
-            print 'Can not connect to server.'
-            #sys.exit(1)
-            self.updated = True
-            return
-        if not cl.auth(jid.getNode(),google_pass):
-            print 'Can not auth with server %s ' % google_username
-            self.updated = True
-            return 
-            
-        #build query to get current status
-        iq = xmpp.Iq()
-        iq.setType('get')
-        iq.setTo(google_username)
-
-        node = xmpp.Node()
-        node.setName('query')
-        node.setAttr('xmlns', 'google:shared-status')
-
-        iq.addChild(node=node) 
-        print iq
-
-        #register with server and send subscribe to status updates
-        cl.RegisterHandler('iq',self.iqHandler)
-        cl.send(iq)
-
-        self.GoOn(cl)
-        cl.disconnect()
-        
-    #get current twitter status
-    def getTwitterStatus(self, username):
-        twitter_url = 'http://twitter.com/statuses/user_timeline/%s.json?count=1'
-        url = twitter_url % username
-        print url
-	try:
-            f = urllib2.urlopen(url)
-       	    result = f.read()
-            
-            json = simplejson.loads(str(result))
-            return json[0].get('text')  
-        except urllib2.HTTPError:
-            return ''
+        self.concurrency = concurrency
+        self.twitter = TimelineClient()
+        self.sessions = SessionPool()
 
     def makePubKey(self, k):
         temp = k.split('!')
@@ -161,6 +73,84 @@ class Twitter2gChat:
         privkey = {'d': long(temp[0]), 'p': long(temp[1]), 'q': long(temp[2])}        
         return privkey    
 
+    #yield a UserUpdate per line of /list/, decrypting as lines arrive
+    def iterUsers(self, stream, key):
+        for line in stream:
+            line = line.strip()
+            if not line:
+                continue
+            try:
+                user = gpowered.rsa.decrypt(line, key).split('!gp!')
+                update = UserUpdate(*user[:3])
+            except Exception, e:
+                print 'skipped a user that could not be read: %r' % e
+                continue
+            yield update
+
+    #yield lists of up to 'size' updates
+    def iterBatches(self, updates, size):
+        batch = []
+        for update in updates:
+            batch.append(update)
+            if len(batch) == size:
+                yield batch
+                batch = []
+        if batch:
+            yield batch
+
+    #run the updates, at most self.concurrency at a time. Workers start on
+    #the first batch of users while the rest are still being read.
+    def runUpdates(self, updates):
+        queue = Queue.Queue(self.concurrency * 2)
+
+        def work():
+            while True:
+                update = queue.get()
+                if update is None:
+                    return
+                #whatever goes wrong, this worker goes on with the next user
+                try:
+                    update.run(self.sessions)
+                except Exception, e:
+                    update.result = 'failed: %r' % e
+                    print '%s failed: %r' % (update.login, e)
+
+        workers = [threading.Thread(target=work)
+                   for i in range(self.concurrency)]
+        for worker in workers:
+            worker.start()
+
+        started = []
+        try:
+            for batch in self.iterBatches(updates, TWEET_BATCH):
+                tweets = self.twitter.latest_many([update.twitter
+                                                   for update in batch])
+                for update in batch:
+                    tweet = tweets.get(update.twitter)
+                    if tweet is not None:
+                        update.twitter_status = tweet[1]
+                    started.append(update)
+                    queue.put(update)
+        finally:
+            for worker in workers:
+                queue.put(None)
+            for worker in workers:
+                worker.join()
+        return started
+
+    def printSummary(self, updates, took):
+        for update in updates:
+            print '%-40s %7.3f s  %s' % (update.login, update.latency,
+                                          update.result)
+        if not updates:
+            return
+        latencies = [update.latency for update in updates]
+        latencies.sort()
+        print '%d users in %.3f s, %d at a time: median %.3f s, ' \
+              'slowest %.3f s, sum %.3f s' % (
+                  len(updates), took, self.concurrency,
+                  latencies[len(latencies) / 2], latencies[-1], sum(latencies))
+
     def loop(self):
         gae_pub = RsaKey.objects.filter(name="gae_pub")[0].key
         gp_priv = RsaKey.objects.filter(name="gp_priv")[0].key
@@ -170,41 +160,15 @@ class Twitter2gChat:
         gtalk_service = Service.objects.get(name='google')
         
         f = urllib2.urlopen('http://twitter2gtalk.appspot.com/list/')
-        result = f.read()
-        enc = gpowered.rsa.decrypt(result, gp_privkey)
-
-        users = enc.split('!GP!')
-        users.pop()
-        for user in users:
-            self.twitter_status = ''
-            self.updated = None
-            self.catches = 0
-            vars = user.split('!gp!')
-            gLogin = vars[0]
-            gPass = vars[1]
-            twit = vars[2]
-            print gLogin
-            #try:
-            #twitter_account =  user.extaccount_set.get(service=self.twitter_service)
-            #google_account =  user.extaccount_set.get(service=gtalk_service)
-
-            self.twitter_status = self.getTwitterStatus(twit)
-	    try:
-            	print self.twitter_status
-	    except:
-	    	pass
-            if self.twitter_status != '':# and '@' not in self.twitter_status:
-                self.updateGtalkStatus(gLogin, gPass)
-            else:
-            	self.updated = True             
-                
-            #except:
-            #    pass
-            while not self.updated:
-            	print self.updated
-            	time.sleep(2)
-
-t = Twitter2gChat()
+
+        start = time.time()
+        updates = self.runUpdates(self.iterUsers(f, gp_privkey))
+        f.close()
+        self.printSummary(updates, time.time() - start)
+        self.sessions.close()
+
+if sys.argv[1:]:
+    t = Twitter2gChat(int(sys.argv[1]))
+else:
+    t = Twitter2gChat()
 t.loop()
-#t.getTwitterStatus()
-#t.updateGtalkStatus()
@@ -0,0 +1,450 @@
+"""Google Talk shared status module
+
+Sets the status message of a Google Talk account through the
+google:shared-status extension. SessionPool keeps one authenticated
+xmpp.Client per JID, so status updates reuse the bound stream instead of
+connecting, starting TLS and authenticating every time.
+
+The streams are all read by one Dispatcher thread, select()ing on their
+sockets. Updates are started on that thread and report back through a
+Future, so nobody spins on Process(1) waiting for an answer. The
+dispatcher also closes the sessions left idle, every EXPIRE_EVERY
+seconds.
+"""
+
+import os
+import select
+import threading
+import time
+
+import xmpp
+
+SHARED_STATUS = 'google:shared-status'
+SERVER = ('talk.google.com', 5222)
+
+# Seconds a session is kept unused. Pushes come from an hourly cron, so
+# anything shorter would close every session before its next update
+IDLE = 2 * 3600
+# Seconds between looks for idle sessions
+EXPIRE_EVERY = 60
+
+# Limits the server sends with its status list, not to be sent back
+STATUS_LIMITS = ('status-list-max', 'status-max', 'status-list-contents-max')
+
+class StatusError(Exception):
+    """The shared status could not be read or set"""
+
+class Disconnected(StatusError):
+    """The stream was closed under us"""
+
+def status_query(jid):
+    """Returns the iq asking for the shared status of 'jid'"""
+
+    iq = xmpp.Iq(typ='get', to=jid)
+    iq.addChild(name='query', namespace=SHARED_STATUS)
+    return iq
+
+def status_update(result, status):
+    """Returns the iq setting 'status', built from the 'result' of a
+    status_query, or None if 'status' is already set"""
+
+    query = result.getTag('query', namespace=SHARED_STATUS)
+    if query is None:
+        raise StatusError('no shared status in %s' % result)
+
+    current = query.getTag('status')
+    if current is None:
+        current = query.addChild('status')
+    elif current.getData() == status:
+        return None
+
+    for limit in STATUS_LIMITS:
+        query.delAttr(limit)
+    current.setData(status)
+
+    # no 'to': the result is addressed to our own full JID, and a set sent
+    # there would go to this resource instead of the server
+    iq = xmpp.Iq(typ='set')
+    iq.addChild(node=query)
+    return iq
+
+class Future:
+    """The outcome of an update, finished on the dispatcher thread"""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.finished = threading.Event()
+        self.callbacks = []
+        self.value = None
+        self.error = None
+        self.started = time.time()
+        self.ended = None
+
+    def done(self):
+        return self.finished.isSet()
+
+    def finish(self, value, error):
+        self.lock.acquire()
+        try:
+            if self.done():
+                return
+            self.value = value
+            self.error = error
+            self.ended = time.time()
+            self.finished.set()
+            callbacks = self.callbacks
+            self.callbacks = []
+        finally:
+            self.lock.release()
+        for callback in callbacks:
+            callback(self)
+
+    def set_result(self, value):
+        self.finish(value, None)
+
+    def set_exception(self, error):
+        self.finish(None, error)
+
+    def add_done_callback(self, callback):
+        self.lock.acquire()
+        try:
+            if not self.done():
+                self.callbacks.append(callback)
+                return
+        finally:
+            self.lock.release()
+        callback(self)
+
+    def result(self, timeout=None):
+        """Waits for the update and returns its result or raises its error"""
+
+        self.finished.wait(timeout)
+        if not self.done():
+            raise StatusError('timed out')
+        if self.error is not None:
+            raise self.error
+        return self.value
+
+    def latency(self):
+        """Seconds from start to finish of the update"""
+
+        return self.ended - self.started
+
+class Dispatcher:
+    """Reads many xmpp.Client streams on one thread
+
+    Functions passed to call() and the stanza handlers of the added clients
+    run on that thread, so clients are only ever touched from it once
+    added.
+    """
+
+    def __init__(self):
+        self.clients = {}
+        self.calls = []
+        self.timers = []
+        self.repeats = []
+        self.lock = threading.Lock()
+        (self.wakeup, self.waker) = os.pipe()
+        self.thread = None
+        self.running = False
+
+    def call(self, func, *args):
+        """Runs func(*args) on the dispatcher thread, or right away when
+        there is none and step() is called by hand"""
+
+        if self.thread is None or threading.currentThread() is self.thread:
+            func(*args)
+            return
+        self.lock.acquire()
+        try:
+            self.calls.append((func, args))
+        finally:
+            self.lock.release()
+        os.write(self.waker, 'x')
+
+    def add(self, client):
+        self.call(self.clients.__setitem__, client.Connection._sock, client)
+
+    def remove(self, client):
+        """Stops reading 'client' and disconnects it"""
+
+        def remove():
+            self.clients.pop(client.Connection._sock, None)
+            if client.isConnected():
+                try:
+                    client.disconnect()
+                except IOError:
+                    pass
+        self.call(remove)
+
+    def timeout(self, future, seconds):
+        """Fails 'future' if it is not done in 'seconds'"""
+
+        self.call(self.timers.append, (time.time() + seconds, future))
+
+    def every(self, seconds, func):
+        """Runs func() on the dispatcher thread every 'seconds'. Returns
+        the repeat to cancel()."""
+
+        repeat = [time.time() + seconds, seconds, func]
+        self.call(self.repeats.append, repeat)
+        return repeat
+
+    def cancel(self, repeat):
+        def cancel():
+            self.repeats = [other for other in self.repeats if other is not repeat]
+        self.call(cancel)
+
+    def step(self, timeout=None):
+        self.lock.acquire()
+        try:
+            calls = self.calls
+            self.calls = []
+        finally:
+            self.lock.release()
+        for func, args in calls:
+            func(*args)
+        if calls:
+            # come back round to anything the calls changed, stop() too
+            timeout = 0
+
+        now = time.time()
+        for timer in [timer for timer in self.timers
+                      if timer[0] <= now or timer[1].done()]:
+            self.timers.remove(timer)
+            timer[1].set_exception(StatusError('timed out'))
+        for repeat in self.repeats[:]:
+            if repeat[0] <= now:
+                repeat[0] = now + repeat[1]
+                repeat[2]()
+        deadlines = [timer[0] for timer in self.timers + self.repeats]
+        if deadlines:
+            deadline = min(deadlines) - now
+            if timeout is None or deadline < timeout:
+                timeout = max(deadline, 0)
+
+        sockets = self.clients.keys()
+        try:
+            readable = select.select([self.wakeup] + sockets, [], [], timeout)[0]
+        except (select.error, ValueError):
+            # a socket closed under us, drop it on the next read
+            readable = sockets
+        if self.wakeup in readable:
+            os.read(self.wakeup, 4096)
+            readable.remove(self.wakeup)
+
+        for sock in readable:
+            client = self.clients.get(sock)
+            if client is None:
+                continue
+            try:
+                # TLS may hold more than one read worth of data
+                while True:
+                    received = client.Process(0)
+                    if not received:
+                        self.clients.pop(sock, None)
+                        break
+                    if received == '0':
+                        break
+            except IOError:
+                self.clients.pop(sock, None)
+
+    def run(self):
+        self.running = True
+        while self.running:
+            self.step()
+
+    def start(self):
+        """Runs the dispatcher on a background thread"""
+
+        if self.thread is not None:
+            return
+        self.thread = threading.Thread(target=self.run)
+        self.thread.setDaemon(True)
+        self.thread.start()
+
+    def stop(self):
+        def stop():
+            self.running = False
+        self.call(stop)
+        if self.thread is not None and self.thread is not threading.currentThread():
+            self.thread.join()
+        self.thread = None
+
+class Session:
+    """An authenticated stream for 'jid', read by 'dispatcher'"""
+
+    def __init__(self, jid, password, dispatcher, server=SERVER):
+        self.jid = xmpp.protocol.JID(jid)
+        self.password = password
+        self.dispatcher = dispatcher
+        self.server = server
+        self.client = None
+        self.pending = []
+        self.lock = threading.Lock()
+        self.used = time.time()
+
+    def connect(self):
+        client = xmpp.Client(self.jid.getDomain(), debug=[])
+        if not client.connect(self.server):
+            raise StatusError('can not connect to %s:%d' % self.server)
+        if not client.auth(self.jid.getNode(), self.password):
+            client.disconnect()
+            raise StatusError('can not auth %s' % self.jid)
+        client.UnregisterDisconnectHandler(client.DisconnectHandler)
+        client.RegisterDisconnectHandler(self.disconnected)
+        self.client = client
+        self.dispatcher.add(client)
+
+    def connected(self):
+        return self.client is not None and self.client.isConnected()
+
+    def disconnected(self):
+        pending = self.pending
+        self.pending = []
+        for future in pending:
+            future.set_exception(Disconnected(str(self.jid)))
+
+    def request(self, iq, future, callback):
+        """Sends 'iq' and calls callback(response) with the result"""
+
+        def response(dispatcher, stanza):
+            if future.done():
+                return
+            if stanza.getType() != 'result':
+                future.set_exception(StatusError(str(stanza)))
+                return
+            try:
+                callback(stanza)
+            except StatusError, e:
+                future.set_exception(e)
+
+        try:
+            self.client.SendAndCallForResponse(iq, response)
+        except IOError:
+            future.set_exception(Disconnected(str(self.jid)))
+
+    def update(self, status, future):
+        """Sets the status message to 'status' and finishes 'future' with
+        False if it already was, True otherwise. Runs on the dispatcher
+        thread."""
+
+        self.used = time.time()
+        if not self.connected():
+            future.set_exception(Disconnected(str(self.jid)))
+            return
+        self.pending.append(future)
+        future.add_done_callback(self.forget)
+
+        def queried(result):
+            update = status_update(result, status)
+            if update is None:
+                future.set_result(False)
+            else:
+                self.request(update, future, lambda result: future.set_result(True))
+
+        self.request(status_query(self.jid.getStripped()), future, queried)
+
+    def forget(self, future):
+        if future in self.pending:
+            self.pending.remove(future)
+
+    def close(self):
+        if self.client is not None:
+            self.dispatcher.remove(self.client)
+        self.client = None
+
+class SessionPool:
+    """Sessions kept per JID, closed after 'idle' seconds unused"""
+
+    def __init__(self, server=SERVER, idle=IDLE, timeout=10, dispatcher=None,
+                 expire_every=EXPIRE_EVERY):
+        self.server = server
+        self.idle = idle
+        self.timeout = timeout
+        self.sessions = {}
+        self.lock = threading.Lock()
+        self.own_dispatcher = dispatcher is None
+        self.dispatcher = dispatcher or Dispatcher()
+        self.dispatcher.start()
+        self.expiry = self.dispatcher.every(expire_every, self.expire)
+
+    def expire(self, now=None):
+        """Closes the sessions unused for 'idle' seconds"""
+
+        if now is None:
+            now = time.time()
+        self.lock.acquire()
+        try:
+            expired = [(jid, session) for jid, session in self.sessions.items()
+                       if now - session.used > self.idle]
+            for jid, session in expired:
+                del self.sessions[jid]
+        finally:
+            self.lock.release()
+        for jid, session in expired:
+            session.close()
+
+    def session(self, jid, password):
+        self.expire()
+        self.lock.acquire()
+        try:
+            session = self.sessions.get(jid)
+            if session is None or session.password != password:
+                if session is not None:
+                    session.close()
+                session = Session(jid, password, self.dispatcher, self.server)
+                self.sessions[jid] = session
+            # not to be expired while the update is started
+            session.used = time.time()
+            return session
+        finally:
+            self.lock.release()
+
+    def update_async(self, jid, password, status):
+        """Starts setting the status message of 'jid' to 'status' over its
+        pooled session, connecting first if there is none or it died.
+        Returns a Future of Session.update()."""
+
+        future = Future()
+        session = self.session(jid, password)
+        session.lock.acquire()
+        try:
+            try:
+                if not session.connected():
+                    session.close()
+                    session.connect()
+            except StatusError, e:
+                future.set_exception(e)
+                return future
+        finally:
+            session.lock.release()
+
+        self.dispatcher.call(session.update, status, future)
+        self.dispatcher.timeout(future, self.timeout)
+        return future
+
+    def update_status(self, jid, password, status):
+        """Sets the status message of 'jid' to 'status', retrying once on a
+        new stream if the pooled one turns out dead. Returns False if
+        'status' already was set."""
+
+        try:
+            return self.update_async(jid, password, status).result()
+        except Disconnected:
+            return self.update_async(jid, password, status).result()
+
+    def close(self):
+        self.lock.acquire()
+        try:
+            sessions = self.sessions.values()
+            self.sessions = {}
+        finally:
+            self.lock.release()
+        for session in sessions:
+            session.close()
+        self.dispatcher.cancel(self.expiry)
+        if self.own_dispatcher:
+            self.dispatcher.stop()
+
+__all__ = ["SessionPool", "Dispatcher", "Future", "StatusError"]
@@ -0,0 +1,375 @@
+"""Twitter timeline module
+
+Fetches the latest tweet of one or many Twitter users. Requests go through
+a transport: keep-alive httplib connections, or urlfetch RPCs on App
+Engine. Either way at most 'limit' requests are in flight per host, and
+rate-limited responses are waited out before trying again. Failures of
+the transport, timeouts too, are reported as TimelineError.
+"""
+
+import httplib
+import socket
+import threading
+import time
+import Queue
+
+try:
+    import simplejson
+except ImportError:
+    import json as simplejson
+
+try:
+    from google.appengine.api import urlfetch
+except ImportError:
+    urlfetch = None
+
+TIMELINE_PATH = '/statuses/user_timeline/%s.json?count=1'
+
+# Twitter answers 400 when the hourly limit is used up, newer versions
+# of the API 420 or 429
+RATE_LIMITED = (400, 420, 429, 503)
+
+# Seconds to wait on a rate-limited response without a reset time, per
+# rate-limited response in a row
+BACKOFF = 2
+MAX_BACKOFF = 300
+
+class TimelineError(Exception):
+    """The timeline could not be fetched"""
+
+class RateLimitError(TimelineError):
+    """Twitter will not answer before 'reset' (seconds since the epoch)"""
+
+    def __init__(self, reset):
+        TimelineError.__init__(self, 'rate limited until %d' % reset)
+        self.reset = reset
+
+def transport_error(error):
+    """Returns 'error', raised by a transport, as a TimelineError
+
+    >>> transport_error(socket.timeout('timed out'))
+    TimelineError('timeout: timed out',)
+    """
+
+    if isinstance(error, TimelineError):
+        return error
+    return TimelineError('%s: %s' % (error.__class__.__name__, error))
+
+def timeline_path(screen_name, since_id=None):
+    """Returns the path of the latest tweet of 'screen_name'
+
+    >>> timeline_path('gpowered')
+    '/statuses/user_timeline/gpowered.json?count=1'
+    >>> timeline_path('gpowered', 42)
+    '/statuses/user_timeline/gpowered.json?count=1&since_id=42'
+    """
+
+    path = TIMELINE_PATH % screen_name
+    if since_id:
+        path = '%s&since_id=%d' % (path, since_id)
+    return path
+
+def parse_timeline(status, body):
+    """Returns (id, text) of the tweet in a timeline response, or None if
+    there is no tweet newer than since_id or the user is protected or
+    unknown
+
+    >>> parse_timeline(200, '[{"id": 12, "text": "hi"}]') == (12, u'hi')
+    True
+    >>> parse_timeline(200, '[]'), parse_timeline(404, 'Not found')
+    (None, None)
+    >>> parse_timeline(500, '')
+    Traceback (most recent call last):
+    TimelineError: HTTP 500
+    """
+
+    if status in (401, 404):
+        return None
+    if status != 200:
+        raise TimelineError('HTTP %d' % status)
+
+    try:
+        json = simplejson.loads(body)
+    except ValueError:
+        raise TimelineError('not a timeline')
+    if not json:
+        return None
+    return (json[0].get('id'), json[0].get('text'))
+
+def reset_time(headers, now):
+    """Returns when a rate-limited response says to try again, or None
+
+    >>> reset_time({'retry-after': '30'}, 1000)
+    1030
+    >>> reset_time({'x-ratelimit-reset': '1200'}, 1000)
+    1200
+    >>> reset_time({}, 1000)
+    """
+
+    if headers.get('retry-after'):
+        return now + int(headers['retry-after'])
+    if headers.get('x-ratelimit-reset'):
+        return int(headers['x-ratelimit-reset'])
+    return None
+
+class HTTPConnection(httplib.HTTPConnection):
+    """HTTPConnection with a socket timeout"""
+
+    def __init__(self, host, port=None, io_timeout=None):
+        httplib.HTTPConnection.__init__(self, host, port)
+        self.io_timeout = io_timeout
+
+    def connect(self):
+        httplib.HTTPConnection.connect(self)
+        self.sock.settimeout(self.io_timeout)
+
+class HTTPTransport:
+    """Fetches over keep-alive connections, reusing idle ones and opening
+    at most 'limit' per host"""
+
+    def __init__(self, limit=4, timeout=10):
+        self.limit = limit
+        self.timeout = timeout
+        self.lock = threading.Lock()
+        self.idle = {}
+        self.slots = {}
+
+    def connection(self, host):
+        self.lock.acquire()
+        try:
+            if host not in self.slots:
+                self.slots[host] = threading.BoundedSemaphore(self.limit)
+                self.idle[host] = []
+            slots = self.slots[host]
+        finally:
+            self.lock.release()
+
+        slots.acquire()
+        self.lock.acquire()
+        try:
+            if self.idle[host]:
+                return self.idle[host].pop()
+        finally:
+            self.lock.release()
+        (name, port) = (host.split(':') + [None])[:2]
+        return HTTPConnection(name, port and int(port), self.timeout)
+
+    def release(self, host, connection):
+        self.lock.acquire()
+        try:
+            if connection is not None:
+                self.idle[host].append(connection)
+        finally:
+            self.lock.release()
+        self.slots[host].release()
+
+    def request(self, connection, path):
+        connection.request('GET', path, headers={'Connection': 'keep-alive'})
+        response = connection.getresponse()
+        body = response.read()
+        headers = dict([(name.lower(), value)
+                        for name, value in response.getheaders()])
+        return (response.status, headers, body)
+
+    def fetch(self, host, path):
+        """Returns (status, headers, body) of GET http://host/path"""
+
+        connection = self.connection(host)
+        try:
+            try:
+                result = self.request(connection, path)
+            except (httplib.HTTPException, socket.error):
+                # the server may have dropped an idle connection
+                connection.close()
+                result = self.request(connection, path)
+        except (httplib.HTTPException, socket.error), e:
+            connection.close()
+            self.release(host, None)
+            raise transport_error(e)
+        except:
+            connection.close()
+            self.release(host, None)
+            raise
+        self.release(host, connection)
+        return result
+
+    def fetch_many(self, host, paths):
+        """Returns (status, headers, body) for every path in 'paths', or the
+        exception raised fetching it"""
+
+        if len(paths) == 1:
+            try:
+                return [self.fetch(host, paths[0])]
+            except Exception, e:
+                return [transport_error(e)]
+
+        results = [None] * len(paths)
+        queue = Queue.Queue()
+        for index in range(len(paths)):
+            queue.put(index)
+
+        def work():
+            while True:
+                try:
+                    index = queue.get_nowait()
+                except Queue.Empty:
+                    return
+                try:
+                    results[index] = self.fetch(host, paths[index])
+                except Exception, e:
+                    results[index] = transport_error(e)
+
+        threads = [threading.Thread(target=work)
+                   for i in range(min(self.limit, len(paths)))]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        return results
+
+class UrlfetchTransport:
+    """Fetches with urlfetch RPCs on App Engine, 'limit' at a time"""
+
+    def __init__(self, limit=10, timeout=10):
+        self.limit = limit
+        self.timeout = timeout
+
+    def start(self, host, path):
+        """Returns the RPC fetching 'path', or the error starting it"""
+
+        rpc = urlfetch.create_rpc(deadline=self.timeout)
+        try:
+            urlfetch.make_fetch_call(rpc, 'http://%s%s' % (host, path))
+        except urlfetch.Error, e:
+            return transport_error(e)
+        return rpc
+
+    def result(self, rpc):
+        if isinstance(rpc, Exception):
+            return rpc
+        try:
+            result = rpc.get_result()
+        except urlfetch.Error, e:
+            return transport_error(e)
+        headers = dict([(name.lower(), value)
+                        for name, value in result.headers.items()])
+        return (result.status_code, headers, result.content)
+
+    def fetch(self, host, path):
+        result = self.result(self.start(host, path))
+        if isinstance(result, Exception):
+            raise result
+        return result
+
+    def fetch_many(self, host, paths):
+        results = [None] * len(paths)
+        rpcs = []
+        for index in range(len(paths)):
+            if len(rpcs) == self.limit:
+                (done, rpc) = rpcs.pop(0)
+                results[done] = self.result(rpc)
+            rpcs.append((index, self.start(host, paths[index])))
+        for done, rpc in rpcs:
+            results[done] = self.result(rpc)
+        return results
+
+def default_transport():
+    if urlfetch is not None:
+        return UrlfetchTransport()
+    return HTTPTransport()
+
+class TimelineClient:
+    """Fetches latest tweets from 'host', waiting out rate limits of at
+    most 'max_wait' seconds and retrying 'retries' times"""
+
+    def __init__(self, host='twitter.com', transport=None, max_wait=60,
+                 retries=2):
+        self.host = host
+        self.transport = transport or default_transport()
+        self.max_wait = max_wait
+        self.retries = retries
+        self.reset = 0
+        self.strikes = 0
+        self.sleep = time.sleep
+
+    def wait(self):
+        """Sleeps until the rate limit is over"""
+
+        delay = self.reset - time.time()
+        if delay > self.max_wait:
+            raise RateLimitError(self.reset)
+        if delay > 0:
+            self.sleep(delay)
+
+    def limited(self, headers):
+        now = time.time()
+        self.strikes += 1
+        reset = reset_time(headers, now)
+        if reset is None:
+            reset = now + min(BACKOFF ** self.strikes, MAX_BACKOFF)
+        self.reset = max(self.reset, reset)
+
+    def fetch_many(self, paths):
+        """Returns responses for 'paths', or the exceptions fetching them.
+        Paths still rate limited when the wait would be too long get a
+        RateLimitError."""
+
+        results = [None] * len(paths)
+        pending = range(len(paths))
+        for attempt in range(self.retries + 1):
+            try:
+                self.wait()
+            except RateLimitError, e:
+                for index in pending:
+                    results[index] = e
+                break
+            responses = self.transport.fetch_many(self.host,
+                                                  [paths[i] for i in pending])
+            limited = []
+            for index, response in zip(pending, responses):
+                if not isinstance(response, Exception) and \
+                   response[0] in RATE_LIMITED and \
+                   (response[0] != 400 or
+                    response[1].get('x-ratelimit-remaining') == '0'):
+                    self.limited(response[1])
+                    response = RateLimitError(self.reset)
+                    limited.append(index)
+                results[index] = response
+            if not limited:
+                self.strikes = 0
+                break
+            pending = limited
+        return results
+
+    def latest(self, screen_name, since_id=None):
+        """Returns (id, text) of the latest tweet of 'screen_name', or None
+        if there is none newer than 'since_id'. Raises TimelineError if it
+        could not be fetched."""
+
+        response = self.fetch_many([timeline_path(screen_name, since_id)])[0]
+        if isinstance(response, Exception):
+            raise response
+        return parse_timeline(response[0], response[2])
+
+    def latest_many(self, screen_names, since_ids={}):
+        """Returns a dict of screen name to latest() for 'screen_names' in
+        one go. Names whose timeline could not be fetched are left out."""
+
+        paths = [timeline_path(name, since_ids.get(name))
+                 for name in screen_names]
+        tweets = {}
+        for name, response in zip(screen_names, self.fetch_many(paths)):
+            if isinstance(response, Exception):
+                continue
+            try:
+                tweets[name] = parse_timeline(response[0], response[2])
+            except TimelineError:
+                pass
+        return tweets
+
+# Do doctest if we're not imported
+if __name__ == "__main__":
+    import doctest
+    doctest.testmod()
+
+__all__ = ["TimelineClient", "TimelineError", "RateLimitError"]